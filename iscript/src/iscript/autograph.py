@@ -8,6 +8,7 @@ import json
 import logging
 import os
 import re
+import shutil
 import tempfile
 import zipfile
 
@@ -373,9 +374,7 @@ async def sign_omnija_with_autograph(config, sign_config, app_path):
 
         await sign_file_with_autograph(sign_config, from_, "autograph_omnija", to=signed_out, extension_id="omni.ja@mozilla.org")
         await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out)
-        with open(from_, "wb") as fout:
-            with open(merged_out, "rb") as fin:
-                fout.write(fin.read())
+        shutil.copyfile(merged_out, from_)
     return files_to_sign
 
 
@@ -396,19 +395,21 @@ async def merge_omnija_files(orig, signed, to):
         bool: always True if function succeeded.
 
     """
-    orig_jarreader = mozjar.JarReader(orig)
-    with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
-        for origjarfile in orig_jarreader:
-            to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
-        # Use ZipFile here because mozjar can't read the signed copies
-        signed_zip = zipfile.ZipFile(signed, "r")
-        for fname in signed_zip.namelist():
-            if fname.startswith("META-INF"):
-                to_writer.add(fname, signed_zip.open(fname, "r"))
-        if orig_jarreader.last_preloaded:
-            jarlog = list(orig_jarreader.entries.keys())
-            preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
-            to_writer.preload(preloads)
+    # Memory-map the original, so its entries can be copied into the new jar
+    # without reading the whole archive into memory
+    with mozjar.JarReader(orig, use_mmap=True) as orig_jarreader:
+        with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
+            for origjarfile in orig_jarreader:
+                to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
+            # Use ZipFile here because mozjar can't read the signed copies
+            signed_zip = zipfile.ZipFile(signed, "r")
+            for fname in signed_zip.namelist():
+                if fname.startswith("META-INF"):
+                    to_writer.add(fname, signed_zip.open(fname, "r"))
+            if orig_jarreader.last_preloaded:
+                jarlog = list(orig_jarreader.entries.keys())
+                preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
+                to_writer.preload(preloads)
     return True
 
 
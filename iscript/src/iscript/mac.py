@@ -17,7 +17,7 @@ import attr
 import pexpect
 from scriptworker_client.aio import download_file, raise_future_exceptions, retry_async, semaphore_wrapper
 from scriptworker_client.exceptions import DownloadError
-from scriptworker_client.utils import get_artifact_path, makedirs, rm, run_command
+from scriptworker_client.utils import get_artifact_path, get_command_pool, makedirs, rm, run_command
 
 from iscript.autograph import sign_langpacks, sign_omnija_with_autograph, sign_widevine_dir
 from iscript.exceptions import InvalidNotarization, IScriptError, ThrottledNotarization, TimeoutError, UnknownAppDir, UnknownNotarizationError
@@ -467,6 +467,7 @@ async def extract_all_apps(config, all_paths):
     """
     log.info("Extracting all apps")
     futures = []
+    pool = get_command_pool()
     work_dir = config["work_dir"]
     unpack_dmg = os.path.join(os.path.dirname(__file__), "data", "unpack-diskimage")
     for counter, app in enumerate(all_paths):
@@ -475,18 +476,22 @@ async def extract_all_apps(config, all_paths):
         rm(app.parent_dir)
         makedirs(app.parent_dir)
         if app.orig_path.endswith((".tar.bz2", ".tar.gz", ".tgz")):
-            futures.append(asyncio.ensure_future(run_command(["tar", "xf", app.orig_path], cwd=app.parent_dir, exception=IScriptError)))
+            futures.append(asyncio.ensure_future(pool.run(["tar", "xf", app.orig_path], io_class="disk", cwd=app.parent_dir, exception=IScriptError)))
         elif app.orig_path.endswith(".dmg"):
             unpack_mountpoint = os.path.join("/tmp", f"{config.get('dmg_prefix', 'dmg')}-{counter}-unpack")
             futures.append(
                 asyncio.ensure_future(
-                    run_command(
-                        [unpack_dmg, app.orig_path, unpack_mountpoint, app.parent_dir], cwd=app.parent_dir, exception=IScriptError, log_level=logging.DEBUG
+                    pool.run(
+                        [unpack_dmg, app.orig_path, unpack_mountpoint, app.parent_dir],
+                        io_class="disk",
+                        cwd=app.parent_dir,
+                        exception=IScriptError,
+                        log_level=logging.DEBUG,
                     )
                 )
             )
         elif app.orig_path.endswith(".zip"):
-            futures.append(asyncio.ensure_future(run_command(["unzip", app.orig_path], cwd=app.parent_dir, exception=IScriptError)))
+            futures.append(asyncio.ensure_future(pool.run(["unzip", app.orig_path], io_class="disk", cwd=app.parent_dir, exception=IScriptError)))
         else:
             raise IScriptError(f"unknown file type {app.orig_path}")
     await raise_future_exceptions(futures)
@@ -509,6 +514,7 @@ async def create_all_notarization_zipfiles(all_paths, path_attrs):
 
     """
     futures = []
+    pool = get_command_pool()
     required_attrs = ["parent_dir"] + path_attrs
     # zip up apps
     for app in all_paths:
@@ -516,7 +522,7 @@ async def create_all_notarization_zipfiles(all_paths, path_attrs):
         parent_base_name = os.path.basename(app.parent_dir)
         app.zip_path = f"{app.parent_dir}-upload{parent_base_name}.zip"
         paths = [os.path.relpath(getattr(app, this_attr), app.parent_dir) for this_attr in path_attrs]
-        futures.append(asyncio.ensure_future(run_command(["zip", "-r", app.zip_path] + paths, cwd=app.parent_dir, exception=IScriptError)))
+        futures.append(asyncio.ensure_future(pool.run(["zip", "-r", app.zip_path] + paths, io_class="disk", cwd=app.parent_dir, exception=IScriptError)))
     await raise_future_exceptions(futures)
 
 
@@ -878,18 +884,21 @@ async def staple_notarization(all_paths, path_attr="app_path"):
     """
     log.info("Stapling apps")
     futures = []
+    pool = get_command_pool()
     for app in all_paths:
         app.check_required_attrs([path_attr])
         cwd = os.path.dirname(getattr(app, path_attr))
         path = os.path.basename(getattr(app, path_attr))
         futures.append(
             asyncio.ensure_future(
-                retry_async(
-                    run_command,
-                    args=[["xcrun", "stapler", "staple", path]],
-                    kwargs={"cwd": cwd, "exception": IScriptError, "log_level": logging.DEBUG},
-                    retry_exceptions=(IScriptError,),
+                pool.run(
+                    ["xcrun", "stapler", "staple", path],
+                    io_class="network",
                     attempts=10,
+                    retry_exceptions=(IScriptError,),
+                    cwd=cwd,
+                    exception=IScriptError,
+                    log_level=logging.DEBUG,
                 )
             )
         )
@@ -912,6 +921,7 @@ async def tar_apps(config, all_paths):
     """
     log.info("Tarring up artifacts")
     futures = []
+    pool = get_command_pool()
     for app in all_paths:
         app.check_required_attrs(["orig_path", "parent_dir", "app_path", "artifact_prefix"])
         # If we downloaded public/build/locale/target.tar.gz, then write to
@@ -926,9 +936,10 @@ async def tar_apps(config, all_paths):
         env["COPYFILE_DISABLE"] = "1"
         futures.append(
             asyncio.ensure_future(
-                run_command(
+                pool.run(
                     ["tar", _get_tar_create_options(app.target_tar_path), app.target_tar_path]
                     + [f for f in os.listdir(cwd) if f != "[]" and not f.endswith(".pkg")],
+                    io_class="disk",
                     cwd=cwd,
                     env=env,
                     exception=IScriptError,
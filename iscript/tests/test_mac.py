@@ -11,6 +11,7 @@ import arrow
 import mock
 import pexpect
 import pytest
+import scriptworker_client.utils as client_utils
 from scriptworker_client.utils import makedirs
 
 import iscript.mac as mac
@@ -307,7 +308,7 @@ async def test_extract_all_apps(mocker, tmpdir, suffix, command, raises):
         if raises:
             raise IScriptError("foo")
 
-    mocker.patch.object(mac, "run_command", new=fake_run_command)
+    mocker.patch.object(client_utils, "run_command", new=fake_run_command)
     work_dir = os.path.join(str(tmpdir), "work")
     config = {"work_dir": work_dir, "dmg_prefix": "test"}
     all_paths = [
@@ -335,7 +336,7 @@ async def test_create_all_notarization_zipfiles(mocker, tmpdir, raises):
         if raises:
             raise IScriptError("foo")
 
-    mocker.patch.object(mac, "run_command", new=fake_run_command)
+    mocker.patch.object(client_utils, "run_command", new=fake_run_command)
     all_paths = []
     work_dir = str(tmpdir)
     for i in range(3):
@@ -680,8 +681,8 @@ async def test_staple_notarization(mocker, raises):
 
     """
 
-    async def fake_retry_async(*args, **kwargs):
-        assert kwargs["args"][0][0] == "xcrun"
+    async def fake_run_command(*args, **kwargs):
+        assert args[0][0] == "xcrun"
         if raises:
             raise IScriptError("foo")
 
@@ -691,7 +692,8 @@ async def test_staple_notarization(mocker, raises):
         app_name = f"{i}.app"
         app_path = os.path.join(parent_dir, app_name)
         all_paths.append(mac.App(parent_dir=parent_dir, app_name=app_name, app_path=app_path))
-    mocker.patch.object(mac, "retry_async", new=fake_retry_async)
+    mocker.patch.object(client_utils, "run_command", new=fake_run_command)
+    mocker.patch.object(asyncio, "sleep", new=noop_async)
     if raises:
         with pytest.raises(IScriptError):
             await mac.staple_notarization(all_paths)
@@ -738,7 +740,7 @@ async def test_tar_apps(mocker, tmpdir, raises, artifact_prefix):
         )
         expected.append(os.path.join(config["artifact_dir"], artifact_prefix, "build", "{}/{}.tar.gz".format(i, i)))
 
-    mocker.patch.object(mac, "run_command", new=noop_async)
+    mocker.patch.object(client_utils, "run_command", new=noop_async)
     mocker.patch.object(mac, "raise_future_exceptions", new=fake_raise_future_exceptions)
     if raises:
         with pytest.raises(IScriptError):
@@ -933,6 +935,7 @@ async def test_sign_behavior(mocker, tmpdir, use_langpack):
 
     mocker.patch.object(os, "listdir", return_value=[])
     mocker.patch.object(mac, "run_command", new=noop_async)
+    mocker.patch.object(client_utils, "run_command", new=noop_async)
     mocker.patch.object(mac, "unlock_keychain", new=noop_async)
     mocker.patch.object(mac, "get_bundle_executable", return_value="bundle_executable")
     mocker.patch.object(mac, "get_app_dir", return_value=os.path.join(work_dir, "foo/bar.app"))
@@ -990,6 +993,7 @@ async def test_sign_and_pkg_behavior(mocker, tmpdir, use_langpack):
 
     mocker.patch.object(os, "listdir", return_value=[])
     mocker.patch.object(mac, "run_command", new=noop_async)
+    mocker.patch.object(client_utils, "run_command", new=noop_async)
     mocker.patch.object(mac, "unlock_keychain", new=noop_async)
     mocker.patch.object(mac, "get_bundle_executable", return_value="bundle_executable")
     mocker.patch.object(mac, "get_app_dir", return_value=os.path.join(work_dir, "foo/bar.app"))
@@ -1046,6 +1050,7 @@ async def test_notarize_behavior(mocker, tmpdir, notarize_type, use_langpack):
 
     mocker.patch.object(os, "listdir", return_value=[])
     mocker.patch.object(mac, "run_command", new=noop_async)
+    mocker.patch.object(client_utils, "run_command", new=noop_async)
     mocker.patch.object(mac, "unlock_keychain", new=noop_async)
     mocker.patch.object(mac, "get_bundle_executable", return_value="bundle_executable")
     mocker.patch.object(mac, "poll_notarization_uuid", new=noop_async)
@@ -1104,6 +1109,7 @@ async def test_notarize_1_behavior(mocker, tmpdir, notarize_type, use_langpack):
 
     mocker.patch.object(os, "listdir", return_value=[])
     mocker.patch.object(mac, "run_command", new=noop_async)
+    mocker.patch.object(client_utils, "run_command", new=noop_async)
     mocker.patch.object(mac, "unlock_keychain", new=noop_async)
     mocker.patch.object(mac, "get_bundle_executable", return_value="bundle_executable")
     mocker.patch.object(mac, "get_app_dir", return_value=os.path.join(work_dir, "foo/bar.app"))
@@ -1160,6 +1166,7 @@ async def test_notarize_3_behavior(mocker, tmpdir):
     }
 
     mocker.patch.object(mac, "run_command", new=noop_async)
+    mocker.patch.object(client_utils, "run_command", new=noop_async)
     mocker.patch.object(mac, "tar_apps", new=noop_async)
     mocker.patch.object(mac, "get_app_dir", return_value=os.path.join(work_dir, "foo/bar.app"))
     mocker.patch.object(mac, "copy_pkgs_to_artifact_dir", new=noop_async)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Benchmark ``download_file`` against the old one-small-chunk-at-a-time loop.
+
+This serves a file of random bytes from a local aiohttp server, then times
+downloading it several times over with the old loop (a new session per
+download, 128 byte reads, blocking writes), and with ``download_file`` at
+each segment count.
+
+Usage::
+
+    python benchmarks/download_file.py [size_in_mb] [segments ...]
+
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import scriptworker_client.aio as aio
+
+DOWNLOADS = 3
+
+
+async def legacy_download_file(url, abs_filename, chunk_size=128, timeout=300):
+    """Download a file the way ``download_file`` used to."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, timeout=timeout) as resp:
+            assert resp.status == 200
+            with open(abs_filename, "wb") as fd:
+                while True:
+                    chunk = await resp.content.read(chunk_size)
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+
+
+async def time_downloads(name, coro_factory, path, size):
+    """Download ``DOWNLOADS`` times, and print the throughput."""
+    start = time.time()
+    for _ in range(DOWNLOADS):
+        await coro_factory()
+        assert os.path.getsize(path) == size
+        os.remove(path)
+    elapsed = time.time() - start
+    print(
+        f"{name:<12} {elapsed:7.2f}s  {DOWNLOADS * size / 2 ** 20 / elapsed:8.1f} MB/s"
+    )
+
+
+async def async_main(size_mb, all_segments):
+    """Serve a file and benchmark downloading it."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        served = os.path.join(tmp_dir, "served")
+        with open(served, "wb") as fh:
+            for _ in range(size_mb):
+                fh.write(os.urandom(2 ** 20))
+        size = os.path.getsize(served)
+
+        async def handler(request):
+            return web.FileResponse(served)
+
+        app = web.Application()
+        app.router.add_get("/file", handler)
+        server = TestServer(app)
+        await server.start_server()
+        url = str(server.make_url("/file"))
+        path = os.path.join(tmp_dir, "downloaded")
+        print(f"file: {size_mb} MB, {DOWNLOADS} downloads each")
+        try:
+            await time_downloads(
+                "legacy", lambda: legacy_download_file(url, path), path, size
+            )
+            for segments in all_segments:
+                await time_downloads(
+                    f"segments={segments}",
+                    lambda: aio.download_file(
+                        url, path, segments=segments, segment_threshold=0
+                    ),
+                    path,
+                    size,
+                )
+        finally:
+            await aio.close_client_sessions()
+            await server.close()
+
+
+def main():
+    """Parse the arguments and run the benchmark."""
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    all_segments = [int(s) for s in sys.argv[2:]] or [1, 4]
+    asyncio.run(async_main(size_mb, all_segments))
+
+
+if __name__ == "__main__":
+    main()
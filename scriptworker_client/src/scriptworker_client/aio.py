@@ -2,10 +2,14 @@
 """Async helper functions."""
 import asyncio
 import fcntl
+import hashlib
 import logging
 import os
 import random
 import sys
+import weakref
+from typing import Dict, List
+from urllib.parse import urlsplit
 
 import aiohttp
 import async_timeout
@@ -92,6 +96,96 @@ async def semaphore_wrapper(semaphore, coro):
 
 
 # lockfile {{{1
+_lockfile_waiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, List[_LockfileWaiter]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class _LockfileWaiter:
+    """A ``lockfile`` call waiting for one of ``paths``.
+
+    Attributes:
+        paths (set): the lockfile paths we're waiting for.
+        future (asyncio.Future): done once we're woken, while we're waiting.
+            Otherwise ``None``.
+        woken_path (str): the released path we were woken for, until we try
+            to take it. Otherwise ``None``.
+
+    """
+
+    def __init__(self, paths):
+        """Initialize _LockfileWaiter."""
+        self.paths = set(paths)
+        self.future = None
+        self.woken_path = None
+
+
+def _get_lockfile_waiters():
+    """Return the running event loop's waiting ``lockfile`` calls, oldest first."""
+    return _lockfile_waiters.setdefault(asyncio.get_event_loop(), [])
+
+
+def _wake_lockfile_waiter(path):
+    """Wake the oldest ``lockfile`` call waiting for ``path``, if any."""
+    for waiter in _get_lockfile_waiters():
+        if (
+            path in waiter.paths
+            and waiter.future is not None
+            and not waiter.future.done()
+        ):
+            waiter.woken_path = path
+            waiter.future.set_result(None)
+            return
+
+
+def _get_available_lockfiles(waiter, paths):
+    """Return the ``paths`` that no older waiter is waiting for, shuffled."""
+    waiters = _get_lockfile_waiters()
+    taken = set()
+    for other in waiters[: waiters.index(waiter)]:
+        taken |= other.paths
+    available = [path for path in paths if path not in taken]
+    return random.sample(available, len(available))
+
+
+def _acquire_lockfile(paths):
+    """Create and lock the first free lockfile in ``paths``.
+
+    Returns:
+        tuple: the lockfile path and its open filehandle, or ``(None, None)``
+            if they're all taken.
+
+    """
+    for path in paths:
+        try:
+            # Ensure the file doesn't exist, so we don't blow away
+            # our own lockfiles.
+            fh = open(path, "x")
+        except (FileExistsError, OSError):
+            continue
+        try:
+            # Acquire an fcntl lock, in case other processes
+            # use something other than ``lockfile`` to acquire
+            # locks
+            fcntl.lockf(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            rm(path)
+            fh.close()
+            continue
+        return path, fh
+    return None, None
+
+
+async def _wait_for_lockfile(waiter, timeout):
+    """Wait up to ``timeout`` seconds for a lockfile ``waiter`` wants to be released."""
+    waiter.future = asyncio.get_event_loop().create_future()
+    try:
+        await asyncio.wait([waiter.future], timeout=timeout)
+    finally:
+        waiter.future.cancel()
+        waiter.future = None
+
+
 @asynccontextmanager
 async def lockfile(paths, name=None, attempts=10, sleep=30):
     """Acquire a lockfile from among ``paths`` and yield the path.
@@ -108,14 +202,18 @@ async def lockfile(paths, name=None, attempts=10, sleep=30):
 
     (See http://0pointer.de/blog/projects/locking.html for more details.)
 
+    Within a process, waiters are woken as soon as a lockfile they want is
+    released, and get lockfiles in the order they asked for them. Lockfiles
+    released by other processes are noticed after at most ``sleep`` seconds.
+
     Args:
         paths (list): a list of path strings to use as lockfiles.
         name (str, optional): a descriptive name for the process that needs
             the lockfile, for logging purposes. Defaults to ``None``.
         attempts (int, optional): the number of attempts to get a lockfile.
             This means we attempt to get a lockfile from every path in ``paths``, ``attempts`` times. Defaults to 20.
-        sleep (int, optional): the number of seconds to sleep between attempts.
-            We sleep after attempting every path in ``paths``. Defaults to 30.
+        sleep (int, optional): the most seconds to wait between attempts.
+            We wait after attempting every path in ``paths``. Defaults to 30.
 
     Yields:
         str: the lockfile path acquired.
@@ -126,37 +224,43 @@ async def lockfile(paths, name=None, attempts=10, sleep=30):
     """
     if name is not None:
         acquired_msg = "Lockfile acquired for {} at %s".format(name)
-        wait_msg = "Couldn't get lock for {}; sleeping %s".format(name)
+        wait_msg = "Couldn't get lock for {}; waiting up to %s seconds".format(name)
         failed_msg = "Can't get lock for {} from paths %s after %s attempts".format(
             name
         )
     else:
         acquired_msg = "Lockfile acquired at %s"
-        wait_msg = "Couldn't get lock; sleeping %s"
+        wait_msg = "Couldn't get lock; waiting up to %s seconds"
         failed_msg = "Can't get lock from paths %s after %s attempts"
-    for attempt in range(0, attempts):
-        for path in [item for item in random.sample(paths, len(paths))]:
-            try:
-                # Ensure the file doesn't exist, so we don't blow away
-                # our own lockfiles.
-                with open(path, "x") as fh:
-                    # Acquire an fcntl lock, in case other processes
-                    # use something other than ``lockfile`` to acquire
-                    # locks
-                    try:
-                        fcntl.lockf(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                        log.debug(acquired_msg, path)
-                        yield path
-                        # We'll clean up `path` in the `finally` block below
-                        return
-                    finally:
-                        rm(path)
-            except (FileExistsError, OSError):
-                continue
-        log.debug(wait_msg, sleep)
-        if attempt < attempts - 1:
-            await asyncio.sleep(sleep)
-    raise LockfileError(failed_msg, paths, attempts)
+    paths = list(paths)
+    waiters = _get_lockfile_waiters()
+    waiter = _LockfileWaiter(paths)
+    waiters.append(waiter)
+    path = None
+    try:
+        for attempt in range(0, attempts):
+            path, fh = _acquire_lockfile(_get_available_lockfiles(waiter, paths))
+            if path is not None:
+                break
+            # Whoever released ``woken_path`` was beaten to it by another process
+            waiter.woken_path = None
+            log.debug(wait_msg, sleep)
+            if attempt < attempts - 1:
+                await _wait_for_lockfile(waiter, sleep)
+    finally:
+        waiters.remove(waiter)
+        if waiter.woken_path not in (None, path):
+            # We were woken for a lockfile we didn't take; pass it on
+            _wake_lockfile_waiter(waiter.woken_path)
+    if path is None:
+        raise LockfileError(failed_msg, paths, attempts)
+    try:
+        log.debug(acquired_msg, path)
+        yield path
+    finally:
+        rm(path)
+        fh.close()
+        _wake_lockfile_waiter(path)
 
 
 class LockfileFuture:
@@ -335,6 +439,63 @@ async def retry_async(
             await asyncio.sleep(sleep_time)
 
 
+# client sessions {{{1
+# How many connections to keep to each host, and how long to keep them idle
+_CLIENT_LIMIT_PER_HOST = 20
+_CLIENT_KEEPALIVE_TIMEOUT = 60
+
+_client_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, aiohttp.ClientSession]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _get_base_url(url):
+    parts = urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc.rpartition("@")[2]).lower()
+
+
+def get_client_session(url):
+    """Get the pooled ``aiohttp.ClientSession`` for ``url``'s base url.
+
+    There's one session per base url (scheme, host and port) per event loop,
+    so connections are kept alive and reused across requests to the same
+    host. Sessions are recreated once closed. They don't keep cookies, so
+    nothing one request sets leaks into another that shares the session.
+
+    Args:
+        url (str): the url to request.
+
+    Returns:
+        aiohttp.ClientSession: the session for ``url``.
+
+    """
+    sessions = _client_sessions.setdefault(asyncio.get_event_loop(), {})
+    base_url = _get_base_url(url)
+    session = sessions.get(base_url)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            cookie_jar=aiohttp.DummyCookieJar(),
+            connector=aiohttp.TCPConnector(
+                limit_per_host=_CLIENT_LIMIT_PER_HOST,
+                keepalive_timeout=_CLIENT_KEEPALIVE_TIMEOUT,
+            ),
+        )
+        sessions[base_url] = session
+    return session
+
+
+async def close_client_sessions():
+    """Close the running event loop's pooled sessions.
+
+    ``sync_main`` calls this once ``async_main`` is done.
+
+    """
+    sessions = _client_sessions.pop(asyncio.get_event_loop(), {})
+    for session in sessions.values():
+        if not session.closed:
+            await session.close()
+
+
 # request {{{1
 async def request(
     url,
@@ -377,30 +538,30 @@ async def request(
 
     """
     sterilized_url = sterilized_url or url
-    async with aiohttp.ClientSession() as session:
-        async with async_timeout.timeout(timeout):
-            log.debug("{} {}".format(method.upper(), sterilized_url))
-
-            async def request_helper():
-                async with session.request(method, url, **kwargs) as resp:
-                    log.debug("Status {}".format(resp.status))
-                    message = "Bad status {}".format(resp.status)
-                    if resp.status in retry_statuses:
-                        raise RetryError(message)
-                    if resp.status not in good:
-                        raise TaskError(message)
-                    if return_type == "text":
-                        return await resp.text()
-                    elif return_type == "json":
-                        return await resp.json()
-                    else:
-                        return resp
-
-            return await retry_async(
-                request_helper,
-                attempts=num_attempts,
-                retry_exceptions=(asyncio.TimeoutError, RetryError),
-            )
+    session = get_client_session(url)
+    async with async_timeout.timeout(timeout):
+        log.debug("{} {}".format(method.upper(), sterilized_url))
+
+        async def request_helper():
+            async with session.request(method, url, **kwargs) as resp:
+                log.debug("Status {}".format(resp.status))
+                message = "Bad status {}".format(resp.status)
+                if resp.status in retry_statuses:
+                    raise RetryError(message)
+                if resp.status not in good:
+                    raise TaskError(message)
+                if return_type == "text":
+                    return await resp.text()
+                elif return_type == "json":
+                    return await resp.json()
+                else:
+                    return resp
+
+        return await retry_async(
+            request_helper,
+            attempts=num_attempts,
+            retry_exceptions=(asyncio.TimeoutError, RetryError),
+        )
 
 
 # download_file {{{1
@@ -417,7 +578,263 @@ async def _log_download_error(resp, log_url, msg):
         )
 
 
-async def download_file(url, abs_filename, log_url=None, chunk_size=128, timeout=300):
+# Reads from the response start this big, and double while they come back full
+_DOWNLOAD_MIN_READ_SIZE = 64 * 1024
+# Network errors a download can resume after
+_DOWNLOAD_RESUME_ERRORS = (
+    aiohttp.ClientPayloadError,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+class _DownloadSegment:
+    """A byte range of a download, and how far it's got.
+
+    Attributes:
+        start (int): the first byte of the range.
+        end (int): the byte after the range, or None for the rest of the file.
+        offset (int): the next byte to write.
+        hasher (hashlib hash): if not None, updated with every byte written,
+            in order.
+
+    """
+
+    def __init__(self, start, end=None, hasher=None):
+        """Initialize _DownloadSegment."""
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.hasher = hasher
+
+    def restart(self):
+        """Start the range over."""
+        self.offset = self.start
+        if self.hasher is not None:
+            self.hasher = hashlib.new(self.hasher.name)
+
+    def get_range_header(self):
+        """Return the Range header for the rest of the range, or None for the whole file."""
+        if self.offset == 0 and self.end is None:
+            return None
+        return "bytes={}-{}".format(
+            self.offset, "" if self.end is None else self.end - 1
+        )
+
+
+async def _check_download_response(resp, log_url, good=(200,)):
+    if resp.status == 404:
+        await _log_download_error(
+            resp, log_url, "404 downloading %(url)s: %(status)s; body=%(body)s"
+        )
+        raise Download404("{} status {}!".format(log_url, resp.status))
+    elif resp.status not in good:
+        await _log_download_error(
+            resp,
+            log_url,
+            "Failed to download %(url)s: %(status)s; body=%(body)s",
+        )
+        raise DownloadError(
+            "{} status {} is not {}!".format(
+                log_url, resp.status, " or ".join(str(status) for status in good)
+            )
+        )
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+async def _write_response(resp, fd, segment, chunk_size):
+    """Stream the body of ``resp`` into ``fd``, at ``segment.offset``.
+
+    Reads grow from ``_DOWNLOAD_MIN_READ_SIZE`` to ``chunk_size`` while the
+    response keeps up, and are written in the default executor while the
+    next read happens. Whatever was read before an error is still written,
+    so ``segment.offset`` is where to resume.
+
+    """
+    loop = asyncio.get_event_loop()
+    read_size = min(_DOWNLOAD_MIN_READ_SIZE, chunk_size)
+    buf = bytearray()
+    pending = None
+
+    async def flush():
+        nonlocal pending
+        if pending is not None:
+            await pending
+            pending = None
+        if buf:
+            data = bytes(buf)
+            buf.clear()
+            pending = loop.run_in_executor(None, _pwrite_all, fd, data, segment.offset)
+            if segment.hasher is not None:
+                segment.hasher.update(data)
+            segment.offset += len(data)
+
+    try:
+        while True:
+            chunk = await resp.content.read(read_size)
+            if not chunk:
+                break
+            buf += chunk
+            if len(chunk) == read_size:
+                read_size = min(read_size * 2, chunk_size)
+            if len(buf) >= read_size:
+                await flush()
+    finally:
+        # Write what's left, then wait for that write
+        await flush()
+        await flush()
+
+
+async def _download_segment(
+    session, url, log_url, fd, segment, chunk_size, timeout, resume_attempts
+):
+    """Download one segment of a file, resuming after network errors.
+
+    Resuming uses a Range request, if the server supports them, and the
+    response isn't content-encoded. Otherwise the segment starts over.
+
+    Raises:
+        Download404: on a 404.
+        DownloadError: on any other bad status, or running out of resume
+            attempts.
+
+    """
+    attempt = 0
+    while True:
+        range_header = segment.get_range_header()
+        headers = {"Range": range_header} if range_header else {}
+        resumable = False
+        try:
+            async with session.get(
+                url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as resp:
+                if range_header and resp.status == 200 and segment.end is None:
+                    # The server ignored the Range header; start the whole file over
+                    log.warning("%s doesn't support ranges; restarting", log_url)
+                    segment.restart()
+                else:
+                    await _check_download_response(
+                        resp, log_url, good=(206,) if range_header else (200,)
+                    )
+                resumable = resp.headers.get(
+                    "Accept-Ranges"
+                ) == "bytes" and resp.headers.get("Content-Encoding", "identity") in (
+                    "identity",
+                    "",
+                )
+                await _write_response(resp, fd, segment, chunk_size)
+            if segment.end is not None and segment.offset != segment.end:
+                raise aiohttp.ClientPayloadError(
+                    "Got {} of {} bytes".format(
+                        segment.offset - segment.start, segment.end - segment.start
+                    )
+                )
+            return
+        except _DOWNLOAD_RESUME_ERRORS as e:
+            attempt += 1
+            if attempt > resume_attempts:
+                raise DownloadError(
+                    "Failed to download {}: {}".format(log_url, e)
+                ) from e
+            if not resumable:
+                if segment.end is not None:
+                    raise DownloadError(
+                        "Failed to download {}: {}".format(log_url, e)
+                    ) from e
+                segment.restart()
+            log.warning(
+                "Error downloading %s at byte %s; retrying: %s",
+                log_url,
+                segment.offset,
+                e,
+            )
+
+
+async def _get_segmented_size(session, url, timeout):
+    """Return the size of ``url``, if it can be downloaded in Range segments.
+
+    Returns:
+        int: the size in bytes, or None if the server doesn't support ranges,
+            or would content-encode the response.
+
+    """
+    try:
+        async with session.head(
+            url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as resp:
+            if (
+                resp.status != 200
+                or resp.headers.get("Accept-Ranges") != "bytes"
+                or resp.headers.get("Content-Encoding", "identity")
+                not in ("identity", "")
+            ):
+                return None
+            return int(resp.headers.get("Content-Length", 0)) or None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        log.debug("Can't download %s in segments: %s", url, e)
+        return None
+
+
+async def _download_segments(
+    session, url, log_url, abs_filename, size, segments, **kwargs
+):
+    """Download ``segments`` of ``url`` concurrently into ``abs_filename``.
+
+    The first failure cancels the rest.
+
+    """
+    fd = os.open(abs_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if size is not None:
+            os.ftruncate(fd, size)
+        futures = [
+            asyncio.ensure_future(
+                _download_segment(session, url, log_url, fd, segment, **kwargs)
+            )
+            for segment in segments
+        ]
+        try:
+            await asyncio.wait(futures, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for future in futures:
+                future.cancel()
+            # Let cancelled segments finish their writes before closing
+            await asyncio.gather(*futures, return_exceptions=True)
+        for future in futures:
+            if not future.cancelled() and future.exception():
+                raise future.exception()
+    finally:
+        os.close(fd)
+
+
+def _hash_file(path, algorithm):
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(4 * 1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+async def download_file(
+    url,
+    abs_filename,
+    log_url=None,
+    chunk_size=4 * 1024 * 1024,
+    timeout=300,
+    session=None,
+    segments=1,
+    segment_threshold=64 * 1024 * 1024,
+    digest=None,
+    digest_algorithm="sha256",
+    resume_attempts=3,
+):
     """Download a file, async.
 
     Args:
@@ -425,36 +842,77 @@ async def download_file(url, abs_filename, log_url=None, chunk_size=128, timeout
         abs_filename (str): the path to download to
         log_url (str, optional): the url to log, should ``url`` contain sensitive information.
             If ``None``, use ``url``. Defaults to ``None``
-        chunk_size (int, optional): the chunk size to read from the response
-            at a time. Default is 128.
-        timeout (int, optional): seconds to time out the request. Default is 300.
+        chunk_size (int, optional): the most bytes to read from the response
+            at a time. Reads start at 64 KiB, and grow while the response keeps
+            up. Default is 4 MiB.
+        timeout (int, optional): seconds to time out each request. Default is 300.
+        session (aiohttp.ClientSession, optional): the session to download with.
+            If ``None``, use ``get_client_session(url)``, which
+            ``client.sync_main`` closes once ``async_main`` is done. Defaults
+            to ``None``.
+        segments (int, optional): if more than 1, download files of at least
+            ``segment_threshold`` bytes in this many concurrent Range requests,
+            if the server supports them. Default is 1.
+        segment_threshold (int, optional): the smallest file to download in
+            segments. Default is 64 MiB.
+        digest (str, optional): if set, the expected hex digest of the file.
+            Defaults to ``None``.
+        digest_algorithm (str, optional): the ``hashlib`` algorithm ``digest``
+            uses. Default is sha256.
+        resume_attempts (int, optional): how many times to resume after network
+            errors, per segment. Default is 3.
+
+    Raises:
+        Download404: on a 404.
+        DownloadError: on any other bad status, too many network errors, or a
+            digest mismatch. ``abs_filename`` is removed.
 
     """
-    aiohttp_timeout = aiohttp.ClientTimeout(total=timeout)
-    async with aiohttp.ClientSession(timeout=aiohttp_timeout) as session:
-        log_url = log_url or url
-        log.info("Downloading %s", log_url)
-        parent_dir = os.path.dirname(abs_filename)
-        async with session.get(url) as resp:
-            if resp.status == 404:
-                await _log_download_error(
-                    resp, log_url, "404 downloading %(url)s: %(status)s; body=%(body)s"
-                )
-                raise Download404("{} status {}!".format(log_url, resp.status))
-            elif resp.status != 200:
-                await _log_download_error(
-                    resp,
-                    log_url,
-                    "Failed to download %(url)s: %(status)s; body=%(body)s",
+    session = session or get_client_session(url)
+    log_url = log_url or url
+    log.info("Downloading %s", log_url)
+    size = None
+    if segments > 1:
+        size = await _get_segmented_size(session, url, timeout)
+        if size is not None and size < segment_threshold:
+            size = None
+    if size is None:
+        hasher = hashlib.new(digest_algorithm) if digest else None
+        download_segments = [_DownloadSegment(0, hasher=hasher)]
+    else:
+        segment_size = -(-size // segments)
+        download_segments = [
+            _DownloadSegment(start, min(start + segment_size, size))
+            for start in range(0, size, segment_size)
+        ]
+        log.debug("Downloading %s in %s segments", log_url, len(download_segments))
+    makedirs(os.path.dirname(abs_filename))
+    try:
+        await _download_segments(
+            session,
+            url,
+            log_url,
+            abs_filename,
+            size,
+            download_segments,
+            chunk_size=chunk_size,
+            timeout=timeout,
+            resume_attempts=resume_attempts,
+        )
+        if digest:
+            if size is None:
+                actual = download_segments[0].hasher.hexdigest()
+            else:
+                actual = await asyncio.get_event_loop().run_in_executor(
+                    None, _hash_file, abs_filename, digest_algorithm
                 )
+            if actual != digest:
                 raise DownloadError(
-                    "{} status {} is not 200!".format(log_url, resp.status)
+                    "{} {} digest {} doesn't match {}!".format(
+                        log_url, digest_algorithm, actual, digest
+                    )
                 )
-            makedirs(parent_dir)
-            with open(abs_filename, "wb") as fd:
-                while True:
-                    chunk = await resp.content.read(chunk_size)
-                    if not chunk:
-                        break
-                    fd.write(chunk)
-        log.info("Done")
+    except BaseException:
+        rm(abs_filename)
+        raise
+    log.info("Done")
@@ -13,8 +13,9 @@ import sys
 import jsonschema
 from immutabledict import immutabledict
 
+from scriptworker_client.aio import close_client_sessions
 from scriptworker_client.exceptions import ClientError, TaskVerificationError
-from scriptworker_client.utils import load_json_or_yaml
+from scriptworker_client.utils import get_command_pool, load_json_or_yaml
 
 log = logging.getLogger(__name__)
 
@@ -104,6 +105,8 @@ def sync_main(
         * the path to the config file is either taken from `config_path` or from `sys.argv[1]`.
         * it verifies `sys.argv` doesn't have more arguments than the config path.
         * it creates the asyncio event loop so that `async_main` can run
+        * it logs the command pool summary, and closes the pooled HTTP sessions,
+          once `async_main` is done
 
     Args:
         async_main (function): The function to call once everything is set up
@@ -183,3 +186,8 @@ async def _handle_asyncio_loop(async_main, config, task):
     except ClientError as exc:
         log.exception("Failed to run async_main")
         sys.exit(exc.exit_code)
+    finally:
+        command_pool = get_command_pool(create=False)
+        if command_pool is not None:
+            command_pool.log_summary()
+        await close_client_sessions()
@@ -7,16 +7,21 @@ Attributes:
 """
 import asyncio
 import functools
+import heapq
+import itertools
 import json
 import logging
 import os
 import random
 import shutil
 import tempfile
+import time
+import weakref
 import yaml
 
 from asyncio.subprocess import PIPE
-from contextlib import contextmanager
+from collections import deque
+from contextlib import ExitStack, contextmanager
 from typing import (
     Any,
     Awaitable,
@@ -146,26 +151,171 @@ async def pipe_to_log(pipe, filehandles=(), level=logging.INFO):
             break
 
 
+# OutputTail {{{1
+class OutputTail:
+    """Keep the last ``max_size`` bytes or so of command output.
+
+    Output is kept as a ring buffer of chunks, dropping the oldest chunks
+    once there's more than ``max_size`` bytes.
+
+    Attributes:
+        max_size (int): how many bytes to keep.
+        chunks (collections.deque): the kept chunks, oldest first.
+        size (int): the total size of ``chunks``.
+
+    """
+
+    def __init__(self, max_size=64 * 1024):
+        """Initialize OutputTail."""
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+
+    def append(self, chunk):
+        """Add a chunk of output, dropping the oldest chunks if needed."""
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        while self.size - len(self.chunks[0]) >= self.max_size:
+            self.size -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        """Return the last ``max_size`` bytes of output, decoded.
+
+        If output was dropped, this starts at the first whole line, if any.
+
+        """
+        data = b"".join(self.chunks)
+        start = max(len(data) - self.max_size, 0)
+        newline = data.find(b"\n", start, len(data) - 1)
+        if start and newline >= 0:
+            start = newline + 1
+        return data[start:].decode("utf-8", "replace")
+
+
+# pipe_to_log_chunked {{{1
+async def pipe_to_log_chunked(
+    pipe, filehandles=(), level=logging.INFO, tail=None, chunk_size=64 * 1024
+):
+    """Log from a subprocess PIPE, a chunk at a time.
+
+    This is a faster ``pipe_to_log`` for chatty commands. Output is read
+    ``chunk_size`` bytes at a time, and written to ``filehandles`` as bytes,
+    whole lines at a time. Lines are only split and decoded if ``log`` is
+    enabled for ``level``.
+
+    Args:
+        pipe (filehandle): subprocess process STDOUT or STDERR
+        filehandles (list of filehandles, optional): the binary filehandle(s)
+            to write to.  If empty, don't write to a separate file.  Defaults to ().
+        level (int, optional): the level to log to.  Defaults to ``logging.INFO``.
+        tail (OutputTail, optional): if not ``None``, keep the end of the
+            output here.  Defaults to ``None``.
+        chunk_size (int, optional): the most bytes to read at a time.
+            Defaults to 64 KiB.
+
+    """
+    should_log = log.isEnabledFor(level)
+    partial = bytearray()
+    while True:
+        chunk = await pipe.read(chunk_size)
+        if chunk:
+            end = chunk.rfind(b"\n") + 1
+            if not end:
+                partial += chunk
+                continue
+            lines = bytes(partial) + chunk[:end]
+            partial = bytearray(chunk[end:])
+        elif partial:
+            lines = bytes(partial) + b"\n"
+            partial.clear()
+        else:
+            break
+        for filehandle in filehandles:
+            filehandle.write(lines)
+        if tail is not None:
+            tail.append(lines)
+        if should_log:
+            for line in lines[:-1].split(b"\n"):
+                log.log(level, to_unicode(line).rstrip())
+
+
 # get_log_filehandle {{{1
 @contextmanager
-def get_log_filehandle(log_path=None):
+def get_log_filehandle(log_path=None, binary=False):
     """Open a log filehandle.
 
     Args:
         log_path (str, optional): the path to log to. If ``None``, create
             a temp file to log to, and delete once we exit the context.
             Defaults to ``None``.
+        binary (bool, optional): open the log in binary mode. Defaults to
+            ``False``.
 
     """
+    mode = "w+b" if binary else "w+"
     if log_path is not None:
-        with open(log_path, "w+") as log_filehandle:
+        with open(log_path, mode) as log_filehandle:
             yield log_filehandle
     else:
-        with tempfile.TemporaryFile(mode="w+") as log_filehandle:
+        with tempfile.TemporaryFile(mode=mode) as log_filehandle:
             yield log_filehandle
 
 
 # run_command {{{1
+async def _capture_output_lines(proc, log_path, log_level, keep_output):
+    """Log ``proc``'s output with ``pipe_to_log``, and wait for it to exit.
+
+    Returns:
+        tuple: the exit code, and the logged output if ``keep_output``.
+
+    """
+    with get_log_filehandle(log_path=log_path) as log_filehandle:
+        await raise_future_exceptions(
+            [
+                asyncio.ensure_future(
+                    pipe_to_log(pipe, filehandles=[log_filehandle], level=log_level)
+                )
+                for pipe in (proc.stderr, proc.stdout)
+            ]
+        )
+        exitcode = await proc.wait()
+        log_contents = ""
+        if keep_output:
+            log_filehandle.seek(0)
+            log_contents = log_filehandle.read()
+    return exitcode, log_contents
+
+
+async def _capture_output_chunked(proc, log_path, log_level, keep_output):
+    """Log ``proc``'s output with ``pipe_to_log_chunked``, and wait for it to exit.
+
+    Without ``log_path``, output isn't written to a file at all.
+
+    Returns:
+        tuple: the exit code, and the tail of the output if ``keep_output``.
+
+    """
+    tail = OutputTail() if keep_output else None
+    with ExitStack() as stack:
+        filehandles = []
+        if log_path is not None:
+            filehandles.append(
+                stack.enter_context(get_log_filehandle(log_path=log_path, binary=True))
+            )
+        await raise_future_exceptions(
+            [
+                asyncio.ensure_future(
+                    pipe_to_log_chunked(
+                        pipe, filehandles=filehandles, level=log_level, tail=tail
+                    )
+                )
+                for pipe in (proc.stderr, proc.stdout)
+            ]
+        )
+    exitcode = await proc.wait()
+    return exitcode, tail.getvalue() if tail is not None else ""
+
+
 async def run_command(
     cmd,
     log_path=None,
@@ -176,6 +326,7 @@ async def run_command(
     exception=None,
     expected_exit_codes=(0,),
     output_log_on_exception=False,
+    chunked_output=True,
 ):
     """Run a command using ``asyncio.create_subprocess_exec``.
 
@@ -206,7 +357,11 @@ async def run_command(
             a successful run. Only used if ``exception`` is not ``None``.
             Defaults to ``(0, )``.
         output_log_on_exception (bool, optional): log the output log if we're
-            raising an exception.
+            raising an exception. With ``chunked_output``, only the last
+            64 KiB or so of output is included.
+        chunked_output (bool, optional): capture output with
+            ``pipe_to_log_chunked`` rather than ``pipe_to_log``, a line at a
+            time. Defaults to ``True``.
 
     Returns:
         int: the exit code of the command
@@ -227,24 +382,12 @@ async def run_command(
     if env is not None:
         kwargs["env"] = env
     proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
-    with get_log_filehandle(log_path=log_path) as log_filehandle:
-        stderr_future = asyncio.ensure_future(
-            pipe_to_log(proc.stderr, filehandles=[log_filehandle], level=log_level)
-        )
-        stdout_future = asyncio.ensure_future(
-            pipe_to_log(proc.stdout, filehandles=[log_filehandle], level=log_level)
-        )
-        _, pending = await asyncio.wait([stderr_future, stdout_future])
-        exitcode = await proc.wait()
-        await asyncio.wait([stdout_future, stderr_future])
-        if exception and exitcode not in expected_exit_codes:
-            log_contents = ""
-            if output_log_on_exception:
-                log_filehandle.seek(0)
-                log_contents = log_filehandle.read()
-            raise exception(
-                "%s in %s exited %s!\n%s", log_cmd, cwd, exitcode, log_contents
-            )
+    capture = _capture_output_chunked if chunked_output else _capture_output_lines
+    exitcode, log_contents = await capture(
+        proc, log_path, log_level, output_log_on_exception
+    )
+    if exception and exitcode not in expected_exit_codes:
+        raise exception("%s in %s exited %s!\n%s", log_cmd, cwd, exitcode, log_contents)
     log.info("%s in %s exited %d", log_cmd, cwd, exitcode)
     return exitcode
 
@@ -564,3 +707,231 @@ def get_single_item_from_sequence(
     if append_sequence_to_error_message:
         error_message = "{}. Given: {}".format(error_message, sequence)
     raise ErrorClass(error_message)
+
+
+# CommandPool {{{1
+def get_default_command_limits():
+    """Get the default number of concurrent commands for each io class.
+
+    ``cpu`` commands are limited to the number of CPUs. ``disk`` commands,
+    like ``tar``, ``unzip`` or ``zip``, to at most 4 so they don't thrash the
+    disk. ``network`` commands mostly wait, so more of them can run at once.
+
+    Returns:
+        dict: the limit for each io class.
+
+    """
+    cpu_count = os.cpu_count() or 1
+    return {"cpu": cpu_count, "disk": min(cpu_count, 4), "network": cpu_count * 4}
+
+
+class CommandStats:
+    """Timing stats for a command run through a ``CommandPool``.
+
+    Attributes:
+        cmd (list): the command, or ``log_cmd`` if set.
+        io_class (str): the io class the command ran in.
+        priority (int): the command priority.
+        attempts (int): how many times the command was run.
+        wait_time (float): the seconds spent waiting for a free slot.
+        run_time (float): the seconds spent running.
+        exitcode (int): the exit code of the last attempt, or ``None`` if it
+            didn't finish.
+
+    """
+
+    def __init__(self, cmd, io_class, priority):
+        """Initialize CommandStats."""
+        self.cmd = cmd
+        self.io_class = io_class
+        self.priority = priority
+        self.attempts = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.exitcode = None
+
+
+class CommandPool:
+    """Run commands with ``run_command``, a limited number at a time.
+
+    Each command runs in an io class, which limits how many of its commands
+    run at once. Waiting commands start in ``priority`` order, lowest first,
+    then in the order they were queued.
+
+    Attributes:
+        limits (dict): the maximum concurrent commands for each io class.
+        running (dict): the number of running commands for each io class.
+        stats (list): a ``CommandStats`` for each command run.
+
+    """
+
+    def __init__(self, limits=None):
+        """Initialize CommandPool.
+
+        Args:
+            limits (dict, optional): override the limits from
+                ``get_default_command_limits``, or add io classes. Defaults
+                to ``None``.
+
+        """
+        self.limits = get_default_command_limits()
+        self.limits.update(limits or {})
+        self.running = {io_class: 0 for io_class in self.limits}
+        self.stats = []
+        self._waiting = {io_class: [] for io_class in self.limits}
+        self._counter = itertools.count()
+
+    async def _acquire(self, io_class, priority):
+        if self.running[io_class] < self.limits[io_class]:
+            self.running[io_class] += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting[io_class], (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed a slot, but won't use it
+                self._release(io_class)
+            raise
+
+    def _release(self, io_class):
+        """Hand our slot to the next waiting command, if any."""
+        waiting = self._waiting[io_class]
+        while waiting:
+            _, _, future = heapq.heappop(waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running[io_class] -= 1
+
+    async def _run_once(self, stats, cmd, **kwargs):
+        queued = time.monotonic()
+        await self._acquire(stats.io_class, stats.priority)
+        started = time.monotonic()
+        stats.wait_time += started - queued
+        stats.attempts += 1
+        try:
+            stats.exitcode = await run_command(cmd, **kwargs)
+            return stats.exitcode
+        finally:
+            stats.run_time += time.monotonic() - started
+            self._release(stats.io_class)
+
+    async def run(
+        self,
+        cmd,
+        io_class="cpu",
+        priority=0,
+        attempts=1,
+        retry_exceptions=Exception,
+        sleeptime_kwargs=None,
+        **kwargs,
+    ):
+        """Run ``cmd`` with ``run_command`` once there's a free slot.
+
+        Retries give up their slot while sleeping.
+
+        Args:
+            cmd (list): the command to run.
+            io_class (str, optional): the io class to run the command in.
+                Defaults to ``cpu``.
+            priority (int, optional): the command priority; lower runs
+                first. Defaults to 0.
+            attempts (int, optional): the number of attempts to make.
+                Defaults to 1.
+            retry_exceptions (list or exception, optional): the exception(s)
+                to retry on. Defaults to ``Exception``.
+            sleeptime_kwargs (dict, optional): the kwargs to pass to
+                ``calculate_sleep_time`` between attempts. Defaults to ``None``.
+            **kwargs: the kwargs to pass to ``run_command``.
+
+        Raises:
+            ValueError: on an unknown ``io_class``.
+            Exception: the exception from the last failed ``run_command``.
+
+        Returns:
+            int: the exit code of the command
+
+        """
+        if io_class not in self.limits:
+            raise ValueError("Unknown io_class {}!".format(io_class))
+        stats = CommandStats(kwargs.get("log_cmd") or cmd, io_class, priority)
+        self.stats.append(stats)
+        return await retry_async(
+            self._run_once,
+            attempts=attempts,
+            retry_exceptions=retry_exceptions,
+            args=(stats, cmd),
+            kwargs=kwargs,
+            sleeptime_kwargs=sleeptime_kwargs,
+        )
+
+    def get_summary(self):
+        """Summarize ``stats`` by io class.
+
+        Returns:
+            dict: for each io class used, the number of ``commands`` and
+                ``attempts``, and the total ``wait_time``, ``run_time`` and
+                ``max_wait_time`` in seconds.
+
+        """
+        summary = {}
+        for stats in self.stats:
+            io_summary = summary.setdefault(
+                stats.io_class,
+                {
+                    "commands": 0,
+                    "attempts": 0,
+                    "wait_time": 0.0,
+                    "run_time": 0.0,
+                    "max_wait_time": 0.0,
+                },
+            )
+            io_summary["commands"] += 1
+            io_summary["attempts"] += stats.attempts
+            io_summary["wait_time"] += stats.wait_time
+            io_summary["run_time"] += stats.run_time
+            io_summary["max_wait_time"] = max(
+                io_summary["max_wait_time"], stats.wait_time
+            )
+        return summary
+
+    def log_summary(self, level=logging.INFO):
+        """Log ``get_summary``, one line per io class."""
+        for io_class, io_summary in sorted(self.get_summary().items()):
+            log.log(
+                level,
+                "%s commands: %d in %d attempts; %.1fs running, %.1fs waiting (max %.1fs)",
+                io_class,
+                io_summary["commands"],
+                io_summary["attempts"],
+                io_summary["run_time"],
+                io_summary["wait_time"],
+                io_summary["max_wait_time"],
+            )
+
+
+_command_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, CommandPool]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_command_pool(create=True):
+    """Get the ``CommandPool`` shared by everything on this event loop.
+
+    Args:
+        create (bool, optional): create the pool if there isn't one yet.
+            Defaults to ``True``.
+
+    Returns:
+        CommandPool: the shared pool, or ``None`` if there isn't one and
+            ``create`` is ``False``.
+
+    """
+    loop = asyncio.get_event_loop()
+    if loop not in _command_pools:
+        if not create:
+            return None
+        _command_pools[loop] = CommandPool()
+    return _command_pools[loop]
@@ -3,6 +3,7 @@
 """Test scriptworker_client.aio
 """
 import asyncio
+import hashlib
 import os
 import re
 import shutil
@@ -13,8 +14,11 @@ from datetime import datetime
 import aiohttp
 import mock
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 import scriptworker_client.aio as aio
+import scriptworker_client.client as client
 from scriptworker_client.exceptions import (
     Download404,
     DownloadError,
@@ -94,12 +98,6 @@ class FakeSession:
             yield resp
 
 
-@asynccontextmanager
-async def GetFakeSession(*args, **kwargs):
-    """Helper class to replace ``aiohttp.ClientSession()``"""
-    yield FakeSession()
-
-
 async def noop_async(*args, **kwargs):
     """Noop coroutine."""
 
@@ -169,10 +167,10 @@ async def test_lockfile(tmpdir, mocker, attempts, has_slept, use_name):
     paths = [os.path.join(tmpdir, "1"), os.path.join(tmpdir, "2")]
     sleep_calls = []
 
-    async def fake_sleep(*args):
+    async def fake_wait(*args):
         sleep_calls.append(args)
 
-    mocker.patch.object(asyncio, "sleep", new=fake_sleep)
+    mocker.patch.object(aio, "_wait_for_lockfile", new=fake_wait)
 
     name = "one" if use_name else None
     async with aio.lockfile(paths, name=name, attempts=attempts, sleep=0) as path1:
@@ -198,6 +196,72 @@ async def test_lockfile(tmpdir, mocker, attempts, has_slept, use_name):
         assert len(sleep_calls) == 0
 
 
+@pytest.mark.asyncio
+async def test_lockfile_wakes_waiter(tmpdir):
+    """Waiters get a lockfile as soon as it's released, not after ``sleep``."""
+    paths = [os.path.join(tmpdir, "1")]
+
+    async def hold():
+        async with aio.lockfile(paths, sleep=30):
+            await asyncio.sleep(0.05)
+
+    holder = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    start = time.time()
+    async with aio.lockfile(paths, sleep=30, attempts=2) as path:
+        assert path == paths[0]
+    assert time.time() - start < 5
+    await holder
+    assert aio._get_lockfile_waiters() == []
+
+
+@pytest.mark.asyncio
+async def test_lockfile_fifo(tmpdir):
+    """Waiters get lockfiles in the order they asked for them, but don't
+    wait behind waiters for other lockfiles.
+
+    """
+    paths = [os.path.join(tmpdir, "1"), os.path.join(tmpdir, "2")]
+    order = []
+
+    async def hold(name, paths, hold_time=0.01):
+        async with aio.lockfile(paths, sleep=30, attempts=3) as path:
+            order.append((name, path))
+            await asyncio.sleep(hold_time)
+
+    futures = [asyncio.ensure_future(hold("holder", paths[:1], 0.05))]
+    for name in ("a", "b", "c"):
+        await asyncio.sleep(0)
+        futures.append(asyncio.ensure_future(hold(name, paths[:1])))
+    await asyncio.sleep(0)
+    async with aio.lockfile(paths, sleep=30, attempts=1) as path:
+        assert path == paths[1]
+    await aio.raise_future_exceptions(futures)
+    assert order == [(name, paths[0]) for name in ("holder", "a", "b", "c")]
+
+
+@pytest.mark.asyncio
+async def test_lockfile_cancelled_waiter(tmpdir):
+    """A waiter that's cancelled after being woken passes the lockfile on."""
+    paths = [os.path.join(tmpdir, "1")]
+    acquired = []
+
+    async def wait_for(name):
+        async with aio.lockfile(paths, sleep=30, attempts=2):
+            acquired.append(name)
+
+    async with aio.lockfile(paths):
+        first = asyncio.ensure_future(wait_for("first"))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(wait_for("second"))
+        await asyncio.sleep(0)
+    # "first" is woken, but cancelled before it runs
+    first.cancel()
+    await asyncio.wait_for(second, 5)
+    assert acquired == ["second"]
+    assert first.cancelled()
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("use_retry_async", (True, False))
 async def test_LockfileFuture(tmpdir, use_retry_async):
@@ -345,6 +409,38 @@ async def test_retry_async_always_fail():
     assert retry_count["always_fail"] == 5
 
 
+# client sessions {{{1
+@pytest.mark.asyncio
+async def test_client_sessions():
+    """There's one pooled session per base url and event loop, recreated once
+    closed.
+
+    """
+    session = aio.get_client_session("https://user:pw@Example.com/foo?bar")
+    assert aio.get_client_session("https://example.com/baz") is session
+    assert aio.get_client_session("https://example.com:8443/") is not session
+    assert aio.get_client_session("http://example.com/") is not session
+    assert isinstance(session.cookie_jar, aiohttp.DummyCookieJar)
+    await aio.close_client_sessions()
+    assert session.closed
+    new_session = aio.get_client_session("https://example.com/")
+    assert new_session is not session
+    await aio.close_client_sessions()
+    await aio.close_client_sessions()
+
+
+@pytest.mark.asyncio
+async def test_request_reuses_connections(tmpdir, download_server):
+    """Requests to the same host share a connection."""
+    url = str(download_server.make_url("/data"))
+    await aio.download_file(url, os.path.join(tmpdir, "foo"))
+    await aio.request(url, method="head")
+    await aio.download_file(url, os.path.join(tmpdir, "foo"))
+    peers = download_server.app["state"]["peers"]
+    assert len(peers) == 3
+    assert len(set(peers)) == 1
+
+
 # request {{{1
 @pytest.mark.parametrize(
     "url,method,return_type,expected,exception,num_attempts",
@@ -362,7 +458,7 @@ async def test_request(
     mocker, url, method, return_type, expected, exception, num_attempts
 ):
     """A request returns the expected value, or raises ``exception`` if not ``None``."""
-    mocker.patch.object(aiohttp, "ClientSession", new=GetFakeSession)
+    mocker.patch.object(aio, "get_client_session", return_value=FakeSession())
     mocker.patch.object(asyncio, "sleep", new=noop_async)
 
     if not exception:
@@ -381,23 +477,206 @@ async def test_request(
 
 
 # download_file {{{1
+DOWNLOAD_DATA = os.urandom(300 * 1024)
+DOWNLOAD_SHA256 = hashlib.sha256(DOWNLOAD_DATA).hexdigest()
+
+
+async def _download_handler(request):
+    """Serve ``DOWNLOAD_DATA``, honoring ``Range`` if ``state["ranges"]``.
+
+    While ``state["failures"]`` is positive, drop the connection halfway
+    through the response.
+
+    """
+    state = request.app["state"]
+    state["requests"].append((request.method, request.headers.get("Range")))
+    state["peers"].append(request.transport.get_extra_info("peername"))
+    start, end, status = 0, len(DOWNLOAD_DATA), 200
+    headers = {}
+    if state["ranges"]:
+        headers["Accept-Ranges"] = "bytes"
+        m = re.match(r"bytes=(\d+)-(\d*)$", request.headers.get("Range", ""))
+        if m:
+            start, status = int(m.group(1)), 206
+            if m.group(2):
+                end = int(m.group(2)) + 1
+    data = DOWNLOAD_DATA[start:end]
+    headers["Content-Length"] = str(len(data))
+    resp = web.StreamResponse(status=status, headers=headers)
+    await resp.prepare(request)
+    if request.method == "HEAD":
+        return resp
+    if state["failures"] > 0:
+        state["failures"] -= 1
+        await resp.write(data[: len(data) // 2])
+        request.transport.close()
+        return resp
+    await resp.write(data)
+    await resp.write_eof()
+    return resp
+
+
+@pytest.fixture
+async def download_server(tmpdir):
+    path = os.path.join(tmpdir, "served")
+    with open(path, "wb") as fh:
+        fh.write(DOWNLOAD_DATA)
+
+    async def file_handler(request):
+        return web.FileResponse(path)
+
+    async def status_handler(request):
+        return web.Response(status=int(request.match_info["status"]), text="bad")
+
+    app = web.Application()
+    app["state"] = {"failures": 0, "ranges": True, "requests": [], "peers": []}
+    app.router.add_get("/data", _download_handler)
+    app.router.add_get("/file", file_handler)
+    app.router.add_get("/status/{status}", status_handler)
+    server = TestServer(app)
+    await server.start_server()
+    yield server
+    await aio.close_client_sessions()
+    await server.close()
+
+
+@pytest.mark.parametrize("segments", (1, 4))
+@pytest.mark.parametrize("route", ("/data", "/file"))
+@pytest.mark.asyncio
+async def test_download_file(tmpdir, download_server, route, segments):
+    path = os.path.join(tmpdir, "sub", "foo")
+    await aio.download_file(
+        str(download_server.make_url(route)),
+        path,
+        chunk_size=100 * 1024,
+        segments=segments,
+        segment_threshold=1024,
+        digest=DOWNLOAD_SHA256,
+    )
+    with open(path, "rb") as fh:
+        assert fh.read() == DOWNLOAD_DATA
+
+
+@pytest.mark.asyncio
+async def test_download_file_session_closed_by_sync_main(tmpdir, download_server):
+    """The session ``download_file`` defaults to is closed once ``async_main`` is done."""
+    url = str(download_server.make_url("/data"))
+    sessions = []
+
+    async def async_main(*args):
+        await aio.download_file(
+            url, os.path.join(tmpdir, "foo"), segments=2, segment_threshold=1024
+        )
+        sessions.append(aio.get_client_session(url))
+        assert not sessions[0].closed
+
+    await client._handle_asyncio_loop(async_main, {}, {})
+    assert sessions[0].closed
+
+
+@pytest.mark.asyncio
+async def test_download_file_segments(tmpdir, download_server):
+    """Big enough files are downloaded in concurrent Range requests."""
+    path = os.path.join(tmpdir, "foo")
+    url = str(download_server.make_url("/data"))
+    await aio.download_file(url, path, segments=3, segment_threshold=1024)
+    size = len(DOWNLOAD_DATA)
+    assert sorted(download_server.app["state"]["requests"]) == [
+        ("GET", "bytes=0-{}".format(size // 3 - 1)),
+        ("GET", "bytes={}-{}".format(size // 3, 2 * size // 3 - 1)),
+        ("GET", "bytes={}-{}".format(2 * size // 3, size - 1)),
+        ("HEAD", None),
+    ]
+    with open(path, "rb") as fh:
+        assert fh.read() == DOWNLOAD_DATA
+    # Too small, or no range support: one request
+    for kwargs in ({"segment_threshold": size + 1}, {}):
+        download_server.app["state"]["requests"] = []
+        if not kwargs:
+            download_server.app["state"]["ranges"] = False
+        await aio.download_file(url, path, segments=3, **kwargs)
+        assert download_server.app["state"]["requests"] == [
+            ("HEAD", None),
+            ("GET", None),
+        ]
+        with open(path, "rb") as fh:
+            assert fh.read() == DOWNLOAD_DATA
+
+
 @pytest.mark.parametrize(
-    "url,expected,raises",
+    "ranges,segments,expected",
     (
-        ("200", "firstsecond", False),
-        ("404", None, Download404),
-        ("500", None, DownloadError),
+        (True, 1, [[None, "bytes=153600-"]]),
+        (False, 1, [[None, None]]),
+        # Whichever segment is served first fails, and resumes
+        (
+            True,
+            2,
+            [
+                ["bytes=0-153599", "bytes=153600-307199", resumed]
+                for resumed in ("bytes=76800-153599", "bytes=230400-307199")
+            ],
+        ),
     ),
 )
 @pytest.mark.asyncio
-async def test_download_file(tmpdir, url, expected, raises, mocker):
-    mocker.patch.object(aiohttp, "ClientSession", new=GetFakeSession)
+async def test_download_file_resume(
+    tmpdir, download_server, ranges, segments, expected
+):
+    """Dropped connections resume where they left off, if the server supports
+    ranges, and restart otherwise.
+
+    """
     path = os.path.join(tmpdir, "foo")
-    if raises:
-        with pytest.raises(raises):
-            await aio.download_file(url, path)
-    else:
-        await aio.download_file(url, path)
-        with open(path, "r") as fh:
-            contents = fh.read()
-        assert contents == expected
+    download_server.app["state"].update(failures=1, ranges=ranges)
+    await aio.download_file(
+        str(download_server.make_url("/data")),
+        path,
+        segments=segments,
+        segment_threshold=1024,
+        digest=DOWNLOAD_SHA256,
+    )
+    with open(path, "rb") as fh:
+        assert fh.read() == DOWNLOAD_DATA
+    requests = [r for m, r in download_server.app["state"]["requests"] if m == "GET"]
+    assert sorted(requests, key=str) in [sorted(e, key=str) for e in expected]
+
+
+@pytest.mark.asyncio
+async def test_download_file_resume_attempts(tmpdir, download_server):
+    """Running out of resume attempts raises ``DownloadError``, and removes
+    the partial file.
+
+    """
+    path = os.path.join(tmpdir, "foo")
+    download_server.app["state"]["failures"] = 3
+    with pytest.raises(DownloadError):
+        await aio.download_file(
+            str(download_server.make_url("/data")), path, resume_attempts=2
+        )
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize(
+    "route,digest,raises",
+    (
+        ("/status/404", None, Download404),
+        ("/status/500", None, DownloadError),
+        ("/data", "0" * 64, DownloadError),
+    ),
+)
+@pytest.mark.parametrize("segments", (1, 4))
+@pytest.mark.asyncio
+async def test_download_file_errors(
+    tmpdir, download_server, route, digest, raises, segments
+):
+    path = os.path.join(tmpdir, "foo")
+    with pytest.raises(raises):
+        await aio.download_file(
+            str(download_server.make_url(route)),
+            path,
+            digest=digest,
+            segments=segments,
+            segment_threshold=1024,
+        )
+    assert not os.path.exists(path)
@@ -11,7 +11,9 @@ from copy import deepcopy
 import mock
 import pytest
 
+import scriptworker_client.aio as aio
 import scriptworker_client.client as client
+import scriptworker_client.utils as utils
 from scriptworker_client.exceptions import TaskError, TaskVerificationError
 
 # helpers {{{1
@@ -170,6 +172,44 @@ async def test_handle_asyncio_loop():
     assert config.get("was_async_main_called")
 
 
+@pytest.mark.parametrize("exit_code", (None, 42))
+@pytest.mark.asyncio
+async def test_handle_asyncio_loop_closes_sessions(exit_code):
+    """``_handle_asyncio_loop`` closes the pooled sessions, even on failure."""
+    sessions = []
+
+    async def async_main(*args, **kwargs):
+        sessions.append(aio.get_client_session("https://example.com"))
+        if exit_code:
+            exception = TaskError("async_error!")
+            exception.exit_code = exit_code
+            raise exception
+
+    if exit_code:
+        with pytest.raises(SystemExit):
+            await client._handle_asyncio_loop(async_main, {}, {})
+    else:
+        await client._handle_asyncio_loop(async_main, {}, {})
+    assert sessions[0].closed
+
+
+@pytest.mark.parametrize("run_commands", (True, False))
+@pytest.mark.asyncio
+async def test_handle_asyncio_loop_logs_command_summary(run_commands, mocker):
+    """``_handle_asyncio_loop`` logs the command pool summary, if there is one."""
+    pools = []
+
+    async def async_main(*args, **kwargs):
+        if run_commands:
+            pools.append(utils.get_command_pool())
+            await pools[0].run(["true"])
+
+    log_summary = mocker.patch.object(utils.CommandPool, "log_summary")
+    await client._handle_asyncio_loop(async_main, {}, {})
+    assert log_summary.call_count == (1 if run_commands else 0)
+    assert utils.get_command_pool(create=False) is (pools[0] if pools else None)
+
+
 @pytest.mark.asyncio
 async def test_fail_handle_asyncio_loop(mocker):
     """``_handle_asyncio_loop`` exits properly on failure."""
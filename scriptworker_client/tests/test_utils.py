@@ -3,6 +3,7 @@
 """Test scriptworker_client.utils
 """
 import asyncio
+import logging
 import os
 import re
 import shutil
@@ -141,14 +142,91 @@ async def test_pipe_to_log(tmpdir):
         assert fh.read() in ("foo\nbar\n", "bar\nfoo\n")
 
 
+# OutputTail {{{1
+@pytest.mark.parametrize(
+    "chunks,max_size,expected",
+    (
+        ([b"foo\n", b"bar\n"], 100, "foo\nbar\n"),
+        ([b"foo\n", b"bar\n", b"baz\n"], 6, "baz\n"),
+        ([b"foo\nbar\n", b"baz\n"], 10, "bar\nbaz\n"),
+        # No whole line fits
+        ([b"foo\n", b"barbazquux\n"], 6, "zquux\n"),
+        ([b"\xff\n"], 100, "\ufffd\n"),
+    ),
+)
+def test_output_tail(chunks, max_size, expected):
+    """``OutputTail`` keeps the last whole lines of output."""
+    tail = utils.OutputTail(max_size=max_size)
+    for chunk in chunks:
+        tail.append(chunk)
+    assert tail.getvalue() == expected
+    assert tail.size >= min(max_size, sum(len(c) for c in chunks))
+
+
+def test_output_tail_drops_chunks():
+    """``OutputTail`` only keeps the chunks it needs."""
+    tail = utils.OutputTail(max_size=10)
+    for _ in range(100):
+        tail.append(b"foo\n")
+    assert len(tail.chunks) == 3
+    assert tail.getvalue() == "foo\nfoo\n"
+
+
+# pipe_to_log_chunked {{{1
+@pytest.mark.parametrize("chunk_size", (3, 64 * 1024))
+@pytest.mark.asyncio
+async def test_pipe_to_log_chunked(tmpdir, chunk_size, caplog):
+    """``pipe_to_log_chunked`` writes whole lines of command output to the
+    log filehandle and the tail, and logs them.
+
+    """
+    caplog.set_level(logging.DEBUG)
+    cmd = r"""for i in 1 2 3; do >&2 echo "foo$i"; echo "bar$i"; done; printf baz"""
+    proc = await asyncio.create_subprocess_exec(
+        "bash", "-c", cmd, stdout=PIPE, stderr=PIPE, stdin=None
+    )
+    path = os.path.join(tmpdir, "log")
+    tail = utils.OutputTail()
+    with open(path, "wb") as log_fh:
+        await asyncio.wait(
+            [
+                utils.pipe_to_log_chunked(
+                    pipe, filehandles=[log_fh], tail=tail, chunk_size=chunk_size
+                )
+                for pipe in (proc.stderr, proc.stdout)
+            ]
+        )
+        await proc.wait()
+    expected = ["foo1", "foo2", "foo3", "bar1", "bar2", "bar3", "baz"]
+    with open(path, "r") as fh:
+        assert sorted(fh.read().splitlines()) == sorted(expected)
+    assert sorted(tail.getvalue().splitlines()) == sorted(expected)
+    assert sorted(r.message for r in caplog.records) == sorted(expected)
+
+
+@pytest.mark.asyncio
+async def test_pipe_to_log_chunked_level(caplog):
+    """``pipe_to_log_chunked`` doesn't split lines it won't log."""
+    caplog.set_level(logging.INFO)
+    proc = await asyncio.create_subprocess_exec(
+        "bash", "-c", "echo foo", stdout=PIPE, stderr=PIPE, stdin=None
+    )
+    with mock.patch.object(utils, "to_unicode") as m:
+        await utils.pipe_to_log_chunked(proc.stdout, level=logging.DEBUG)
+    await proc.wait()
+    m.assert_not_called()
+    assert caplog.records == []
+
+
 # get_log_filehandle {{{1
+@pytest.mark.parametrize("binary", (False, True))
 @pytest.mark.parametrize("path", (None, "log"))
-def test_get_log_filehandle(path, tmpdir):
+def test_get_log_filehandle(path, binary, tmpdir):
     """``get_log_filehandle`` gives a writable filehandle."""
     if path:
         path = os.path.join(tmpdir, path)
-    with utils.get_log_filehandle(log_path=path) as log_fh:
-        log_fh.write("foo")
+    with utils.get_log_filehandle(log_path=path, binary=binary) as log_fh:
+        log_fh.write(b"foo" if binary else "foo")
     if path:
         with open(path) as fh:
             assert fh.read() == "foo"
@@ -187,9 +265,18 @@ def test_get_log_filehandle(path, tmpdir):
         ),
     ),
 )
+@pytest.mark.parametrize("chunked_output", (True, False))
 @pytest.mark.asyncio
 async def test_run_command(
-    command, status, expected_log, exception, output_log, env, raises, tmpdir
+    command,
+    status,
+    expected_log,
+    exception,
+    output_log,
+    env,
+    raises,
+    chunked_output,
+    tmpdir,
 ):
     """``run_command`` runs the expected command, logs its output, and exits
     with its exit status. If ``exception`` is set and we exit non-zero, we
@@ -208,6 +295,7 @@ async def test_run_command(
                 env=env,
                 exception=exception,
                 output_log_on_exception=output_log,
+                chunked_output=chunked_output,
             )
     else:
         assert (
@@ -218,6 +306,7 @@ async def test_run_command(
                 env=env,
                 exception=exception,
                 output_log_on_exception=output_log,
+                chunked_output=chunked_output,
             )
             == status
         )
@@ -225,6 +314,50 @@ async def test_run_command(
             assert fh.read() in expected_log
 
 
+@pytest.mark.parametrize("log_path", (None, "log"))
+@pytest.mark.parametrize("chunked_output", (True, False))
+@pytest.mark.asyncio
+async def test_run_command_output_log_on_exception(log_path, chunked_output, tmpdir):
+    """``output_log_on_exception`` puts the output in the exception; with
+    ``chunked_output``, only the end of it.
+
+    """
+    if log_path:
+        log_path = os.path.join(tmpdir, log_path)
+    with pytest.raises(TaskError) as excinfo:
+        await utils.run_command(
+            ["bash", "-c", "seq 1 100000 && >&2 echo failed && exit 1"],
+            log_path=log_path,
+            log_level=logging.DEBUG,
+            exception=TaskError,
+            output_log_on_exception=True,
+            chunked_output=chunked_output,
+        )
+    log_contents = excinfo.value.args[-1]
+    assert log_contents.endswith("100000\nfailed\n")
+    assert log_contents.startswith("1\n") is not chunked_output
+    if log_path:
+        with open(log_path) as fh:
+            lines = fh.read().splitlines()
+        assert len(lines) == 100001
+        assert lines[-1] == "failed"
+
+
+@pytest.mark.parametrize("chunked_output", (True, False))
+@pytest.mark.asyncio
+async def test_run_command_pipe_error(chunked_output, mocker):
+    """An error reading the command's output is raised, rather than lost."""
+
+    async def broken_pipe(pipe, **kwargs):
+        await pipe.read()
+        raise OSError("broken")
+
+    mocker.patch.object(utils, "pipe_to_log", new=broken_pipe)
+    mocker.patch.object(utils, "pipe_to_log_chunked", new=broken_pipe)
+    with pytest.raises(OSError, match="broken"):
+        await utils.run_command(["echo", "foo"], chunked_output=chunked_output)
+
+
 # list_files {{{1
 def test_list_files():
     """``list_files`` yields a list of all files in a directory, ignoring
@@ -544,3 +677,150 @@ def test_fail_get_single_item_from_sequence(
             utils.get_single_item_from_sequence(list_, condition)
 
     assert str(exec_info.value) == expected_message
+
+
+# CommandPool {{{1
+def test_get_default_command_limits(mocker):
+    mocker.patch.object(os, "cpu_count", return_value=8)
+    assert utils.get_default_command_limits() == {
+        "cpu": 8,
+        "disk": 4,
+        "network": 32,
+    }
+    mocker.patch.object(os, "cpu_count", return_value=None)
+    assert utils.get_default_command_limits() == {"cpu": 1, "disk": 1, "network": 4}
+
+
+@pytest.mark.asyncio
+async def test_command_pool_limits(mocker):
+    """``CommandPool`` runs at most ``limits[io_class]`` commands at once per
+    io class.
+
+    """
+    running = {"disk": 0, "network": 0}
+    max_running = {"disk": 0, "network": 0}
+
+    async def fake_run_command(cmd, **kwargs):
+        io_class = cmd[0]
+        running[io_class] += 1
+        max_running[io_class] = max(max_running[io_class], running[io_class])
+        await asyncio.sleep(0.01)
+        running[io_class] -= 1
+        return 0
+
+    mocker.patch.object(utils, "run_command", new=fake_run_command)
+    pool = utils.CommandPool(limits={"disk": 2, "network": 3})
+    futures = [
+        asyncio.ensure_future(pool.run([io_class], io_class=io_class))
+        for io_class in ["disk", "network"] * 10
+    ]
+    assert await utils.raise_future_exceptions(futures) == [0] * 20
+    assert max_running == {"disk": 2, "network": 3}
+    assert pool.running == {"cpu": 0, "disk": 0, "network": 0}
+    summary = pool.get_summary()
+    assert sorted(summary) == ["disk", "network"]
+    assert summary["disk"]["commands"] == summary["disk"]["attempts"] == 10
+    assert summary["disk"]["run_time"] >= 0.1
+    assert summary["disk"]["max_wait_time"] >= 0.04
+
+
+@pytest.mark.asyncio
+async def test_command_pool_priority(mocker):
+    """Waiting commands run lowest ``priority`` first, then in order."""
+    order = []
+
+    async def fake_run_command(cmd, **kwargs):
+        order.append(cmd[0])
+        await asyncio.sleep(0)
+        return 0
+
+    mocker.patch.object(utils, "run_command", new=fake_run_command)
+    pool = utils.CommandPool(limits={"cpu": 1})
+    futures = [
+        asyncio.ensure_future(pool.run([name], priority=priority))
+        for name, priority in (("a", 5), ("b", 3), ("c", 1), ("d", 3), ("e", 0))
+    ]
+    await utils.raise_future_exceptions(futures)
+    # "a" gets the free slot before the others are queued
+    assert order == ["a", "e", "c", "b", "d"]
+
+
+@pytest.mark.asyncio
+async def test_command_pool_cancel(mocker):
+    """Cancelled commands give up their place and their slot."""
+
+    async def fake_run_command(cmd, **kwargs):
+        await asyncio.sleep(0.01)
+        return 0
+
+    mocker.patch.object(utils, "run_command", new=fake_run_command)
+    pool = utils.CommandPool(limits={"cpu": 1})
+    futures = [asyncio.ensure_future(pool.run([str(i)])) for i in range(3)]
+    await asyncio.sleep(0)
+    futures[1].cancel()
+    await asyncio.wait(futures)
+    assert futures[1].cancelled()
+    assert futures[2].result() == 0
+    assert pool.running["cpu"] == 0
+    assert [stats.attempts for stats in pool.stats] == [1, 0, 1]
+
+
+@pytest.mark.asyncio
+async def test_command_pool_retry(mocker):
+    """``CommandPool.run`` retries failed commands, and raises once it runs
+    out of attempts.
+
+    """
+    exitcodes = [TaskError("fail"), 1]
+
+    async def fake_run_command(cmd, **kwargs):
+        result = exitcodes.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    mocker.patch.object(utils, "run_command", new=fake_run_command)
+    pool = utils.CommandPool()
+    sleeptime_kwargs = {"delay_factor": 0}
+    assert (
+        await pool.run(
+            ["foo", "secret"],
+            log_cmd=["foo", "***"],
+            attempts=2,
+            retry_exceptions=TaskError,
+            sleeptime_kwargs=sleeptime_kwargs,
+        )
+        == 1
+    )
+    stats = pool.stats[0]
+    assert (stats.cmd, stats.attempts, stats.exitcode) == (["foo", "***"], 2, 1)
+    exitcodes = [TaskError("fail")] * 2
+    with pytest.raises(TaskError):
+        await pool.run(
+            ["foo"],
+            attempts=2,
+            retry_exceptions=TaskError,
+            sleeptime_kwargs=sleeptime_kwargs,
+        )
+    assert pool.stats[1].exitcode is None
+    assert pool.running["cpu"] == 0
+    with pytest.raises(ValueError):
+        await pool.run(["foo"], io_class="gpu")
+
+
+@pytest.mark.asyncio
+async def test_command_pool_run_command(tmpdir, caplog):
+    """``CommandPool.run`` runs real commands, and logs its summary."""
+    caplog.set_level(logging.INFO)
+    pool = utils.CommandPool()
+    assert await pool.run(["bash", "-c", "exit 3"], io_class="disk", cwd=tmpdir) == 3
+    pool.log_summary()
+    assert "disk commands: 1 in 1 attempts" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_get_command_pool():
+    assert utils.get_command_pool(create=False) is None
+    pool = utils.get_command_pool()
+    assert isinstance(pool, utils.CommandPool)
+    assert utils.get_command_pool() is pool
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Benchmark building and uploading autograph /sign/file request bodies.
+
+This measures how many times ``call_autograph`` reads the input file, how
+many bytes it copies to temporary files, and how long it takes, for a
+synthetic input. The upload goes to a fake session that drains the request
+body in 64KiB reads, the way aiohttp does.
+
+Usage::
+
+    python benchmarks/autograph_request.py [size_in_mb]
+
+"""
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+# signingscript.sign and signingscript.task import each other; task goes first
+import signingscript.task  # noqa: F401 isort:skip
+import signingscript.sign as sign  # isort:skip
+
+
+class CountingFile(io.FileIO):
+    """A file that counts the bytes read from it."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize CountingFile."""
+        super().__init__(*args, **kwargs)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        """Read from the file, counting the bytes read."""
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class FakeSession:
+    """Drain the request body like aiohttp's IOBasePayload."""
+
+    async def post(self, url, data=None, headers=None):
+        """Read the whole request body, and return a fake response."""
+        while data.read(2 ** 16):
+            pass
+        resp = mock.MagicMock()
+        resp.status = 200
+        resp.json = mock.AsyncMock(return_value=[{"signed_file": ""}])
+        return resp
+
+
+async def run(path):
+    """Run ``call_autograph`` against `path` and print the stats."""
+    written = 0
+    real_temporary_file = tempfile.TemporaryFile
+
+    def counting_temporary_file(*args, **kwargs):
+        fh = real_temporary_file(*args, **kwargs)
+        real_write = fh.write
+
+        def write(data):
+            nonlocal written
+            written += len(data)
+            return real_write(data)
+
+        fh.write = write
+        return fh
+
+    input_file = CountingFile(path, "rb")
+    with mock.patch.object(tempfile, "TemporaryFile", new=counting_temporary_file):
+        start = time.time()
+        await sign.call_autograph(FakeSession(), "https://autograph.example.com/sign/file", "user", "password", {"input": input_file})
+        elapsed = time.time() - start
+    size = os.path.getsize(path)
+    print(f"input size:               {size} bytes")
+    print(f"input bytes read:         {input_file.bytes_read} ({input_file.bytes_read / size:.1f} passes)")
+    print(f"bytes copied to tmpfiles: {written}")
+    print(f"elapsed:                  {elapsed:.2f}s")
+
+
+def main():
+    """Create a random input file and benchmark it."""
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    with tempfile.NamedTemporaryFile() as fh:
+        for _ in range(size_mb):
+            fh.write(os.urandom(2 ** 20))
+        fh.flush()
+        asyncio.run(run(fh.name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark ``_create_tarfile`` with and without parallel compression.
+
+This builds a synthetic tree shaped roughly like a Firefox package: a few
+large, mostly-compressible libraries plus many small text files, with a
+share of incompressible data. It then times ``_create_tarfile`` for each
+compression and thread count, and checks that the result still untars.
+
+Usage::
+
+    python benchmarks/create_tarfile.py [size_in_mb] [threads ...]
+
+"""
+import asyncio
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import time
+
+# signingscript.sign and signingscript.task import each other; task goes first
+import signingscript.task  # noqa: F401 isort:skip
+import signingscript.sign as sign  # isort:skip
+
+
+class Context:
+    """Just enough of a scriptworker Context for ``_create_tarfile``."""
+
+    def __init__(self, work_dir, threads):
+        """Initialize Context."""
+        self.config = {"work_dir": work_dir, "tarfile_compression_threads": threads}
+
+
+def make_tree(top_dir, size_mb):
+    """Write about `size_mb` MB of files under `top_dir`, and return their paths."""
+    rng = random.Random(1)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+    files = []
+    remaining = size_mb * 2 ** 20
+    i = 0
+    while remaining > 0:
+        # Every tenth file is a big library; the rest are small
+        size = min(remaining, 40 * 2 ** 20 if i % 10 == 0 else rng.randint(1, 512) * 2 ** 10)
+        path = os.path.join(top_dir, "firefox", "dir{}".format(i % 17), "file{}".format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            written = 0
+            while written < size:
+                # A quarter random bytes, the rest text-like
+                if rng.random() < 0.25:
+                    block = os.urandom(2 ** 16)
+                else:
+                    block = b" ".join(rng.choices(words, k=12000))[: 2 ** 16]
+                block = block[: size - written]
+                fh.write(block)
+                written += len(block)
+        files.append(path)
+        remaining -= size
+        i += 1
+    return files
+
+
+def main():
+    """Create a synthetic tree and benchmark compressing it."""
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    all_threads = [int(t) for t in sys.argv[2:]] or [1, os.cpu_count() or 1]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        top_dir = os.path.join(tmp_dir, "tree")
+        files = make_tree(top_dir, size_mb)
+        print(f"tree: {len(files)} files, {size_mb} MB, {os.cpu_count()} cpus")
+        for compression in ("gz", "bz2"):
+            for threads in all_threads:
+                to = os.path.join(tmp_dir, "out.tar.{}".format(compression))
+                start = time.time()
+                asyncio.run(sign._create_tarfile(Context(tmp_dir, threads), to, files, compression, tmp_dir=top_dir))
+                elapsed = time.time() - start
+                with tarfile.open(to) as t:
+                    assert len(t.getmembers()) == len(files)
+                print(f"{compression:>3} threads={threads:<3} {elapsed:7.2f}s  {os.path.getsize(to) / 2 ** 20:8.1f} MB")
+                os.remove(to)
+
+
+if __name__ == "__main__":
+    main()
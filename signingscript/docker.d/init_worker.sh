@@ -23,7 +23,6 @@ test_var_set 'TEMPLATE_DIR'
 
 export DMG_PATH=/app/signingscript/files/dmg
 export HFSPLUS_PATH=/app/signingscript/files/hfsplus
-export ZIPALIGN_PATH=/usr/bin/zipalign
 
 export PASSWORDS_PATH=$CONFIG_DIR/passwords.json
 export GPG_PUBKEY_PATH=$CONFIG_DIR/gpg_pubkey
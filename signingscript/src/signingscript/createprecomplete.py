@@ -39,30 +39,82 @@ def get_build_entries(root_path):
     return rel_file_path_list, rel_dir_path_list
 
 
-def generate_precomplete(root_path):
-    """Creates the precomplete file containing the remove and rmdir
-    application update instructions. The given directory is used
-    for the location to enumerate and to create the precomplete file.
+def get_build_entries_from_list(root_path, file_list):
+    """Like get_build_entries, but builds the lists from file_list, the paths
+    that will exist under root_path, instead of walking root_path. Parent
+    directories are derived from the file paths; paths ending with / are
+    directories, which lets empty directories be listed too.
+    """
+    root_path = os.path.abspath(root_path)
+    rel_file_path_set = set()
+    rel_dir_path_set = set()
+    for path in file_list:
+        is_dir = path.endswith("/")
+        path = os.path.abspath(path)
+        if not path.startswith(root_path + os.sep):
+            continue
+        rel_path = path[len(root_path) + 1 :].replace("\\", "/")
+        parts = rel_path.split("/")
+        if not is_dir:
+            parts = parts[:-1]
+            if not (rel_path.endswith("channel-prefs.js") or rel_path.endswith("update-settings.ini") or rel_path.find("distribution/") != -1):
+                rel_file_path_set.add(rel_path)
+        for i in range(1, len(parts) + 1):
+            rel_path_dir = "/".join(parts[:i]) + "/"
+            if rel_path_dir.find("distribution/") == -1:
+                rel_dir_path_set.add(rel_path_dir)
+
+    rel_file_path_list = list(rel_file_path_set)
+    rel_file_path_list.sort(reverse=True)
+    rel_dir_path_list = list(rel_dir_path_set)
+    rel_dir_path_list.sort(reverse=True)
+
+    return rel_file_path_list, rel_dir_path_list
+
+
+def _get_precomplete_path(root_path):
+    """Returns the root to enumerate and the path of the precomplete file.
+    If inside a Mac bundle use the root of the bundle for the path.
     """
     rel_path_precomplete = "precomplete"
-    # If inside a Mac bundle use the root of the bundle for the path.
     if os.path.basename(root_path) == "Resources":
         root_path = os.path.abspath(os.path.join(root_path, "../../"))
         rel_path_precomplete = "Contents/Resources/precomplete"
+    return root_path, os.path.join(root_path, rel_path_precomplete)
 
-    precomplete_file_path = os.path.join(root_path, rel_path_precomplete)
-    # Open the file so it exists before building the list of files and open it
-    # in binary mode to prevent OS specific line endings.
-    precomplete_file = open(precomplete_file_path, "wb")
-    rel_file_path_list, rel_dir_path_list = get_build_entries(root_path)
+
+def _write_precomplete(precomplete_file, rel_file_path_list, rel_dir_path_list):
     for rel_file_path in rel_file_path_list:
         precomplete_file.write('remove "{}"\n'.format(rel_file_path).encode("utf-8"))
 
     for rel_dir_path in rel_dir_path_list:
         precomplete_file.write('rmdir "{}"\n'.format(rel_dir_path).encode("utf-8"))
 
+
+def generate_precomplete(root_path):
+    """Creates the precomplete file containing the remove and rmdir
+    application update instructions. The given directory is used
+    for the location to enumerate and to create the precomplete file.
+    """
+    root_path, precomplete_file_path = _get_precomplete_path(root_path)
+    # Open the file so it exists before building the list of files and open it
+    # in binary mode to prevent OS specific line endings.
+    precomplete_file = open(precomplete_file_path, "wb")
+    rel_file_path_list, rel_dir_path_list = get_build_entries(root_path)
+    _write_precomplete(precomplete_file, rel_file_path_list, rel_dir_path_list)
     precomplete_file.close()
 
 
+def generate_precomplete_from_list(root_path, file_list):
+    """Like generate_precomplete, but enumerates file_list, the paths that
+    will exist once the build is repacked, instead of walking the directory.
+    Only the precomplete file itself needs to be on disk.
+    """
+    root_path, precomplete_file_path = _get_precomplete_path(root_path)
+    rel_file_path_list, rel_dir_path_list = get_build_entries_from_list(root_path, list(file_list) + [precomplete_file_path])
+    with open(precomplete_file_path, "wb") as precomplete_file:
+        _write_precomplete(precomplete_file, rel_file_path_list, rel_dir_path_list)
+
+
 if __name__ == "__main__":
     generate_precomplete(os.getcwd())
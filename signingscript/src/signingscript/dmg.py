@@ -0,0 +1,462 @@
+"""Read the HFS+ volume in a dmg without mounting or extracting it.
+
+A dmg is a UDIF disk image: a data fork of compressed runs of sectors, a
+property list with a ``blkx`` table per partition saying where each run goes,
+and a ``koly`` trailer pointing at both. `UDIFImage` gives random access to
+the decompressed disk, a run at a time. `HFSVolume` reads the HFS+ catalog
+from that, and `write_dmg_to_tarfile` streams every file, directory and
+symlink in the volume into a tarfile.
+
+Only what Firefox dmgs use is supported: raw, zero, zlib, bzip2 and lzma runs,
+and uncompressed HFS+ or HFSX volumes. Anything else raises
+`UnsupportedDmgError`, so callers can fall back to the ``dmg`` and
+``hfsplus`` binaries.
+
+"""
+import bisect
+import bz2
+import collections
+import io
+import logging
+import lzma
+import plistlib
+import stat
+import struct
+import tarfile
+import zlib
+
+from signingscript.exceptions import SigningScriptError, UnsupportedDmgError
+
+log = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+
+# UDIF run types
+_RUN_ZERO = 0x00000000
+_RUN_RAW = 0x00000001
+_RUN_IGNORE = 0x00000002
+_RUN_ADC = 0x80000004
+_RUN_ZLIB = 0x80000005
+_RUN_BZIP2 = 0x80000006
+_RUN_LZFSE = 0x80000007
+_RUN_LZMA = 0x80000008
+_RUN_COMMENT = 0x7FFFFFFE
+_RUN_END = 0xFFFFFFFF
+_DECOMPRESSORS = {_RUN_ZLIB: zlib.decompress, _RUN_BZIP2: bz2.decompress, _RUN_LZMA: lzma.decompress}
+
+_MISH = struct.Struct(">4sIQQQII24sII128sI")
+_RUN = struct.Struct(">IIQQQQ")
+
+# HFS+ dates count seconds from 1904-01-01
+_HFS_EPOCH_OFFSET = 2082844800
+_ROOT_FOLDER_ID = 2
+_EXTENTS_FILE_ID = 3
+_CATALOG_FILE_ID = 4
+_FOLDER_RECORD = 1
+_FILE_RECORD = 2
+_DATA_FORK = 0
+_UF_COMPRESSED = 0x20
+_PRIVATE_DATA = "\0\0\0\0HFS+ Private Data"
+# Filesystem metadata at the root of the volume, rather than contents
+_HIDDEN_ROOT_NAMES = {_PRIVATE_DATA, ".HFS+ Private Directory Data\r", ".journal", ".journal_info_block"}
+
+
+# UDIFImage {{{1
+class UDIFImage:
+    """Random access to the decompressed sectors of a UDIF disk image.
+
+    Runs are decompressed whole, and the last `cache_size` of them are kept,
+    so reading a file's blocks in order decompresses each run once.
+
+    Args:
+        fh (file): the dmg, open for reading in binary mode
+        cache_size (int, optional): how many decompressed runs to keep.
+            Defaults to 8.
+
+    Raises:
+        UnsupportedDmgError: if `fh` isn't a UDIF image with a property list
+
+    """
+
+    def __init__(self, fh, cache_size=8):
+        """Initialize UDIFImage."""
+        self._fh = fh
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        fh.seek(0, io.SEEK_END)
+        if fh.tell() < SECTOR_SIZE:
+            raise UnsupportedDmgError("Not a UDIF image: too small")
+        fh.seek(-SECTOR_SIZE, io.SEEK_END)
+        koly = fh.read(SECTOR_SIZE)
+        if koly[:4] != b"koly":
+            raise UnsupportedDmgError("Not a UDIF image: no koly trailer")
+        (data_fork_offset,) = struct.unpack_from(">Q", koly, 24)
+        xml_offset, xml_length = struct.unpack_from(">QQ", koly, 216)
+        if not xml_length:
+            raise UnsupportedDmgError("UDIF image has no property list")
+        fh.seek(xml_offset)
+        plist = plistlib.loads(fh.read(xml_length))
+
+        self.partitions = []
+        runs = []
+        for blkx in plist["resource-fork"]["blkx"]:
+            mish = _MISH.unpack_from(blkx["Data"])
+            if mish[0] != b"mish":
+                raise UnsupportedDmgError("Bad blkx table: no mish header")
+            first_sector, sector_count, data_offset, run_count = mish[2], mish[3], mish[4], mish[11]
+            self.partitions.append((blkx.get("CFName") or blkx.get("Name", ""), first_sector, sector_count))
+            for i in range(run_count):
+                run_type, _, sector, count, offset, length = _RUN.unpack_from(blkx["Data"], _MISH.size + i * _RUN.size)
+                if run_type in (_RUN_COMMENT, _RUN_END) or not count:
+                    continue
+                if run_type in (_RUN_ADC, _RUN_LZFSE) or (run_type not in _DECOMPRESSORS and run_type not in (_RUN_ZERO, _RUN_RAW, _RUN_IGNORE)):
+                    raise UnsupportedDmgError(f"Unsupported UDIF run type {run_type:#x}")
+                runs.append((first_sector + sector, count, run_type, data_fork_offset + data_offset + offset, length))
+        runs.sort()
+        self._runs = runs
+        self._run_starts = [run[0] for run in runs]
+
+    def _get_run(self, i):
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        _, count, run_type, offset, length = self._runs[i]
+        self._fh.seek(offset)
+        data = self._fh.read(length)
+        if run_type != _RUN_RAW:
+            data = _DECOMPRESSORS[run_type](data)
+        if len(data) != count * SECTOR_SIZE:
+            raise SigningScriptError(f"UDIF run at sector {self._runs[i][0]} is {len(data)} bytes; expected {count * SECTOR_SIZE}")
+        self._cache[i] = data
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def read(self, offset, size):
+        """Read `size` bytes of the disk, starting at `offset`.
+
+        Raises:
+            SigningScriptError: if the read runs past the sectors in the image
+
+        """
+        out = bytearray()
+        while size > 0:
+            i = bisect.bisect_right(self._run_starts, offset // SECTOR_SIZE) - 1
+            if i < 0 or offset >= (self._runs[i][0] + self._runs[i][1]) * SECTOR_SIZE:
+                raise SigningScriptError(f"Offset {offset} isn't in the UDIF image")
+            start, count, run_type = self._runs[i][:3]
+            run_offset = offset - start * SECTOR_SIZE
+            n = min(size, count * SECTOR_SIZE - run_offset)
+            if run_type in (_RUN_ZERO, _RUN_IGNORE):
+                # Free space is often one big zero run; don't decompress it
+                out += bytes(n)
+            else:
+                out += self._get_run(i)[run_offset : run_offset + n]
+            offset += n
+            size -= n
+        return bytes(out)
+
+    def get_hfs_offset(self):
+        """Find the HFS+ partition.
+
+        Returns:
+            int: the offset of the HFS+ partition in the disk
+
+        Raises:
+            UnsupportedDmgError: if there's no HFS+ partition
+
+        """
+        # Prefer partitions named for HFS, but check every one
+        for name, first_sector, sector_count in sorted(self.partitions, key=lambda p: "Apple_HFS" not in p[0]):
+            if sector_count >= 3 and self.read(first_sector * SECTOR_SIZE + 1024, 2) in (b"H+", b"HX"):
+                return first_sector * SECTOR_SIZE
+        raise UnsupportedDmgError("No HFS+ partition found in the UDIF image")
+
+
+# HFSVolume {{{1
+def _parse_fork(data, offset):
+    logical_size = struct.unpack_from(">Q", data, offset)[0]
+    extents = struct.unpack_from(">16I", data, offset + 16)
+    return logical_size, [(extents[i], extents[i + 1]) for i in range(0, 16, 2) if extents[i + 1]]
+
+
+def _iter_btree_leaf_records(data):
+    """Yield the records in every leaf node of a B-tree file, in key order."""
+    (first_leaf,) = struct.unpack_from(">I", data, 24)
+    (node_size,) = struct.unpack_from(">H", data, 32)
+    node = first_leaf
+    seen = set()
+    while node:
+        if node in seen or (node + 1) * node_size > len(data):
+            raise SigningScriptError(f"Corrupt HFS+ B-tree: bad leaf node {node}")
+        seen.add(node)
+        buf = data[node * node_size : (node + 1) * node_size]
+        f_link, _, kind, _, num_records = struct.unpack_from(">IIbBH", buf)
+        if kind != -1:
+            raise SigningScriptError(f"Corrupt HFS+ B-tree: node {node} isn't a leaf")
+        # Record offsets are at the end of the node, last first, with the
+        # offset of the free space before them
+        offsets = struct.unpack_from(f">{num_records + 1}H", buf, node_size - 2 * (num_records + 1))[::-1]
+        for start, end in zip(offsets, offsets[1:]):
+            yield buf[start:end]
+        node = f_link
+
+
+class HFSEntry:
+    """A file, directory or symlink in an HFS+ volume.
+
+    Attributes:
+        path (str): the path from the root of the volume, `.` for the root
+        type (bytes): `tarfile.DIRTYPE`, `tarfile.SYMTYPE` or `tarfile.REGTYPE`
+        mode (int): the permission bits
+        mtime (int): the modification time, in seconds since the unix epoch
+        file_id (int): the catalog node id holding the data, for files
+        fork (tuple): the data fork's logical size and extents, for files
+            and symlinks
+
+    """
+
+    def __init__(self, path, type_, mode, mtime, file_id=None, fork=None):
+        """Initialize HFSEntry."""
+        self.path = path
+        self.type = type_
+        self.mode = mode
+        self.mtime = mtime
+        self.file_id = file_id
+        self.fork = fork
+
+
+class HFSVolume:
+    """Read the files in an HFS+ or HFSX volume.
+
+    Args:
+        read (function): reads `size` bytes of the volume at `offset`, with
+            signature ``read(offset, size)``
+
+    Raises:
+        UnsupportedDmgError: if there's no HFS+ volume header
+
+    """
+
+    def __init__(self, read):
+        """Initialize HFSVolume."""
+        self._read = read
+        header = read(1024, 512)
+        if header[:2] not in (b"H+", b"HX"):
+            raise UnsupportedDmgError("Not an HFS+ volume")
+        (self.block_size,) = struct.unpack_from(">I", header, 40)
+        self._overflow = collections.defaultdict(list)
+        extents_file = _parse_fork(header, 192)
+        if extents_file[0]:
+            for record in _iter_btree_leaf_records(self.read_fork(_EXTENTS_FILE_ID, extents_file)):
+                _, fork_type, _, file_id, _ = struct.unpack_from(">HBBII", record)
+                extents = struct.unpack_from(">16I", record, 12)
+                if fork_type == _DATA_FORK:
+                    self._overflow[file_id].extend((extents[i], extents[i + 1]) for i in range(0, 16, 2) if extents[i + 1])
+        self._catalog = self.read_fork(_CATALOG_FILE_ID, _parse_fork(header, 272))
+
+    def _get_extents(self, file_id, fork):
+        logical_size, extents = fork
+        blocks = sum(count for _, count in extents)
+        # Overflow records are in key order, so in file order
+        for start, count in self._overflow.get(file_id, []):
+            if blocks * self.block_size >= logical_size:
+                break
+            extents = extents + [(start, count)]
+            blocks += count
+        if blocks * self.block_size < logical_size:
+            raise SigningScriptError(f"HFS+ file {file_id} is missing extents")
+        return extents
+
+    def iter_fork_blocks(self, file_id, fork, chunk_size=2 ** 20):
+        """Yield the data in a file's fork, up to `chunk_size` bytes at a time."""
+        remaining = fork[0]
+        for start, count in self._get_extents(file_id, fork):
+            offset = start * self.block_size
+            extent_size = min(remaining, count * self.block_size)
+            while extent_size > 0:
+                n = min(chunk_size, extent_size)
+                yield self._read(offset, n)
+                offset += n
+                extent_size -= n
+                remaining -= n
+            if not remaining:
+                break
+
+    def read_fork(self, file_id, fork):
+        """Read the whole of a file's fork."""
+        return b"".join(self.iter_fork_blocks(file_id, fork))
+
+    def iter_entries(self):
+        """Yield an HFSEntry for each directory, file and symlink in the volume.
+
+        Directories come first, parents before children. Then symlinks, then
+        files, in the order their data is laid out in the volume.
+
+        Raises:
+            UnsupportedDmgError: for compressed files or directory hard links
+
+        """
+        folders = {}
+        files = []
+        for record in _iter_btree_leaf_records(self._catalog):
+            key_length, parent_id, name_length = struct.unpack_from(">HIH", record)
+            name = record[8 : 8 + 2 * name_length].decode("utf-16-be").replace("/", ":")
+            data = record[2 + key_length :]
+            (record_type,) = struct.unpack_from(">h", data)
+            if record_type == _FOLDER_RECORD:
+                folders[struct.unpack_from(">I", data, 8)[0]] = (parent_id, name, data)
+            elif record_type == _FILE_RECORD:
+                files.append((parent_id, name, data))
+
+        paths = {_ROOT_FOLDER_ID: "."}
+
+        def get_path(folder_id):
+            if folder_id not in paths:
+                if folder_id not in folders:
+                    return None
+                parent_id, name, _ = folders[folder_id]
+                parent = get_path(parent_id)
+                paths[folder_id] = None if parent is None or (parent == "." and name in _HIDDEN_ROOT_NAMES) else f"{parent}/{name}"
+            return paths[folder_id]
+
+        dirs = []
+        for folder_id, (_, _, data) in folders.items():
+            path = get_path(folder_id)
+            if path is not None:
+                dirs.append(HFSEntry(path, tarfile.DIRTYPE, *_get_mode_and_mtime(data, 0o755)))
+        dirs.sort(key=lambda entry: entry.path.split("/"))
+
+        # Hard links point at files in the private data folder
+        private_id = next((folder_id for folder_id, (parent_id, name, _) in folders.items() if parent_id == _ROOT_FOLDER_ID and name == _PRIVATE_DATA), None)
+        inodes = {name: data for parent_id, name, data in files if parent_id == private_id}
+
+        symlinks = []
+        regular = []
+        for parent_id, name, data in files:
+            parent = get_path(parent_id)
+            if parent is None or (parent == "." and name in _HIDDEN_ROOT_NAMES):
+                continue
+            path = f"{parent}/{name}"
+            file_type, creator = data[48:52], data[52:56]
+            if (file_type, creator) == (b"fdrp", b"MACS"):
+                raise UnsupportedDmgError(f"{path} is a directory hard link")
+            mode, mtime = _get_mode_and_mtime(data, 0o644)
+            if (file_type, creator) == (b"hlnk", b"hfs+"):
+                inode = "iNode{}".format(struct.unpack_from(">I", data, 44)[0])
+                if inode not in inodes:
+                    raise SigningScriptError(f"{path} links to missing {inode}")
+                data = inodes[inode]
+                mode, mtime = _get_mode_and_mtime(data, 0o644)
+            if data[41] & _UF_COMPRESSED:
+                raise UnsupportedDmgError(f"{path} is compressed")
+            file_id = struct.unpack_from(">I", data, 8)[0]
+            fork = _parse_fork(data, 88)
+            if stat.S_ISLNK(struct.unpack_from(">H", data, 42)[0]):
+                symlinks.append(HFSEntry(path, tarfile.SYMTYPE, mode, mtime, file_id, fork))
+            else:
+                regular.append(HFSEntry(path, tarfile.REGTYPE, mode, mtime, file_id, fork))
+        symlinks.sort(key=lambda entry: entry.path)
+        regular.sort(key=lambda entry: (entry.fork[1][0][0] if entry.fork[1] else 0, entry.path))
+        yield from dirs
+        yield from symlinks
+        yield from regular
+
+
+def _get_mode_and_mtime(data, default_mode):
+    (file_mode,) = struct.unpack_from(">H", data, 42)
+    (mtime,) = struct.unpack_from(">I", data, 16)
+    # Volumes created without permissions have no mode at all
+    return stat.S_IMODE(file_mode) or default_mode, max(mtime - _HFS_EPOCH_OFFSET, 0)
+
+
+# HFSForkReader {{{1
+class HFSForkReader(io.RawIOBase):
+    """A read-only file object over a file's data fork, for `tarfile.addfile`."""
+
+    def __init__(self, volume, entry):
+        """Initialize HFSForkReader."""
+        super().__init__()
+        self._blocks = volume.iter_fork_blocks(entry.file_id, entry.fork)
+        self._buffer = b""
+
+    def readable(self):
+        """Return True; the fork is readable."""
+        return True
+
+    def readinto(self, b):
+        """Read up to ``len(b)`` bytes into `b`, and return the number read."""
+        while not self._buffer:
+            self._buffer = next(self._blocks, None)
+            if self._buffer is None:
+                self._buffer = b""
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+# get_dmg_files {{{1
+def get_dmg_files(fh):
+    """List the files and directories in the HFS+ volume of a dmg.
+
+    Names match the members `write_dmg_to_tarfile` would write. Directories
+    end in ``/``, the way zipfile marks them.
+
+    Args:
+        fh (file): the dmg, open for reading in binary mode
+
+    Raises:
+        UnsupportedDmgError: if the dmg uses features this module can't read.
+
+    Returns:
+        dict: the size of each file, or 0 for directories.
+
+    """
+    image = UDIFImage(fh)
+    hfs_offset = image.get_hfs_offset()
+    volume = HFSVolume(lambda offset, size: image.read(hfs_offset + offset, size))
+    files = {}
+    for entry in volume.iter_entries():
+        if entry.type == tarfile.DIRTYPE:
+            files["{}/".format(entry.path.rstrip("/"))] = 0
+        elif entry.type == tarfile.REGTYPE:
+            files[entry.path] = entry.fork[0]
+    return files
+
+
+# write_dmg_to_tarfile {{{1
+def write_dmg_to_tarfile(fh, tar):
+    """Add everything in the HFS+ volume of a dmg to a tarfile.
+
+    Members are named like ``tar czf to.tar.gz .`` from the root of the
+    volume would name them, and are owned by root.
+
+    Args:
+        fh (file): the dmg, open for reading in binary mode
+        tar (tarfile.TarFile): the tarfile to add to
+
+    Raises:
+        UnsupportedDmgError: if the dmg uses features this module can't read.
+            Nothing has been added to `tar` if the problem is with the image,
+            rather than a file in it.
+
+    """
+    image = UDIFImage(fh)
+    hfs_offset = image.get_hfs_offset()
+    volume = HFSVolume(lambda offset, size: image.read(hfs_offset + offset, size))
+    for entry in volume.iter_entries():
+        info = tarfile.TarInfo("./" if entry.path == "." else entry.path)
+        info.type = entry.type
+        info.mode = entry.mode
+        info.mtime = entry.mtime
+        if entry.type == tarfile.SYMTYPE:
+            info.linkname = volume.read_fork(entry.file_id, entry.fork).decode("utf8")
+            tar.addfile(info)
+        elif entry.type == tarfile.REGTYPE:
+            info.size = entry.fork[0]
+            with HFSForkReader(volume, entry) as reader:
+                tar.addfile(info, io.BufferedReader(reader, buffer_size=2 ** 20))
+        else:
+            tar.addfile(info)
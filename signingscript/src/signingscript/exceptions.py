@@ -40,3 +40,7 @@ class FailedSubprocess(ScriptWorkerTaskException):
 
         """
         super(FailedSubprocess, self).__init__(msg, exit_code=STATUSES["internal-error"])
+
+
+class UnsupportedDmgError(SigningScriptError):
+    """A dmg uses a feature that `signingscript.dmg` can't read."""
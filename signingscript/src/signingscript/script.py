@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 """Signing script."""
+import asyncio
 import logging
 import os
 
 import aiohttp
 import scriptworker.client
 
-from signingscript.task import build_filelist_dict, sign, task_signing_formats
+from signingscript.task import build_filelist_dict, get_signing_plan, sign, task_signing_formats, write_signing_estimate
 from signingscript.utils import copy_to_dir, load_autograph_configs
 
 log = logging.getLogger(__name__)
@@ -20,7 +21,7 @@ async def async_main(context):
         context (Context): the signing context.
 
     """
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(connector=get_connector(context)) as session:
         all_signing_formats = task_signing_formats(context)
         if "gpg" in all_signing_formats or "autograph_gpg" in all_signing_formats:
             if not context.config.get("gpg_pubkey"):
@@ -34,20 +35,78 @@ async def async_main(context):
 
         context.session = session
         context.autograph_configs = load_autograph_configs(context.config["autograph_configs"])
-        work_dir = context.config["work_dir"]
         filelist_dict = build_filelist_dict(context)
+        signing_plan = get_signing_plan(context)
         for path, path_dict in filelist_dict.items():
-            copy_to_dir(path_dict["full_path"], context.config["work_dir"], target=path)
-            log.info("signing %s", path)
-            output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
-            for source in output_files:
-                source = os.path.relpath(source, work_dir)
-                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
-            if "gpg" in path_dict["formats"] or "autograph_gpg" in path_dict["formats"]:
-                copy_to_dir(context.config["gpg_pubkey"], context.config["artifact_dir"], target="public/build/KEY")
+            signing_plan.add(path, path_dict["formats"])
+        if context.config.get("signing_estimate") or context.config.get("signing_dry_run"):
+            await write_signing_estimate(context, filelist_dict)
+        if context.config.get("signing_dry_run"):
+            log.info("Dry run; not signing anything")
+            return
+        semaphore = asyncio.Semaphore(context.config.get("max_concurrent_signings", 1))
+        tasks = [asyncio.ensure_future(_sign_path(context, semaphore, path, path_dict)) for path, path_dict in filelist_dict.items()]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Report errors in filelist order, rather than completion order
+        errors = [(path, result) for path, result in zip(filelist_dict, results) if isinstance(result, BaseException)]
+        for path, error in errors:
+            log.error("Failed to sign %s: %s", path, error)
+        if errors:
+            raise errors[0][1]
     log.info("Done!")
 
 
+# get_connector {{{1
+def get_connector(context):
+    """Create the connector for the autograph session.
+
+    Reuse connections to each autograph server, up to
+    ``autograph_connections_per_host`` at a time, and cache DNS lookups.
+
+    Args:
+        context (Context): the signing context.
+
+    Returns:
+        aiohttp.TCPConnector: the connector.
+
+    """
+    return aiohttp.TCPConnector(
+        limit_per_host=context.config.get("autograph_connections_per_host", 8),
+        keepalive_timeout=context.config.get("autograph_keepalive_timeout", 30),
+        ttl_dns_cache=context.config.get("autograph_dns_cache_ttl", 300),
+    )
+
+
+# _sign_path {{{1
+async def _sign_path(context, semaphore, path, path_dict):
+    """Copy, sign, and publish a single upstream artifact.
+
+    Args:
+        context (Context): the signing context.
+        semaphore (asyncio.Semaphore): limits the number of paths being
+            signed at the same time.
+        path (str): the relative path of the upstream artifact.
+        path_dict (dict): the `build_filelist_dict` entry for `path`.
+
+    Returns:
+        list: the relative paths of the published files.
+
+    """
+    work_dir = context.config["work_dir"]
+    async with semaphore:
+        copy_to_dir(path_dict["full_path"], work_dir, target=path)
+        log.info("signing %s", path)
+        output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
+    published = []
+    for source in output_files:
+        source = os.path.relpath(source, work_dir)
+        copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
+        published.append(source)
+    if "gpg" in path_dict["formats"] or "autograph_gpg" in path_dict["formats"]:
+        copy_to_dir(context.config["gpg_pubkey"], context.config["artifact_dir"], target="public/build/KEY")
+    return published
+
+
 def get_default_config(base_dir=None):
     """Create the default config to work from.
 
@@ -66,11 +125,26 @@ def get_default_config(base_dir=None):
         "my_ip": "127.0.0.1",
         "schema_file": os.path.join(os.path.dirname(__file__), "data", "signing_task_schema.json"),
         "verbose": True,
-        "zipalign": "zipalign",
         "dmg": "dmg",
         "hfsplus": "hfsplus",
         "gpg_pubkey": None,
         "widevine_cert": None,
+        "max_concurrent_signings": 4,
+        "max_concurrent_signings_per_format": {},
+        "tarfile_compression_threads": 0,
+        "autograph_hash_batch_size": 20,
+        "autograph_hash_batch_linger": 0.05,
+        "autograph_pool_error_threshold": 3,
+        "autograph_pool_cooldown": 30.0,
+        "autograph_max_concurrent_requests": 16,
+        "autograph_connections_per_host": 8,
+        "autograph_keepalive_timeout": 30,
+        "autograph_dns_cache_ttl": 300,
+        "authenticode_signing_threads": 0,
+        "signed_content_cache_dir": None,
+        "dmg_python_extraction": True,
+        "signing_estimate": False,
+        "signing_dry_run": False,
     }
     return default_config
 
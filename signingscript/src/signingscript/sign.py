@@ -2,35 +2,45 @@
 """Signingscript task functions."""
 import asyncio
 import base64
+import copy
 import difflib
 import fnmatch
 import glob
 import hashlib
+import io
 import json
 import logging
 import os
+import posixpath
 import re
 import resource
 import shutil
-import subprocess
+import struct
 import sys
 import tarfile
 import tempfile
 import time
 import zipfile
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial, wraps
 from io import BytesIO
 
+import aiohttp
 import mohawk
-import winsign.sign
+import winsign.osslsigncode
+import winsign.timestamp
+from mardor.format import extras_header, index_header, mar, mar_header, sigs_header
 from mardor.reader import MarReader
-from mardor.writer import add_signature_block
-from scriptworker.utils import get_single_item_from_sequence, makedirs, raise_future_exceptions, retry_async, rm
+from mardor.signing import make_dummy_signature, make_hasher, verify_signature
+from scriptworker.utils import calculate_sleep_time, get_single_item_from_sequence, makedirs, raise_future_exceptions, retry_async, rm
+from winsign.asn1 import ContentInfo, SignedData, der_decode, der_encode, get_signeddata, id_signedData, resign
 from winsign.crypto import load_pem_certs
 
-from signingscript import task, utils
-from signingscript.createprecomplete import generate_precomplete
-from signingscript.exceptions import SigningScriptError
+from signingscript import dmg, task, utils, zipalign
+from signingscript.createprecomplete import generate_precomplete, generate_precomplete_from_list
+from signingscript.exceptions import SigningScriptError, UnsupportedDmgError
 
 log = logging.getLogger(__name__)
 
@@ -45,7 +55,11 @@ sys.path.append(os.path.abspath(os.path.join(os.path.realpath(os.path.dirname(__
 
 from mozpack import mozjar  # noqa  # isort:skip
 
-_ZIP_ALIGNMENT = "4"  # Value must always be 4, based on https://developer.android.com/studio/command-line/zipalign.html
+# Number of input bytes to base64 encode at a time when streaming autograph
+# requests. This must be a multiple of 3, so blocks encode without padding.
+_AUTOGRAPH_CHUNK_SIZE = 3 * 2 ** 18
+
+_ZIP_ALIGNMENT = 4  # Value must always be 4, based on https://developer.android.com/studio/command-line/zipalign.html
 
 # Blessed files call the other widevine files.
 _WIDEVINE_BLESSED_FILENAMES = (
@@ -135,13 +149,236 @@ def get_autograph_config(autograph_configs, cert_type, signing_formats, raise_on
         An Autograph object
 
     """
-    for a in autograph_configs.get(cert_type, []):
-        if a and (set(a.formats) & set(signing_formats)):
-            return a
+    servers = get_autograph_servers(autograph_configs, cert_type, signing_formats, raise_on_empty=raise_on_empty)
+    return servers[0] if servers else None
+
+
+# get_autograph_servers {{{1
+def get_autograph_servers(autograph_configs, cert_type, signing_formats, raise_on_empty=False):
+    """Get every autograph config for given `signing_formats` and `cert_type`.
+
+    Args:
+        autograph_configs (dict of lists of lists): the contents of
+            `autograph_configs`.
+        cert_type (str): the certificate type - essentially signing level,
+            separating release vs nightly vs dep.
+        signing_formats (list): the signing formats the server needs to support
+        raise_on_empty (bool): flag to raise errors. Optional. Defaults to False.
+
+    Raises:
+        SigningScriptError: when no suitable signing server is found
+
+    Returns:
+        list: the matching Autograph objects, in config order
 
-    if raise_on_empty:
+    """
+    servers = [a for a in autograph_configs.get(cert_type, []) if a and (set(a.formats) & set(signing_formats))]
+    if not servers and raise_on_empty:
         raise SigningScriptError(f"No autograph config found with cert type {cert_type} and formats {signing_formats}")
-    return None
+    return servers
+
+
+# AutographPool {{{1
+def _autograph_server_key(server):
+    return (server.url, server.client_id)
+
+
+def _is_autograph_server_error(exc):
+    """Return True if `exc` says the server, rather than the request, is bad."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        # A 4xx is our fault, and would fail on any server; 429 is overload
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError, SigningScriptError))
+
+
+@dataclass
+class AutographServerStats:
+    """Health and latency of one autograph server."""
+
+    requests: int = 0
+    errors: int = 0
+    consecutive_errors: int = 0
+    in_flight: int = 0
+    latency: float = None
+    ejected_until: float = 0.0
+
+
+class AutographPool:
+    """Spread autograph requests over every server that can handle them.
+
+    Each request goes to the healthy server with the lowest expected wait:
+    its smoothed latency, times one more than the requests already in flight
+    to it. Servers with no latency yet go first, and ties go to the server
+    with the fewest requests. A server that fails `error_threshold` requests
+    in a row is ejected for `cooldown` seconds. When it comes back, a single
+    failure ejects it again until it has a success. If every server is
+    ejected, the one due back soonest is used anyway.
+
+    Retries go to a server the request hasn't tried yet, without sleeping,
+    and only back off once every healthy server has failed.
+
+    At most `max_concurrent_requests` requests go out at once, across all
+    servers; the rest wait their turn before a server is chosen for them.
+
+    Args:
+        error_threshold (int, optional): consecutive failures before a server
+            is ejected. Defaults to 3.
+        cooldown (float, optional): how long to eject a server for, in
+            seconds. Defaults to 30.
+        latency_weight (float, optional): how much the latest request counts
+            towards the smoothed latency. Defaults to 0.3.
+        max_concurrent_requests (int, optional): the most requests to have
+            in flight at once. If None, don't limit them. Defaults to None.
+
+    Attributes:
+        stats (dict): the AutographServerStats for each server, keyed by
+            url and client_id.
+
+    """
+
+    def __init__(self, error_threshold=3, cooldown=30.0, latency_weight=0.3, max_concurrent_requests=None):
+        """Initialize AutographPool."""
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.latency_weight = latency_weight
+        self.max_concurrent_requests = max_concurrent_requests
+        self.stats = {}
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests) if max_concurrent_requests else None
+
+    def get_stats(self, server):
+        """Get the AutographServerStats for `server`, creating them if need be."""
+        return self.stats.setdefault(_autograph_server_key(server), AutographServerStats())
+
+    def is_healthy(self, server):
+        """Return True unless `server` is ejected."""
+        return self.get_stats(server).ejected_until <= time.monotonic()
+
+    def choose(self, servers, exclude=()):
+        """Choose the server to send the next request to.
+
+        Args:
+            servers (list): the Autograph objects to choose from
+            exclude (set, optional): keys of servers to avoid, if any others
+                are left. Defaults to ().
+
+        Returns:
+            Autograph: the chosen server
+
+        """
+        candidates = [s for s in servers if _autograph_server_key(s) not in exclude] or list(servers)
+        healthy = [s for s in candidates if self.is_healthy(s)]
+        if not healthy:
+            return min(candidates, key=lambda s: self.get_stats(s).ejected_until)
+
+        def score(server):
+            stats = self.get_stats(server)
+            return ((stats.latency or 0.0) * (stats.in_flight + 1), stats.requests)
+
+        return min(healthy, key=score)
+
+    def record_success(self, server, elapsed):
+        """Record a request to `server` that succeeded after `elapsed` seconds."""
+        stats = self.get_stats(server)
+        stats.consecutive_errors = 0
+        if stats.latency is None:
+            stats.latency = elapsed
+        else:
+            stats.latency += self.latency_weight * (elapsed - stats.latency)
+
+    def record_failure(self, server):
+        """Record a failed request to `server`, ejecting it if it keeps failing."""
+        stats = self.get_stats(server)
+        stats.errors += 1
+        stats.consecutive_errors += 1
+        if stats.consecutive_errors >= self.error_threshold:
+            stats.ejected_until = time.monotonic() + self.cooldown
+            log.warning("Ejecting autograph server %s for %ss after %d failures in a row", server.url, self.cooldown, stats.consecutive_errors)
+
+    async def attempt(self, servers, func, tried):
+        """Make one attempt at a request, on the best server not in `tried`.
+
+        Args:
+            servers (list): the Autograph objects that can handle the request
+            func (function): an awaitable function taking the chosen server
+            tried (set): keys of the servers this request already tried. The
+                chosen server is added to it.
+
+        Returns:
+            object: the result of `func`
+
+        """
+        if self._semaphore is None:
+            return await self._attempt(servers, func, tried)
+        async with self._semaphore:
+            return await self._attempt(servers, func, tried)
+
+    async def _attempt(self, servers, func, tried):
+        server = self.choose(servers, exclude=tried)
+        tried.add(_autograph_server_key(server))
+        stats = self.get_stats(server)
+        stats.requests += 1
+        stats.in_flight += 1
+        start = time.monotonic()
+        try:
+            result = await func(server)
+        except Exception as e:
+            if _is_autograph_server_error(e):
+                self.record_failure(server)
+            raise
+        finally:
+            stats.in_flight -= 1
+        self.record_success(server, time.monotonic() - start)
+        return result
+
+    def _get_sleep_time(self, servers, tried, attempt, **kwargs):
+        if any(_autograph_server_key(s) not in tried and self.is_healthy(s) for s in servers):
+            return 0
+        return calculate_sleep_time(attempt, **kwargs)
+
+    async def call(self, servers, func, attempts=3, sleeptime_kwargs=None):
+        """Call `func` on a server from `servers`, failing over to others.
+
+        Args:
+            servers (list): the Autograph objects that can handle the request
+            func (function): an awaitable function taking the chosen server
+            attempts (int, optional): the most attempts to make. Defaults to 3.
+            sleeptime_kwargs (dict, optional): passed to
+                `calculate_sleep_time` when backing off. Defaults to None.
+
+        Raises:
+            Exception: the exception from the last attempt
+
+        Returns:
+            object: the result of `func`
+
+        """
+        tried = set()
+        return await retry_async(
+            self.attempt,
+            args=(servers, func, tried),
+            attempts=attempts,
+            sleeptime_callback=partial(self._get_sleep_time, servers, tried),
+            sleeptime_kwargs=sleeptime_kwargs,
+        )
+
+
+def get_autograph_pool(context):
+    """Get the AutographPool shared by every request in this task.
+
+    Args:
+        context (Context): the signing context
+
+    Returns:
+        AutographPool: the pool
+
+    """
+    if getattr(context, "autograph_pool", None) is None:
+        context.autograph_pool = AutographPool(
+            error_threshold=context.config.get("autograph_pool_error_threshold", 3),
+            cooldown=context.config.get("autograph_pool_cooldown", 30.0),
+            max_concurrent_requests=context.config.get("autograph_max_concurrent_requests"),
+        )
+    return context.autograph_pool
 
 
 # sign_file {{{1
@@ -293,7 +530,8 @@ async def sign_widevine_zip(context, orig_path, fmt):
     Extract the files to sign (see `_WIDEVINE_BLESSED_FILENAMES` and
     `_WIDEVINE_UNBLESSED_FILENAMES), skipping already-signed files.
     The blessed files should be signed with the `widevine_blessed` format.
-    Then append the sigfiles to the zipfile.
+    Regenerate `precomplete` from the member list, then add it and the
+    sigfiles to the zipfile.
 
     Args:
         context (Context): the signing context
@@ -313,22 +551,25 @@ async def sign_widevine_zip(context, orig_path, fmt):
     files_to_sign = _get_widevine_signing_files(all_files)
     log.debug("Widevine files to sign: %s", files_to_sign)
     if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
+        # Only extract the files to sign and `precomplete`; the member list is
+        # enough to regenerate `precomplete`
+        await _extract_zipfile(context, orig_path, files=list(files_to_sign) + _get_precomplete_members(all_files), tmp_dir=tmp_dir)
+        all_files = [os.path.join(tmp_dir, f) for f in all_files]
         tasks = []
+        sig_files = []
         # Sign the appropriate inner files
         for from_, fmt in files_to_sign.items():
             from_ = os.path.join(tmp_dir, from_)
             to = f"{from_}.sig"
             tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, "blessed" in fmt, to=to)))
             all_files.append(to)
+            sig_files.append(to)
         await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
         # Regenerate the `precomplete` file, which is used for cleanup before
         # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
+        precomplete = _run_generate_precomplete(context, tmp_dir, file_list=all_files)
+        # Only the sigfiles and `precomplete` changed; copy everything else as-is
+        await _update_zipfile(context, orig_path, sig_files + [precomplete], tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -337,13 +578,14 @@ async def sign_widevine_zip(context, orig_path, fmt):
 async def sign_widevine_tar(context, orig_path, fmt):
     """Sign the internals of a tarfile with the widevine key.
 
-    Extract the entire tarball, but only sign a handful of files (see
-    `_WIDEVINE_BLESSED_FILENAMES` and `_WIDEVINE_UNBLESSED_FILENAMES).
+    Extract only the handful of files to sign (see `_WIDEVINE_BLESSED_FILENAMES`
+    and `_WIDEVINE_UNBLESSED_FILENAMES), and `precomplete`.
     The blessed files should be signed with the `widevine_blessed` format.
-    Then recreate the tarball.
+    Regenerate `precomplete` from the member list, then recreate the tarball.
 
     Ideally we would be able to append the sigfiles to the original tarball,
-    but that's not possible with compressed tarballs.
+    but that's not possible with compressed tarballs, so the unchanged members
+    are streamed from the original instead.
 
     Args:
         context (Context): the signing context
@@ -360,19 +602,22 @@ async def sign_widevine_tar(context, orig_path, fmt):
     # speed over disk space.
     tmp_dir = tempfile.mkdtemp(prefix="wvtar", dir=context.config["work_dir"])
     # Get file list
-    all_files = await _get_tarfile_files(orig_path, compression)
+    # Links are listed too, so they get `remove` lines in `precomplete`
+    all_files = await _get_tarfile_files(orig_path, compression, include_dirs=True, include_links=True)
     files_to_sign = _get_widevine_signing_files(all_files)
     log.debug("Widevine files to sign: %s", files_to_sign)
     if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
+        # Only extract the files to sign and `precomplete`; the member list is
+        # enough to regenerate `precomplete`
+        await _extract_tarfile(context, orig_path, compression, files=list(files_to_sign) + _get_precomplete_members(all_files), tmp_dir=tmp_dir)
+        all_files = [os.path.join(tmp_dir, f) for f in all_files]
         tasks = []
+        sig_files = []
         # Sign the appropriate inner files
         for from_, fmt in files_to_sign.items():
             from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
+            # Don't try to sign directories or links
+            if os.path.islink(from_) or not os.path.isfile(from_):
                 continue
             # Move the sig location on mac. This should be noop on linux.
             to = _get_mac_sigpath(from_)
@@ -380,12 +625,12 @@ async def sign_widevine_tar(context, orig_path, fmt):
             makedirs(os.path.dirname(to))
             tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, "blessed" in fmt, to=to)))
             all_files.append(to)
+            sig_files.append(to)
         await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
         # Regenerate the `precomplete` file, which is used for cleanup before
         # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
+        precomplete = _run_generate_precomplete(context, tmp_dir, file_list=all_files)
+        await _update_tarfile(context, orig_path, sig_files + [precomplete], compression, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -424,7 +669,7 @@ async def sign_omnija_zip(context, orig_path, fmt):
 
     Extract the files to sign, then sign them with autograph, recreating the omni.ja
     from the original to preserve performance tweeks but adding signing info,
-    Then append the sigfiles to the zipfile.
+    Then replace them in the zipfile.
 
     Args:
         context (Context): the signing context
@@ -444,14 +689,16 @@ async def sign_omnija_zip(context, orig_path, fmt):
     files_to_sign = _get_omnija_signing_files(all_files)
     log.debug("Omnija files to sign: %s", files_to_sign)
     if files_to_sign:
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
+        await _extract_zipfile(context, orig_path, files=list(files_to_sign), tmp_dir=tmp_dir)
         tasks = []
+        signed_files = []
         # Sign the appropriate inner files
         for from_, fmt in files_to_sign.items():
             from_ = os.path.join(tmp_dir, from_)
             tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_)))
+            signed_files.append(from_)
         await raise_future_exceptions(tasks)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
+        await _update_zipfile(context, orig_path, signed_files, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -462,7 +709,7 @@ async def sign_omnija_tar(context, orig_path, fmt):
 
     Extract the files to sign, then sign them with autograph, recreating the omni.ja
     from the original to preserve performance tweeks but adding signing info.
-    Then recreate the tarball.
+    Then recreate the tarball, streaming the unchanged members from the original.
 
     Args:
         context (Context): the signing context
@@ -483,10 +730,9 @@ async def sign_omnija_tar(context, orig_path, fmt):
     files_to_sign = _get_omnija_signing_files(all_files)
     log.debug("Omnija files to sign: %s", files_to_sign)
     if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
+        await _extract_tarfile(context, orig_path, compression, files=list(files_to_sign), tmp_dir=tmp_dir)
         tasks = []
+        signed_files = []
         # Sign the appropriate inner files
         for from_, fmt in files_to_sign.items():
             from_ = os.path.join(tmp_dir, from_)
@@ -494,8 +740,9 @@ async def sign_omnija_tar(context, orig_path, fmt):
             if not os.path.isfile(from_):
                 continue
             tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_)))
+            signed_files.append(from_)
         await raise_future_exceptions(tasks)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
+        await _update_tarfile(context, orig_path, signed_files, compression, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -585,14 +832,36 @@ def _get_omnija_signing_files(file_list):
     return files
 
 
+# _get_precomplete_members {{{1
+def _get_precomplete_members(file_list):
+    """Return the archive members in `file_list` that are `precomplete` files."""
+    return [f for f in file_list if os.path.basename(f) == "precomplete"]
+
+
 # _run_generate_precomplete {{{1
-def _run_generate_precomplete(context, tmp_dir):
-    """Regenerate `precomplete` file with widevine sig paths for complete mar."""
+def _run_generate_precomplete(context, tmp_dir, file_list=None):
+    """Regenerate `precomplete` file with widevine sig paths for complete mar.
+
+    Args:
+        context (Context): the signing context
+        tmp_dir (str): the directory the archive was extracted to
+        file_list (list, optional): the paths, under `tmp_dir`, of every
+            member of the signed archive. If set, `precomplete` is generated
+            from this list, and only `precomplete` itself needs to have been
+            extracted. If None, walk `tmp_dir`. Defaults to None.
+
+    Returns:
+        str: the path to the `precomplete` file
+
+    """
     log.info("Generating `precomplete` file...")
     path = _ensure_one_precomplete(tmp_dir, "before")
     with open(path, "r") as fh:
         before = fh.readlines()
-    generate_precomplete(os.path.dirname(path))
+    if file_list is None:
+        generate_precomplete(os.path.dirname(path))
+    else:
+        generate_precomplete_from_list(os.path.dirname(path), file_list)
     path = _ensure_one_precomplete(tmp_dir, "after")
     with open(path, "r") as fh:
         after = fh.readlines()
@@ -602,6 +871,7 @@ def _run_generate_precomplete(context, tmp_dir):
         for line in difflib.ndiff(before, after):
             fh.write(line)
     utils.copy_to_dir(diff_path, context.config["artifact_dir"], target="public/logs/precomplete.diff")
+    return path
 
 
 # _ensure_one_precomplete {{{1
@@ -646,37 +916,42 @@ async def zip_align_apk(context, abs_to):
     This is necessary if the APK is uploaded to the Google Play Store.
     https://developer.android.com/studio/command-line/zipalign.html
 
+    The APK is only rewritten if it isn't aligned already.
+
     Args:
         context (Context): the signing context
         abs_to (str): the absolute path to the apk
 
     """
-    original_apk_location = abs_to
-    zipalign_executable_location = context.config["zipalign"]
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_apk_location = os.path.join(temp_dir, "aligned.apk")
-
-        zipalign_command = [zipalign_executable_location]
-        if context.config["verbose"] is True:
-            zipalign_command += ["-v"]
-
-        zipalign_command += [_ZIP_ALIGNMENT, original_apk_location, temp_apk_location]
-        await utils.execute_subprocess(zipalign_command)
-        shutil.move(temp_apk_location, abs_to)
-
-    log.info('"{}" has been zip aligned'.format(abs_to))
+    if await asyncio.get_event_loop().run_in_executor(None, zipalign.align_zip_file, abs_to, _ZIP_ALIGNMENT):
+        log.info('"{}" has been zip aligned'.format(abs_to))
+    else:
+        log.info('"{}" is already zip aligned'.format(abs_to))
 
 
 # _convert_dmg_to_tar_gz {{{1
 @time_async_function
 async def _convert_dmg_to_tar_gz(context, from_):
-    """Explode a dmg and tar up its contents. Return the relative tarball path."""
+    """Explode a dmg and tar up its contents. Return the relative tarball path.
+
+    Unless ``dmg_python_extraction`` is off, the HFS+ volume is read straight
+    out of the dmg and into the tarball. The ``dmg`` and ``hfsplus`` binaries
+    are used if that's off, or if the dmg uses something `signingscript.dmg`
+    can't read.
+
+    """
     work_dir = context.config["work_dir"]
     abs_from = os.path.join(work_dir, from_)
     # replace .dmg suffix with .tar.gz (case insensitive)
     to = re.sub(r"\.dmg$", ".tar.gz", from_, flags=re.I)
     abs_to = os.path.join(work_dir, to)
+    if context.config.get("dmg_python_extraction", True):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _write_dmg_to_tar_gz, context, abs_from, abs_to)
+            return to
+        except UnsupportedDmgError as e:
+            log.warning("Falling back to the dmg and hfsplus binaries for %s: %s", from_, e)
+            rm(abs_to)
     dmg_executable_location = context.config["dmg"]
     hfsplus_executable_location = context.config["hfsplus"]
 
@@ -693,10 +968,17 @@ async def _convert_dmg_to_tar_gz(context, from_):
     return to
 
 
+def _write_dmg_to_tar_gz(context, abs_from, abs_to):
+    with open(abs_from, "rb") as fh, _open_tarfile_for_writing(context, abs_to, "gz") as t:
+        dmg.write_dmg_to_tarfile(fh, t)
+
+
 # _get_zipfile_files {{{1
 @time_async_function
-async def _get_zipfile_files(from_):
+async def _get_zipfile_files(from_, sizes=False):
     with zipfile.ZipFile(from_, mode="r") as z:
+        if sizes:
+            return {info.filename: info.file_size for info in z.infolist()}
         files = z.namelist()
         return files
 
@@ -741,6 +1023,74 @@ async def _create_zipfile(context, to, files, tmp_dir=None, mode="w"):
         raise SigningScriptError(e)
 
 
+# _update_zipfile {{{1
+@time_async_function
+async def _update_zipfile(context, to, files, tmp_dir=None):
+    """Replace or add `files` in the zipfile `to`, leaving other members alone.
+
+    Members that aren't in `files` are raw-copied, local header and compressed
+    data, without being inflated and deflated again. Members in `files` are
+    compressed and written in place of the original, or appended if new. A new
+    central directory is then written.
+
+    Args:
+        context (Context): the signing context
+        to (str): the path to the zipfile to update
+        files (list): the paths of the new or changed files
+        tmp_dir (str, optional): the directory `files` are relative to. If
+            None, use `work_dir/unzipped`. Defaults to None.
+
+    Raises:
+        SigningScriptError: on failure
+
+    Returns:
+        str: the path to the zipfile
+
+    """
+    work_dir = context.config["work_dir"]
+    tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
+    changed = {os.path.relpath(f, tmp_dir): f for f in files}
+    fd, tmp_path = tempfile.mkstemp(prefix=".zip", dir=os.path.dirname(to) or None)
+    os.close(fd)
+    try:
+        log.info("Updating zipfile {} with {}...".format(to, sorted(changed)))
+        with zipfile.ZipFile(to, mode="r") as src, zipfile.ZipFile(tmp_path, mode="w", compression=zipfile.ZIP_DEFLATED) as dest:
+            # Each member runs from its local header to the next member, or
+            # to the central directory for the last one
+            offsets = sorted(info.header_offset for info in src.infolist()) + [src.start_dir]
+            member_ends = dict(zip(offsets, offsets[1:]))
+            for info in src.infolist():
+                if info.filename in changed:
+                    dest.write(changed.pop(info.filename), arcname=info.filename)
+                else:
+                    _copy_zip_member(src, dest, info, member_ends[info.header_offset])
+            for arcname, path in changed.items():
+                dest.write(path, arcname=arcname)
+        os.replace(tmp_path, to)
+        return to
+    except Exception as e:
+        rm(tmp_path)
+        raise SigningScriptError(e)
+
+
+def _copy_zip_member(src, dest, info, end):
+    """Raw-copy the zipfile member `info`, ending at offset `end`, from `src` to `dest`."""
+    new_info = copy.copy(info)
+    new_info.header_offset = dest.fp.tell()
+    src.fp.seek(info.header_offset)
+    remaining = end - info.header_offset
+    while remaining:
+        block = src.fp.read(min(remaining, _AUTOGRAPH_CHUNK_SIZE))
+        if not block:
+            raise SigningScriptError("Truncated zipfile member {}".format(info.filename))
+        dest.fp.write(block)
+        remaining -= len(block)
+    # Let ZipFile write the central directory entry, and any members after this one
+    dest.start_dir = dest.fp.tell()
+    dest.filelist.append(new_info)
+    dest.NameToInfo[new_info.filename] = new_info
+
+
 # _get_tarfile_compression {{{1
 def _get_tarfile_compression(compression):
     compression = compression.lstrip(".")
@@ -750,30 +1100,95 @@ def _get_tarfile_compression(compression):
 
 
 # _get_tarfile_files {{{1
+def _is_tarfile_dir_link(member, dirs, links):
+    """Whether symlink `member` points at a directory, like `os.walk` would say."""
+    seen = set()
+    while member.issym() and member.name not in seen:
+        seen.add(member.name)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(member.name), member.linkname))
+        if target in dirs:
+            return True
+        if target not in links:
+            return False
+        member = links[target]
+    return False
+
+
 @time_async_function
-async def _get_tarfile_files(from_, compression):
+async def _get_tarfile_files(from_, compression, include_dirs=False, include_links=False, sizes=False):
+    """List the members of a tarball.
+
+    Args:
+        from_ (str): the path to the tarball
+        compression (str): the tarball compression
+        include_dirs (bool, optional): include directories, with a trailing
+            `/`. Defaults to False.
+        include_links (bool, optional): include symlinks and hard links,
+            the way `os.walk` would list them once extracted: links to
+            directories get a trailing `/` if `include_dirs` is set, and
+            anything else is listed as a file. Defaults to False.
+        sizes (bool, optional): return a dict of member name to size.
+            Defaults to False.
+
+    Returns:
+        list or dict: the member names, or their sizes if `sizes` is set.
+
+    """
     compression = _get_tarfile_compression(compression)
-    with tarfile.open(from_, mode="r:{}".format(compression)) as t:
-        files = t.getmembers()
-        return [f.name for f in files if f.isfile()]
+    with tarfile.open(from_, mode="r|{}".format(compression)) as t:
+        files = []
+        dirs = set()
+        links = {}
+        for f in t:
+            if f.isfile():
+                files.append((f.name, f.size))
+            elif f.isdir():
+                dirs.add(posixpath.normpath(f.name))
+                if include_dirs:
+                    # Mark directories the way zipfile does
+                    files.append(("{}/".format(f.name.rstrip("/")), 0))
+            elif include_links and (f.issym() or f.islnk()):
+                links[posixpath.normpath(f.name)] = f
+        for member in links.values():
+            if _is_tarfile_dir_link(member, dirs, links):
+                if include_dirs:
+                    files.append(("{}/".format(member.name.rstrip("/")), 0))
+            else:
+                files.append((member.name, 0))
+        return dict(files) if sizes else [name for name, _ in files]
 
 
 # _extract_tarfile {{{1
 @time_async_function
-async def _extract_tarfile(context, from_, compression, tmp_dir=None):
+async def _extract_tarfile(context, from_, compression, files=None, tmp_dir=None):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
     compression = _get_tarfile_compression(compression)
+    log.debug("Extracting {} from {} to {}...".format(files or "all files", from_, tmp_dir))
     try:
-        files = []
+        extracted_files = []
         rm(tmp_dir)
         utils.mkdir(tmp_dir)
-        with tarfile.open(from_, mode="r:{}".format(compression)) as t:
-            t.extractall(path=tmp_dir)
-            for name in t.getnames():
-                path = os.path.join(tmp_dir, name)
-                os.path.isfile(path) and files.append(path)
-        return files
+        if files is not None:
+            wanted = set(files)
+            # Stream through the tarball once, stopping after the last member we want
+            with tarfile.open(from_, mode="r|{}".format(compression)) as t:
+                for member in t:
+                    if member.name in wanted:
+                        t.extract(member, path=tmp_dir)
+                        extracted_files.append(os.path.join(tmp_dir, member.name))
+                        wanted.remove(member.name)
+                        if not wanted:
+                            break
+            if wanted:
+                raise SigningScriptError("{} not found in {}".format(sorted(wanted), from_))
+        else:
+            with tarfile.open(from_, mode="r:{}".format(compression)) as t:
+                t.extractall(path=tmp_dir)
+                for name in t.getnames():
+                    path = os.path.join(tmp_dir, name)
+                    os.path.isfile(path) and extracted_files.append(path)
+        return extracted_files
     except Exception as e:
         raise SigningScriptError(e)
 
@@ -788,6 +1203,34 @@ def _owner_filter(tarinfo_obj):
     return tarinfo_obj
 
 
+# _open_tarfile_for_writing {{{1
+@contextmanager
+def _open_tarfile_for_writing(context, to, compression):
+    """Open the tarfile `to` for writing, compressing on multiple threads.
+
+    `tarfile_compression_threads` sets the number of threads; 0 means one per
+    cpu. With a single thread, let `tarfile` compress as usual.
+
+    Args:
+        context (Context): the signing context
+        to (str): the path to the tarfile to write
+        compression (str): the compression format, `gz` or `bz2`
+
+    Yields:
+        tarfile.TarFile: the open tarfile
+
+    """
+    threads = context.config.get("tarfile_compression_threads", 0) or os.cpu_count() or 1
+    if threads == 1:
+        with tarfile.open(to, mode="w:{}".format(compression)) as t:
+            yield t
+    else:
+        log.debug("Compressing {} with {} threads".format(to, threads))
+        with open(to, "wb") as fh, utils.ParallelCompressor(fh, compression, threads) as compressor:
+            with tarfile.open(fileobj=compressor, mode="w|") as t:
+                yield t
+
+
 # _create_tarfile {{{1
 @time_async_function
 async def _create_tarfile(context, to, files, compression, tmp_dir=None):
@@ -796,7 +1239,7 @@ async def _create_tarfile(context, to, files, compression, tmp_dir=None):
     compression = _get_tarfile_compression(compression)
     try:
         log.info("Creating tarfile {}...".format(to))
-        with tarfile.open(to, mode="w:{}".format(compression)) as t:
+        with _open_tarfile_for_writing(context, to, compression) as t:
             for f in files:
                 relpath = os.path.relpath(f, tmp_dir)
                 t.add(f, arcname=relpath, filter=_owner_filter)
@@ -805,33 +1248,326 @@ async def _create_tarfile(context, to, files, compression, tmp_dir=None):
         raise SigningScriptError(e)
 
 
-def write_signing_req_to_disk(fp, signing_req):
-    """Write signing_req to fp.
+# _update_tarfile {{{1
+@time_async_function
+async def _update_tarfile(context, to, files, compression, tmp_dir=None):
+    """Replace or add `files` in the tarfile `to`, leaving other members alone.
+
+    A compressed tarball can't be updated in place, so it's rewritten, but
+    members that aren't in `files` are streamed from the original rather than
+    extracted to disk first. Members in `files` are read from `tmp_dir` in
+    place of the original, or appended if new. All members go through
+    `_owner_filter`.
+
+    Args:
+        context (Context): the signing context
+        to (str): the path to the tarfile to update
+        files (list): the paths of the new or changed files
+        compression (str): the compression format, `gz` or `bz2`
+        tmp_dir (str, optional): the directory `files` are relative to. If
+            None, use `work_dir/untarred`. Defaults to None.
+
+    Raises:
+        SigningScriptError: on failure
+
+    Returns:
+        str: the path to the tarfile
+
+    """
+    work_dir = context.config["work_dir"]
+    tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
+    compression = _get_tarfile_compression(compression)
+    changed = {os.path.relpath(f, tmp_dir): f for f in files}
+    fd, tmp_path = tempfile.mkstemp(prefix=".tar", dir=os.path.dirname(to) or None)
+    os.close(fd)
+    try:
+        log.info("Updating tarfile {} with {}...".format(to, sorted(changed)))
+        with tarfile.open(to, mode="r|{}".format(compression)) as src, _open_tarfile_for_writing(context, tmp_path, compression) as dest:
+            for member in src:
+                path = changed.pop(os.path.normpath(member.name), None)
+                if path is not None:
+                    dest.add(path, arcname=member.name, filter=_owner_filter)
+                elif member.isfile():
+                    dest.addfile(_owner_filter(member), src.extractfile(member))
+                else:
+                    dest.addfile(_owner_filter(member))
+            for arcname, path in changed.items():
+                dest.add(path, arcname=arcname, filter=_owner_filter)
+        os.replace(tmp_path, to)
+        return to
+    except Exception as e:
+        rm(tmp_path)
+        raise SigningScriptError(e)
+
+
+# AutographRequestBody {{{1
+class AutographRequestBody(io.RawIOBase):
+    """A read-only, streaming JSON body for an autograph signing request.
+
+    File-like values in the signing request are base64 encoded on the fly, in
+    blocks of `chunk_size` input bytes, so the request is never written to
+    disk or held in memory as a whole. `chunk_size` must be a multiple of 3,
+    so each block encodes without padding.
+
+    Rewinding with ``seek(0)`` restarts the encoding from the beginning of
+    every file-like value, which lets us hash the body and then upload it,
+    and retry the upload, without buffering it.
+
+    Attributes:
+        size (int): the total size of the encoded body, in bytes.
 
-    Does proper base64 and json encoding.
-    Tries not to hold onto a lot of memory.
     """
-    fp.write(b"[{")
-    for k, v in signing_req.items():
-        fp.write(json.dumps(k).encode("utf8"))
-        fp.write(b":")
-        if hasattr(v, "read"):
+
+    def __init__(self, sign_req, chunk_size=_AUTOGRAPH_CHUNK_SIZE):
+        """Initialize AutographRequestBody.
+
+        Args:
+            sign_req (dict or list): the signing request, as from
+                `make_signing_req`, or a list of them to sign in one request
+            chunk_size (int, optional): the number of input bytes to encode at
+                a time. Defaults to `_AUTOGRAPH_CHUNK_SIZE`.
+
+        Raises:
+            SigningScriptError: if `chunk_size` isn't a multiple of 3
+
+        """
+        super().__init__()
+        if chunk_size <= 0 or chunk_size % 3:
+            raise SigningScriptError(f"chunk_size must be a positive multiple of 3; got {chunk_size}")
+        self._chunk_size = chunk_size
+        self._parts = []
+        if isinstance(sign_req, dict):
+            sign_req = [sign_req]
+        literal = b"["
+        for i, req in enumerate(sign_req):
+            literal += b",{" if i else b"{"
+            for j, (k, v) in enumerate(req.items()):
+                if j:
+                    literal += b","
+                literal += json.dumps(k).encode("utf8") + b":"
+                if hasattr(v, "read"):
+                    self._parts.append(literal + b'"')
+                    self._parts.append(v)
+                    literal = b'"'
+                else:
+                    literal += json.dumps(v).encode("utf8")
+            literal += b"}"
+        self._parts.append(literal + b"]")
+        self.size = sum(len(part) if isinstance(part, bytes) else _get_base64_size(part) for part in self._parts)
+        self.seek(0)
+
+    def readable(self):
+        """Return True; the body is readable."""
+        return True
+
+    def seekable(self):
+        """Return True; the body can be rewound with ``seek(0)``."""
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Rewind the body to the beginning.
+
+        Raises:
+            io.UnsupportedOperation: on any seek other than ``seek(0)``
+
+        """
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("AutographRequestBody only supports seek(0)")
+        self._chunks = self._iter_chunks()
+        self._buffer = b""
+        self._offset = 0
+        self._position = 0
+        return 0
+
+    def tell(self):
+        """Return the current position in the body."""
+        return self._position
+
+    def read(self, size=-1):
+        """Read up to `size` bytes of the body.
+
+        Only one encoded chunk is returned at a time, so a large `size` never
+        joins chunks together.
+
+        Args:
+            size (int, optional): the maximum number of bytes to read. If
+                negative, read the rest of the body. Defaults to -1.
+
+        Returns:
+            bytes: the next part of the body; empty at the end of the body.
+
+        """
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(self._chunk_size), b""))
+        if self._offset >= len(self._buffer):
+            self._buffer = next(self._chunks, b"")
+            self._offset = 0
+        data = self._buffer[self._offset : self._offset + size]
+        self._offset += len(data)
+        self._position += len(data)
+        return data
+
+    def readinto(self, b):
+        """Read into the pre-allocated bytes-like object `b`."""
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def _iter_chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
             # Make sure we're always reading from the beginning of the file
             # Sometimes we have to retry the request
-            v.seek(0)
-            fp.write(b'"')
+            part.seek(0)
             while True:
-                block = v.read(1020)
+                block = part.read(self._chunk_size)
+                # Short reads would add padding mid-stream; top the block up to
+                # a multiple of 3
+                while block and len(block) % 3:
+                    more = part.read(3 - len(block) % 3)
+                    if not more:
+                        break
+                    block += more
                 if not block:
                     break
-                e = b64encode(block).encode("utf8")
-                fp.write(e)
-            fp.write(b'"')
-        else:
-            fp.write(json.dumps(v).encode("utf8"))
-        fp.write(b",")
-    fp.seek(-1, 1)
-    fp.write(b"}]")
+                yield base64.b64encode(block)
+
+
+def _get_base64_size(fh):
+    """Return the size of the base64 encoding of the file-like object `fh`."""
+    fh.seek(0, io.SEEK_END)
+    size = fh.tell()
+    fh.seek(0)
+    return (size + 2) // 3 * 4
+
+
+# SignedFileResponseParser {{{1
+class SignedFileResponseParser:
+    """Incrementally parse an autograph /sign/file response.
+
+    The base64 ``signed_file`` value is decoded and written to `fh` as the
+    response is fed in, so only the rest of the response, which is small, is
+    ever held in memory. The ``signed_file`` value is left as an empty string
+    in the parsed response.
+
+    """
+
+    _WHITESPACE = b" \t\r\n"
+
+    def __init__(self, fh, key="signed_file"):
+        """Initialize SignedFileResponseParser.
+
+        Args:
+            fh (file object): the binary file to write the decoded value to
+            key (str, optional): the key whose value to write to `fh`.
+                Defaults to ``signed_file``.
+
+        """
+        self._fh = fh
+        self._key = key.encode("utf8")
+        # The response without the streamed value
+        self._rest = bytearray()
+        # The string being parsed; only kept for strings outside the streamed value
+        self._string = bytearray()
+        self._last_string = None
+        self._pending_key = None
+        self._in_string = False
+        self._escape = False
+        self._streaming = False
+        # Base64 characters left over from the last feed, if not a multiple of 4
+        self._b64_remainder = b""
+        self.found = False
+        self.bytes_written = 0
+
+    def feed(self, data):
+        """Parse the next chunk of the response.
+
+        Args:
+            data (bytes): the next chunk of the response
+
+        """
+        i = 0
+        while i < len(data):
+            if self._streaming:
+                end = data.find(b'"', i)
+                self._write_b64(data[i:] if end < 0 else data[i:end])
+                if end < 0:
+                    break
+                self._streaming = False
+                self._rest += b'"'
+                i = end + 1
+            elif self._in_string:
+                i = self._feed_string(data, i)
+            else:
+                c = data[i : i + 1]
+                self._rest += c
+                i += 1
+                if c == b'"':
+                    if self._pending_key == self._key:
+                        self._streaming = self.found = True
+                    else:
+                        self._in_string = True
+                        self._string = bytearray()
+                    self._pending_key = None
+                elif c == b":":
+                    self._pending_key = self._last_string
+                elif c not in self._WHITESPACE:
+                    self._pending_key = None
+
+    def _feed_string(self, data, i):
+        if self._escape:
+            self._escape = False
+            self._string += data[i : i + 1]
+            self._rest += data[i : i + 1]
+            return i + 1
+        end = len(data)
+        for special in (b'"', b"\\"):
+            found = data.find(special, i, end)
+            if found >= 0:
+                end = found
+        self._string += data[i:end]
+        self._rest += data[i:end]
+        if end < len(data):
+            self._rest += data[end : end + 1]
+            if data[end : end + 1] == b"\\":
+                self._escape = True
+            else:
+                self._in_string = False
+                self._last_string = bytes(self._string)
+        return end + 1
+
+    def _write_b64(self, data):
+        # base64 has no characters that need escaping, but JSON encoders may
+        # still escape `/` as `\/`
+        data = self._b64_remainder + data.replace(b"\\", b"")
+        aligned = len(data) - len(data) % 4
+        self._b64_remainder = data[aligned:]
+        if aligned:
+            decoded = base64.b64decode(data[:aligned])
+            self._fh.write(decoded)
+            self.bytes_written += len(decoded)
+
+    def close(self):
+        """Finish parsing the response.
+
+        Raises:
+            SigningScriptError: if the response is incomplete, doesn't contain
+                the key, or isn't valid json
+
+        Returns:
+            object: the parsed response, without the streamed value.
+
+        """
+        if not self.found:
+            raise SigningScriptError(f"No {self._key.decode('utf8')} in autograph response")
+        if self._streaming or self._b64_remainder:
+            raise SigningScriptError("Incomplete autograph response")
+        try:
+            return json.loads(bytes(self._rest))
+        except ValueError as e:
+            raise SigningScriptError(f"Invalid autograph response: {e}")
 
 
 def get_hawk_content_hash(request_body, content_type):
@@ -841,7 +1577,7 @@ def get_hawk_content_hash(request_body, content_type):
     h.update(content_type.encode("utf8"))
     h.update(b"\n")
     while True:
-        block = request_body.read(1024)
+        block = request_body.read(2 ** 20)
         if not block:
             break
         h.update(block)
@@ -860,32 +1596,75 @@ def get_hawk_header(url, user, password, content_type, content_hash):
 
 
 @time_async_function
-async def call_autograph(session, url, user, password, sign_req):
-    """Call autograph and return the json response."""
-    content_type = "application/json"
+async def call_autograph(session, url, user, password, sign_req, to=None):
+    """Call autograph and return the json response.
 
-    request_body = tempfile.TemporaryFile("w+b")
-    write_signing_req_to_disk(request_body, sign_req)
-    request_body.seek(0)
+    Args:
+        session (aiohttp.ClientSession): client session object
+        url (str): the autograph endpoint to call
+        user (str): the hawk user
+        password (str): the hawk password
+        sign_req (dict or list): the signing request, as from
+            `make_signing_req`, or a list of them
+        to (str, optional): if set, stream the ``signed_file`` in the response
+            to this path, rather than returning it in the response. Defaults
+            to None.
+
+    Returns:
+        list: the json response
 
+    """
+    content_type = "application/json"
+
+    request_body = AutographRequestBody(sign_req)
     content_hash = get_hawk_content_hash(request_body, content_type)
 
     auth_header = get_hawk_header(url, user, password, content_type, content_hash)
 
-    request_body.seek(0, 2)
-    req_size = request_body.tell()
+    req_size = request_body.size
     log.debug("req_size: %s", req_size)
     request_body.seek(0)
 
     resp = await session.post(url, data=request_body, headers={"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)})
     log.debug("Autograph response: %s", resp.status)
     resp.raise_for_status()
-    # TODO: Write this out to temporary file. The responses can be large,
-    # especially in the case of APK/omnija signing where the entire file is
-    # being sent and returned.
+    if to:
+        return await write_signed_file_response(resp, to)
     return await resp.json()
 
 
+# write_signed_file_response {{{1
+@time_async_function
+async def write_signed_file_response(resp, to):
+    """Stream the ``signed_file`` in an autograph response to `to`.
+
+    The signed file is decoded into a temporary file next to `to`, which only
+    replaces `to` once the whole response has been read. `to` may be the file
+    being uploaded, and a failed attempt must not clobber it before a retry.
+
+    Args:
+        resp (aiohttp.ClientResponse): the autograph response
+        to (str): the path to write the signed file to
+
+    Returns:
+        list: the json response, with an empty ``signed_file``
+
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=".signed", dir=os.path.dirname(to) or None)
+    try:
+        with open(fd, "wb") as fh:
+            parser = SignedFileResponseParser(fh)
+            async for chunk in resp.content.iter_chunked(_AUTOGRAPH_CHUNK_SIZE):
+                parser.feed(chunk)
+            sign_resp = parser.close()
+        os.replace(tmp_path, to)
+    except BaseException:
+        rm(tmp_path)
+        raise
+    log.debug("Wrote %d signed bytes to %s; RSS:%s", parser.bytes_written, to, get_rss())
+    return sign_resp
+
+
 def b64encode(input_bytes):
     """Return a base64 encoded string."""
     return base64.b64encode(input_bytes).decode("ascii")
@@ -928,40 +1707,48 @@ def make_signing_req(input_file, fmt, keyid=None, extension_id=None):
 
 
 @time_async_function
-async def sign_with_autograph(session, server, input_file, fmt, autograph_method, keyid=None, extension_id=None):
+async def sign_with_autograph(session, server, input_file, fmt, autograph_method, keyid=None, extension_id=None, to=None, pool=None):
     """Signs data with autograph and returns the result.
 
     Args:
         session (aiohttp.ClientSession): client session object
-        server (Autograph): the server to connect to sign
+        server (Autograph or list): the server to connect to sign, or a list
+                                    of servers to spread requests over
         input_file (file object): the source data to sign
         fmt (str): the format to sign with
         autograph_method (str): which autograph method to use to sign. must be
                                 one of 'file', 'hash', or 'data'
         keyid (str): which key to use on autograph (optional)
         extension_id (str): which id to send to autograph for the extension (optional)
+        to (str): for the 'file' method, stream the signed file to this path
+                  rather than returning it (optional)
+        pool (AutographPool): the pool to choose servers from, so health is
+                              tracked across requests (optional)
 
     Raises:
         aiohttp.ClientError: on failure
         SigningScriptError: when no suitable signing server is found for fmt
 
     Returns:
-        bytes: the signed data
+        bytes: the signed data, or `to` if specified
 
     """
     if autograph_method not in {"file", "hash", "data"}:
         raise SigningScriptError(f"Unsupported autograph method: {autograph_method}")
 
-    keyid = keyid or server.key_id
-    sign_req = make_signing_req(input_file, fmt, keyid, extension_id)
+    servers = server if isinstance(server, list) else [server]
+    pool = pool or AutographPool()
 
-    url = f"{server.url}/sign/{autograph_method}"
+    async def call(server):
+        sign_req = make_signing_req(input_file, fmt, keyid or server.key_id, extension_id)
+        url = f"{server.url}/sign/{autograph_method}"
+        return await call_autograph(session, url, server.client_id, server.access_key, sign_req, to=to)
 
-    sign_resp = await retry_async(
-        call_autograph, args=(session, url, server.client_id, server.access_key, sign_req), attempts=3, sleeptime_kwargs={"delay_factor": 2.0}
-    )
+    sign_resp = await pool.call(servers, call, attempts=3, sleeptime_kwargs={"delay_factor": 2.0})
 
-    if autograph_method == "file":
+    if to:
+        return to
+    elif autograph_method == "file":
         return sign_resp[0]["signed_file"]
     else:
         return sign_resp[0]["signature"]
@@ -987,13 +1774,10 @@ async def sign_file_with_autograph(context, from_, fmt, to=None, extension_id=No
         str: the path to the signed file
 
     """
-    cert_type = task.task_cert_type(context)
-    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    servers = task.get_signing_plan(context).get(fmt).get_servers()
     to = to or from_
-    input_file = open(from_, "rb")
-    signed_bytes = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "file", extension_id=extension_id))
-    with open(to, "wb") as fout:
-        fout.write(signed_bytes)
+    with open(from_, "rb") as input_file:
+        await sign_with_autograph(context.session, servers, input_file, fmt, "file", extension_id=extension_id, to=to, pool=get_autograph_pool(context))
     return to
 
 
@@ -1014,11 +1798,10 @@ async def sign_gpg_with_autograph(context, from_, fmt, **kwargs):
         list: the path to the signed file, and sig.
 
     """
-    cert_type = task.task_cert_type(context)
-    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    servers = task.get_signing_plan(context).get(fmt).get_servers()
     to = f"{from_}.asc"
     input_file = open(from_, "rb")
-    signature = await sign_with_autograph(context.session, a, input_file, fmt, "data")
+    signature = await sign_with_autograph(context.session, servers, input_file, fmt, "data", pool=get_autograph_pool(context))
     with open(to, "w") as fout:
         fout.write(signature)
     return [from_, to]
@@ -1042,13 +1825,142 @@ async def sign_hash_with_autograph(context, hash_, fmt, keyid=None):
         bytes: the signature
 
     """
-    cert_type = task.task_cert_type(context)
-    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    servers = task.get_signing_plan(context).get(fmt).get_servers()
+    if context.config.get("autograph_hash_batch_size", 1) > 1:
+        batcher = _get_autograph_batcher(context, servers, fmt, "hash", keyid)
+        return base64.b64decode(await batcher.sign(hash_))
     input_file = BytesIO(hash_)
-    signature = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "hash", keyid))
+    signature = base64.b64decode(await sign_with_autograph(context.session, servers, input_file, fmt, "hash", keyid, pool=get_autograph_pool(context)))
     return signature
 
 
+# AutographBatcher {{{1
+class AutographBatcher:
+    """Coalesce concurrent signing requests into batched autograph requests.
+
+    Autograph's ``/sign/hash`` and ``/sign/data`` endpoints take a list of
+    inputs. Calls to `sign` wait up to `linger` seconds for other calls to
+    join them, then all go in one request; the signatures are handed back to
+    each caller in order. A batch is sent as soon as it has `batch_size`
+    inputs. If the request fails after retries, every caller in the batch
+    gets the exception.
+
+    Args:
+        session (aiohttp.ClientSession): client session object
+        servers (list): the Autograph servers to sign with
+        fmt (str): the format to sign with
+        autograph_method (str): `hash` or `data`
+        keyid (str): which key to use on autograph. If None, use each
+            server's `key_id`.
+        batch_size (int): the most inputs to send in one request
+        linger (float): how long to wait for a batch to fill, in seconds
+        pool (AutographPool, optional): the pool to choose servers from.
+            Defaults to a new one.
+
+    """
+
+    def __init__(self, session, servers, fmt, autograph_method, keyid, batch_size, linger, pool=None):
+        """Initialize AutographBatcher."""
+        self.session = session
+        self.servers = servers
+        self.fmt = fmt
+        self.autograph_method = autograph_method
+        self.keyid = keyid
+        self.batch_size = batch_size
+        self.linger = linger
+        self.pool = pool or AutographPool()
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def sign(self, input_bytes):
+        """Sign `input_bytes` as part of the next batch.
+
+        Args:
+            input_bytes (bytes): the data to sign
+
+        Raises:
+            aiohttp.ClientError: on failure
+            SigningScriptError: on a malformed response
+
+        Returns:
+            str: the base64 encoded signature
+
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((input_bytes, future))
+        if len(self._pending) >= self.batch_size:
+            self._send()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.linger, self._send)
+        return await future
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        task_ = asyncio.ensure_future(self._sign_batch(batch))
+        # Hold a reference until it's done, so it isn't garbage collected
+        self._tasks.add(task_)
+        task_.add_done_callback(self._tasks.discard)
+
+    async def _call(self, batch, server):
+        url = f"{server.url}/sign/{self.autograph_method}"
+        log.debug("Signing a batch of %d with %s", len(batch), url)
+        sign_reqs = [make_signing_req(BytesIO(input_bytes), self.fmt, self.keyid or server.key_id) for input_bytes, _ in batch]
+        return await call_autograph(self.session, url, server.client_id, server.access_key, sign_reqs)
+
+    @time_async_function
+    async def _sign_batch(self, batch):
+        try:
+            sign_resp = await self.pool.call(self.servers, partial(self._call, batch), attempts=3, sleeptime_kwargs={"delay_factor": 2.0})
+            if len(sign_resp) != len(batch):
+                raise SigningScriptError(f"Sent autograph {len(batch)} inputs, but got {len(sign_resp)} signatures back")
+            for (_, future), resp in zip(batch, sign_resp):
+                if not future.done():
+                    future.set_result(resp["signature"])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+
+def _get_autograph_batcher(context, servers, fmt, autograph_method, keyid):
+    """Get the task's batcher for a set of servers, format, method and keyid.
+
+    Args:
+        context (Context): the signing context
+        servers (list): the Autograph servers to sign with
+        fmt (str): the format to sign with
+        autograph_method (str): `hash` or `data`
+        keyid (str): which key to use on autograph (can be None)
+
+    Returns:
+        AutographBatcher: the batcher, shared by every step in this task.
+
+    """
+    if not hasattr(context, "autograph_batchers"):
+        context.autograph_batchers = {}
+    key = (tuple(_autograph_server_key(s) for s in servers), fmt, autograph_method, keyid)
+    if key not in context.autograph_batchers:
+        context.autograph_batchers[key] = AutographBatcher(
+            context.session,
+            servers,
+            fmt,
+            autograph_method,
+            keyid,
+            batch_size=context.config["autograph_hash_batch_size"],
+            linger=context.config.get("autograph_hash_batch_linger", 0.05),
+            pool=get_autograph_pool(context),
+        )
+    return context.autograph_batchers[key]
+
+
 def get_mar_verification_key(cert_type, fmt, keyid):
     """Get the public key file for the format/cert_type.
 
@@ -1094,20 +2006,108 @@ def verify_mar_signature(cert_type, fmt, mar, keyid=None):
 
     """
     mar_verify_key = get_mar_verification_key(cert_type, fmt, keyid)
-    try:
-        mar_path = os.path.join(os.path.dirname(sys.executable), "mar")
-        cmd = [mar_path, "-k", mar_verify_key, "-v", mar]
-        log.info("Running %s", cmd)
-        subprocess.check_call(cmd, stdout=sys.stdout, stderr=sys.stderr)
-        log.info("Verified signature.")
-    except subprocess.CalledProcessError as e:
-        raise SigningScriptError(e)
+    log.info("Verifying %s with %s", mar, mar_verify_key)
+    with open(mar_verify_key, "rb") as fh:
+        public_key = fh.read()
+    with open(mar, "rb") as fh, MarReader(fh) as m:
+        if not m.verify(public_key):
+            raise SigningScriptError("{} doesn't verify with {}".format(mar, mar_verify_key))
+    log.info("Verified signature.")
+
+
+def verify_mar_hash_signature(cert_type, fmt, mar_hash, signature, hash_algo, keyid=None):
+    """Verify a mar hash signature against the public key, in-process.
+
+    Args:
+        cert_type (str): the cert scope string
+        fmt (str): the signing format
+        mar_hash (bytes): the hash of the mar's signature data
+        signature (bytes): the signature of `mar_hash`
+        hash_algo (str): the hash algorithm, `sha1` or `sha384`
+        keyid (str, optional): the key id to use (can be None)
+
+    Raises:
+        SigningScriptError: if the signature doesn't verify, or the nick isn't found
+
+    """
+    mar_verify_key = get_mar_verification_key(cert_type, fmt, keyid)
+    with open(mar_verify_key, "rb") as fh:
+        public_key = fh.read()
+    if not verify_signature(public_key, signature, mar_hash, hash_algo):
+        raise SigningScriptError("mar hash signature doesn't verify with {}".format(mar_verify_key))
+    log.info("Verified signature with %s.", mar_verify_key)
+
+
+# write_mar_with_signature_block {{{1
+def write_mar_with_signature_block(src, dest, hash_algo):
+    """Copy a mar, with a single dummy signature, and hash it in the same pass.
+
+    This does what mardor's ``add_signature_block`` followed by
+    ``MarReader.calculate_hashes`` do, but reads the file data once: the new
+    layout is worked out from the headers and index up front, so each block
+    can be hashed as it's written. The dummy signature has the same size as
+    a real one, and the signature bytes aren't covered by the hash, so the
+    signature can be written over it afterwards.
+
+    Args:
+        src (file): the mar to read, open in binary mode
+        dest (file): the file to write to, open in binary mode
+        hash_algo (str): the hash algorithm, `sha1` or `sha384`
+
+    Returns:
+        tuple: (bytes, int), the hash to sign, and the offset of the
+            signature in `dest`
+
+    """
+    algo_id = {"sha1": 1, "sha384": 2}[hash_algo]
+    signature = make_dummy_signature(algo_id)
+    src.seek(0)
+    mardata = mar.parse_stream(src)
+
+    # Work out where everything goes; see mardor's add_signature_block
+    sigs = dict(filesize=0, count=1, sigs=[dict(algorithm_id=algo_id, size=len(signature), signature=signature)])
+    sigs_size = len(sigs_header.build(sigs))
+    extras = extras_header.build(mardata.additional)
+    data_offset = mar_header.sizeof() + sigs_size + len(extras)
+    for e in mardata.index.entries:
+        e.offset += data_offset - mardata.data_offset
+    index = index_header.build(mardata.index)
+    mardata.header.index_offset = data_offset + mardata.data_length
+    sigs["filesize"] = mardata.header.index_offset + len(index)
+    header = mar_header.build(mardata.header)
+
+    # Everything but the signature itself is covered; see mardor's get_signature_data
+    h = make_hasher(algo_id)
+    h.update(header)
+    h.update(struct.pack(">QI", sigs["filesize"], 1))
+    h.update(struct.pack(">II", algo_id, len(signature)))
+    dest.write(header)
+    dest.write(sigs_header.build(sigs))
+    signature_offset = dest.tell() - len(signature)
+    h.update(extras)
+    dest.write(extras)
+    src.seek(mardata.data_offset)
+    remaining = mardata.data_length
+    while remaining:
+        block = src.read(min(remaining, utils.HASH_CHUNK_SIZE))
+        if not block:
+            raise SigningScriptError("Truncated mar data")
+        h.update(block)
+        dest.write(block)
+        remaining -= len(block)
+    h.update(index)
+    dest.write(index)
+    return h.finalize(), signature_offset
 
 
 @time_async_function
 async def sign_mar384_with_autograph_hash(context, from_, fmt, to=None, **kwargs):
     """Signs a hash with autograph, injects it into the file, and writes the result to arg `to` or `from_` if `to` is None.
 
+    `from_` is read once, while it's copied to a temporary file next to `to`
+    and hashed. The signature is then verified against the hash and written
+    into the temporary file, which replaces `to`.
+
     Args:
         context (Context): the signing context
         from_ (str): the source file to sign
@@ -1123,44 +2123,37 @@ async def sign_mar384_with_autograph_hash(context, from_, fmt, to=None, **kwargs
         str: the path to the signed file
 
     """
-    cert_type = task.task_cert_type(context)
+    plan_entry = task.get_signing_plan(context).get(fmt)
     # Get any key id that the task may have specified
-    fmt, keyid = utils.split_autograph_format(fmt)
+    cert_type, fmt, keyid = plan_entry.cert_type, plan_entry.fmt, plan_entry.keyid
     # Call to check that we have a server available
-    get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    plan_entry.get_servers()
 
     hash_algo, expected_signature_length = "sha384", 512
 
-    # Add a dummy signature into a temporary file (TODO: dedup with mardor.cli do_hash)
-    with tempfile.TemporaryFile() as tmp:
-        with open(from_, "rb") as f:
-            add_signature_block(f, tmp, hash_algo)
-
-        tmp.seek(0)
-
-        with MarReader(tmp) as m:
-            hashes = m.calculate_hashes()
-        h = hashes[0][1]
-
-    signature = await sign_hash_with_autograph(context, h, fmt, keyid)
-
-    # Add a signature to the MAR file (TODO: dedup with mardor.cli do_add_signature)
-    if len(signature) != expected_signature_length:
-        raise SigningScriptError(
-            "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(hash_algo, len(signature), expected_signature_length)
-        )
-
-    # use the tmp file in case param `to` is `from_` which causes stream errors
-    tmp_dst = tempfile.NamedTemporaryFile(mode="w+b", delete=False)
-    with open(tmp_dst.name, "w+b") as dst:
-        with open(from_, "rb") as src:
-            add_signature_block(src, dst, hash_algo, signature)
-
     to = to or from_
-    shutil.copyfile(tmp_dst.name, to)
-    os.unlink(tmp_dst.name)
-
-    verify_mar_signature(cert_type, fmt, to, keyid)
+    fd, tmp_path = tempfile.mkstemp(prefix=".mar", dir=os.path.dirname(to) or None)
+    try:
+        with open(from_, "rb") as src, os.fdopen(fd, "wb") as dst:
+            h, signature_offset = write_mar_with_signature_block(src, dst, hash_algo)
+
+        signature = await sign_hash_with_autograph(context, h, fmt, keyid)
+
+        if len(signature) != expected_signature_length:
+            raise SigningScriptError(
+                "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(
+                    hash_algo, len(signature), expected_signature_length
+                )
+            )
+        verify_mar_hash_signature(cert_type, fmt, h, signature, hash_algo, keyid)
+
+        with open(tmp_path, "r+b") as dst:
+            dst.seek(signature_offset)
+            dst.write(signature)
+        os.replace(tmp_path, to)
+    except BaseException:
+        rm(tmp_path)
+        raise
 
     log.info("wrote mar with autograph signed hash %s to %s", from_, to)
     return to
@@ -1193,17 +2186,54 @@ async def sign_widevine_with_autograph(context, from_, blessed, to=None):
     flags = 1 if blessed else 0
     fmt = "autograph_widevine"
 
-    h = widevine.generate_widevine_hash(from_, flags)
+    signed_content_cache = task.get_signed_content_cache(context)
+    cache_key = _get_signed_content_key(context, from_, fmt, None, [context.config["widevine_cert"]], flags)
+    async with signed_content_cache.lock(cache_key):
+        if signed_content_cache.get(cache_key, to):
+            return to
+
+        h = widevine.generate_widevine_hash(from_, flags)
 
-    signature = await sign_hash_with_autograph(context, h, fmt)
+        signature = await sign_hash_with_autograph(context, h, fmt)
 
-    with open(to, "wb") as fout:
-        certificate = open(context.config["widevine_cert"], "rb").read()
-        sig = widevine.generate_widevine_signature(signature, certificate, flags)
-        fout.write(sig)
+        with open(to, "wb") as fout:
+            certificate = open(context.config["widevine_cert"], "rb").read()
+            sig = widevine.generate_widevine_signature(signature, certificate, flags)
+            fout.write(sig)
+        signed_content_cache.put(cache_key, to)
     return to
 
 
+def _get_signed_content_key(context, path, fmt, keyid, cert_paths, *options):
+    """Describe how `path` is being signed, for the signed content cache.
+
+    The task's cert type, and the autograph servers and key ids `fmt`
+    resolves to, are part of the key, so a worker sharing the cache between
+    tasks never reuses a signature made with a different key.
+
+    Args:
+        context (Context): the signing context
+        path (str): the file being signed
+        fmt (str): the format it's being signed with
+        keyid (str): the autograph key id, if any
+        cert_paths (list): the certificates that go into the signature. Their
+            contents are part of the key; None entries are skipped.
+        *options: anything else that changes the signed output
+
+    Returns:
+        list: the key for `SignedContentCache`
+
+    """
+    digest_cache = task.get_digest_cache(context)
+    plan_entry = task.get_signing_plan(context).get(fmt)
+    servers = [[s.url, s.key_id] for s in plan_entry.servers]
+
+    def sha256(p):
+        return digest_cache.get_hashes(p, ("sha256",))["sha256"]
+
+    return [sha256(path), fmt, keyid, plan_entry.cert_type, servers, [sha256(p) for p in cert_paths if p], *options]
+
+
 @time_async_function
 async def sign_omnija_with_autograph(context, from_):
     """Sign the omnija file specified using autograph.
@@ -1229,9 +2259,7 @@ async def sign_omnija_with_autograph(context, from_):
 
     await sign_file_with_autograph(context, from_, "autograph_omnija", to=signed_out, extension_id="omni.ja@mozilla.org")
     await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out)
-    with open(from_, "wb") as fout:
-        with open(merged_out, "rb") as fin:
-            fout.write(fin.read())
+    shutil.copyfile(merged_out, from_)
     return from_
 
 
@@ -1254,27 +2282,112 @@ async def merge_omnija_files(orig, signed, to):
         bool: always True if function succeeded.
 
     """
-    orig_jarreader = mozjar.JarReader(orig)
-    with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
-        for origjarfile in orig_jarreader:
-            to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
-        # Use ZipFile here because mozjar can't read the signed copies
-        signed_zip = zipfile.ZipFile(signed, "r")
-        for fname in signed_zip.namelist():
-            if fname.startswith("META-INF"):
-                to_writer.add(fname, signed_zip.open(fname, "r"))
-        if orig_jarreader.last_preloaded:
-            jarlog = list(orig_jarreader.entries.keys())
-            preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
-            to_writer.preload(preloads)
+    # Memory-map the original, so its entries can be copied into the new jar
+    # without reading the whole archive into memory
+    with mozjar.JarReader(orig, use_mmap=True) as orig_jarreader:
+        with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
+            for origjarfile in orig_jarreader:
+                # Passing the JarFileReader with its own compression makes JarWriter
+                # copy the compressed data as-is, rather than inflating and
+                # deflating every entry again. Only the new META-INF entries get
+                # compressed.
+                to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
+            # Use ZipFile here because mozjar can't read the signed copies
+            signed_zip = zipfile.ZipFile(signed, "r")
+            for fname in signed_zip.namelist():
+                if fname.startswith("META-INF"):
+                    to_writer.add(fname, signed_zip.open(fname, "r"))
+            if orig_jarreader.last_preloaded:
+                jarlog = list(orig_jarreader.entries.keys())
+                preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
+                to_writer.preload(preloads)
     return True
 
 
+# AuthenticodeCertStore {{{1
+class AuthenticodeCertStore:
+    """Load each authenticode PEM certificate chain once per task.
+
+    Every file in a windows zip is signed with the same certificates, so
+    parse them the first time they're asked for, and hand out copies of the
+    parsed chain after that.
+
+    Args:
+        config (dict): the signingscript config, with ``authenticode_cert``,
+            ``authenticode_cert_{keyid}`` and ``authenticode_cross_cert`` paths
+
+    """
+
+    def __init__(self, config):
+        """Initialize AuthenticodeCertStore."""
+        self.config = config
+        self._chains = {}
+
+    def load(self, path):
+        """Get the certificates in the PEM file at `path`.
+
+        Args:
+            path (str): the path to the PEM file
+
+        Returns:
+            list: the parsed certificates. The caller may modify the list.
+
+        """
+        if path not in self._chains:
+            with open(path, "rb") as fh:
+                self._chains[path] = load_pem_certs(fh.read())
+        return list(self._chains[path])
+
+    def get_certs(self, keyid=None):
+        """Get the signing certificate chain for `keyid`.
+
+        Args:
+            keyid (str, optional): the autograph key id. If None, use
+                ``authenticode_cert``. Defaults to None.
+
+        Returns:
+            list: the parsed certificates
+
+        """
+        return self.load(self.get_cert_path(keyid))
+
+    def get_cert_path(self, keyid=None):
+        """Get the path to the signing certificate chain for `keyid`."""
+        if keyid:
+            return self.config[f"authenticode_cert_{keyid}"]
+        return self.config["authenticode_cert"]
+
+    def get_cross_certs(self):
+        """Get the parsed ``authenticode_cross_cert`` certificates."""
+        return self.load(self.config["authenticode_cross_cert"])
+
+
+def get_authenticode_cert_store(context):
+    """Get the task's authenticode certificate store, creating it if needed.
+
+    Args:
+        context (Context): the signing context
+
+    Returns:
+        AuthenticodeCertStore: the store shared by every file in this task.
+
+    """
+    if not hasattr(context, "authenticode_cert_store"):
+        context.authenticode_cert_store = AuthenticodeCertStore(context.config)
+    return context.authenticode_cert_store
+
+
 # sign_authenticode_file {{{1
 @time_async_function
-async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_comment=None):
+async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_comment=None, executor=None):
     """Sign a file in-place with authenticode, using autograph as a backend.
 
+    This does what ``winsign.sign.sign_file`` does, in three stages. The
+    dummy signature, which digests the file, and writing the real signature
+    both run osslsigncode, so they run in `executor`. In between, the
+    signature is signed by autograph on the event loop. When many files are
+    signed at once, some are being digested while others wait on autograph.
+
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
@@ -1282,16 +2395,20 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         comment (str): The authenticode comment to sign with, if present.
                        currently only used for msi files.
                        (Defaults to None)
+        executor (concurrent.futures.Executor): where to run the blocking
+                       stages. If None, use the loop's default executor.
+                       (Defaults to None)
+
+    Raises:
+        IOError: if the file can't be signed
 
     Returns:
-        True on success, False otherwise
+        True on success
 
     """
-    if winsign.osslsigncode.is_signed(orig_path):
-        log.info("%s is already signed", orig_path)
-        return True
-
-    fmt, keyid = utils.split_autograph_format(fmt)
+    loop = asyncio.get_event_loop()
+    plan_entry = task.get_signing_plan(context).get(fmt)
+    fmt, keyid = plan_entry.fmt, plan_entry.keyid
 
     async def signer(digest, digest_algo):
         try:
@@ -1307,10 +2424,8 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
     else:
         digest_algo = "sha1"
 
-    if keyid:
-        certs = load_pem_certs(open(context.config[f"authenticode_cert_{keyid}"], "rb").read())
-    else:
-        certs = load_pem_certs(open(context.config["authenticode_cert"], "rb").read())
+    cert_store = get_authenticode_cert_store(context)
+    certs = cert_store.get_certs(keyid)
 
     url = context.config["authenticode_url"]
     timestamp_style = context.config["authenticode_timestamp_style"]
@@ -1325,23 +2440,63 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         log.info("Not using specified comment to sign %s, not yet implemented for non *.msi files.", orig_path)
         authenticode_comment = None
 
-    if not await winsign.sign.sign_file(
-        infile,
-        outfile,
-        digest_algo,
-        certs,
-        signer,
-        url=url,
-        comment=authenticode_comment,
-        crosscert=crosscert,
-        timestamp_style=timestamp_style,
-    ):
-        raise IOError(f"Couldn't sign {orig_path}")
-    os.rename(outfile, infile)
+    signed_content_cache = task.get_signed_content_cache(context)
+    cache_key = await loop.run_in_executor(
+        executor,
+        partial(
+            _get_signed_content_key,
+            context,
+            orig_path,
+            fmt,
+            keyid,
+            [cert_store.get_cert_path(keyid), crosscert],
+            digest_algo,
+            url,
+            authenticode_comment,
+            timestamp_style,
+        ),
+    )
+    async with signed_content_cache.lock(cache_key):
+        if signed_content_cache.get(cache_key, orig_path):
+            return True
+
+        if await loop.run_in_executor(executor, winsign.osslsigncode.is_signed, orig_path):
+            log.info("%s is already signed", orig_path)
+            return True
+
+        try:
+            dummy_sig = await loop.run_in_executor(
+                executor, partial(winsign.osslsigncode.get_dummy_signature, infile, digest_algo, url=url, comment=authenticode_comment, crosscert=crosscert)
+            )
+            if crosscert:
+                certs.extend(cert_store.get_cross_certs())
+            newsig = await resign(get_signeddata(dummy_sig), certs, signer)
+            newsig = await _add_authenticode_timestamp(newsig, digest_algo, timestamp_style)
+            await loop.run_in_executor(executor, winsign.osslsigncode.write_signature, infile, outfile, newsig)
+        except Exception as e:
+            raise IOError(f"Couldn't sign {orig_path}") from e
+        os.rename(outfile, infile)
+        signed_content_cache.put(cache_key, infile)
 
     return True
 
 
+async def _add_authenticode_timestamp(sig, digest_algo, timestamp_style):
+    """Add a timestamp to an encoded authenticode signature, like winsign does."""
+    if timestamp_style not in ("old", "rfc3161"):
+        return sig
+    ci = der_decode(sig, ContentInfo())[0]
+    signed_data = der_decode(ci["content"], SignedData())[0]
+    if timestamp_style == "old":
+        signed_data = await winsign.timestamp.add_old_timestamp(signed_data, None)
+    else:
+        signed_data = await winsign.timestamp.add_rfc3161_timestamp(signed_data, digest_algo, None)
+    ci = ContentInfo()
+    ci["contentType"] = id_signedData
+    ci["content"] = signed_data
+    return der_encode(ci)
+
+
 # sign_authenticode_zip {{{1
 @time_async_function
 async def sign_authenticode_zip(context, orig_path, fmt, *, authenticode_comment=None, **kwargs):
@@ -1377,11 +2532,25 @@ async def sign_authenticode_zip(context, orig_path, fmt, *, authenticode_comment
     if not files_to_sign:
         raise SigningScriptError("Did not find any files to sign, all files: {}".format(files))
 
-    # Sign the appropriate inner files
-    tasks = [sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment) for file_ in files_to_sign]
-    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
-    [f.result() for f in done]
+    # Sign the appropriate inner files. Their osslsigncode stages share a
+    # pool of threads, while autograph limits its own concurrency.
+    threads = context.config.get("authenticode_signing_threads", 0) or os.cpu_count() or 1
+    executor = ThreadPoolExecutor(max_workers=min(threads, len(files_to_sign)))
+    try:
+        tasks = [
+            asyncio.ensure_future(sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment, executor=executor))
+            for file_ in files_to_sign
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task_ in pending:
+            task_.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        [f.result() for f in done]
+    finally:
+        # Don't block the event loop on any osslsigncode stage that's still
+        # running in a thread; its task has been cancelled already
+        executor.shutdown(wait=False)
     if file_extension == ".zip":
-        # Recreate the zipfile
-        await _create_zipfile(context, orig_path, files, tmp_dir=tmp_dir)
+        # Only the signed files changed; copy everything else as-is
+        await _update_zipfile(context, orig_path, files_to_sign, tmp_dir=tmp_dir)
     return orig_path
@@ -7,14 +7,26 @@ Attributes:
         function.
 
 """
+import asyncio
+import json
 import logging
 import os
+import tarfile
+import zipfile
 
 from immutabledict import immutabledict
 from scriptworker.exceptions import TaskVerificationError
 from scriptworker.utils import get_single_item_from_sequence
 
+from signingscript import dmg
+from signingscript.exceptions import SigningScriptError, UnsupportedDmgError
 from signingscript.sign import (
+    _get_omnija_signing_files,
+    _get_tarfile_files,
+    _get_widevine_signing_files,
+    _get_zipfile_files,
+    _should_sign_windows,
+    get_autograph_servers,
     sign_authenticode_zip,
     sign_file,
     sign_gpg,
@@ -26,6 +38,7 @@ from signingscript.sign import (
     sign_widevine,
     sign_xpi,
 )
+from signingscript.utils import DigestCache, SignedContentCache, mkdir, split_autograph_format
 
 log = logging.getLogger(__name__)
 
@@ -147,7 +160,8 @@ async def sign(context, path, signing_formats, **kwargs):
         except OSError:
             size = "??"
         log.info("sign(): Signing %s bytes in %s with %s...", size, output, fmt)
-        output = await signing_func(context, output, fmt, **kwargs)
+        async with _get_format_semaphore(context, fmt):
+            output = await signing_func(context, output, fmt, **kwargs)
     # We want to return a list
     if not isinstance(output, (tuple, list)):
         output = [output]
@@ -158,6 +172,375 @@ def _get_signing_function_from_format(fmt):
     return FORMAT_TO_SIGNING_FUNCTION.get(fmt.split(":")[0], FORMAT_TO_SIGNING_FUNCTION["default"])
 
 
+# _get_format_semaphore {{{1
+def _get_format_semaphore(context, fmt):
+    """Get the semaphore limiting concurrent signings for a format family.
+
+    The format family is the format without any keyid suffix. Its limit is
+    ``max_concurrent_signings_per_format[family]`` if specified, falling back
+    to ``max_concurrent_signings``.
+
+    Args:
+        context (Context): the signing context
+        fmt (str): the format to sign with
+
+    Returns:
+        asyncio.Semaphore: the semaphore for the format family.
+
+    """
+    family = fmt.split(":")[0]
+    if not hasattr(context, "signing_semaphores"):
+        context.signing_semaphores = {}
+    if family not in context.signing_semaphores:
+        limits = context.config.get("max_concurrent_signings_per_format") or {}
+        limit = limits.get(family, context.config.get("max_concurrent_signings", 1))
+        context.signing_semaphores[family] = asyncio.Semaphore(limit)
+    return context.signing_semaphores[family]
+
+
+# get_digest_cache {{{1
+def get_digest_cache(context):
+    """Get the task's file digest cache, creating it if needed.
+
+    Args:
+        context (Context): the signing context
+
+    Returns:
+        DigestCache: the task's cache, used to key the signed content cache.
+
+    """
+    if not hasattr(context, "digest_cache"):
+        context.digest_cache = DigestCache()
+    return context.digest_cache
+
+
+# get_signed_content_cache {{{1
+def get_signed_content_cache(context):
+    """Get the task's signed content cache, creating it if needed.
+
+    The cache lives in ``signed_content_cache_dir`` if that's set, so it can
+    be shared by every task on the worker. Otherwise it lives in `work_dir`,
+    and only lasts as long as this task.
+
+    Args:
+        context (Context): the signing context
+
+    Returns:
+        SignedContentCache: the cache shared by every signing step in this task.
+
+    """
+    if not hasattr(context, "signed_content_cache"):
+        cache_dir = context.config.get("signed_content_cache_dir") or os.path.join(context.config["work_dir"], "signed_content_cache")
+        context.signed_content_cache = SignedContentCache(cache_dir)
+    return context.signed_content_cache
+
+
+# SigningPlan {{{1
+# Only these pass a keyid to autograph; for any other format, a ``:keyid``
+# suffix is part of the format the autograph configs have to list
+_KEYID_SIGNING_FUNCTIONS = (sign_mar384_with_autograph_hash, sign_authenticode_zip)
+
+
+class SigningPlanEntry:
+    """How to sign with one signing format.
+
+    Attributes:
+        fmt (str): the signing format. The keyid suffix is split off for
+            formats that pass it to autograph.
+        keyid (str): the autograph key id from the format, or None.
+
+    """
+
+    def __init__(self, plan, fmt):
+        """Initialize SigningPlanEntry."""
+        if _get_signing_function_from_format(fmt) in _KEYID_SIGNING_FUNCTIONS:
+            self.fmt, self.keyid = split_autograph_format(fmt)
+        else:
+            self.fmt, self.keyid = fmt, None
+        self._plan = plan
+        self._servers = None
+
+    @property
+    def cert_type(self):
+        """str: the task's certificate type."""
+        return self._plan.cert_type
+
+    @property
+    def servers(self):
+        """tuple: the autograph servers supporting `fmt`, in config order.
+
+        `AutographPool` chooses between them per request.
+
+        """
+        if self._servers is None:
+            self._servers = tuple(get_autograph_servers(self._plan.context.autograph_configs, self.cert_type, [self.fmt]))
+        return self._servers
+
+    def get_servers(self):
+        """Get the autograph servers to sign with.
+
+        Raises:
+            SigningScriptError: when no suitable signing server is found
+
+        Returns:
+            list: the autograph servers.
+
+        """
+        if not self.servers:
+            raise SigningScriptError(f"No autograph config found with cert type {self.cert_type} and formats {[self.fmt]}")
+        return list(self.servers)
+
+
+class SigningPlan:
+    """The resolved signing formats for a task.
+
+    Resolving a format means checking the task scopes for the cert type,
+    splitting off the keyid for formats that pass one to autograph, and
+    scanning the autograph configs. None of that changes during a task, so
+    each format is resolved once, and every signing function reads the
+    result instead of redoing it per file.
+
+    Attributes:
+        context (Context): the signing context.
+        paths (dict): the `SigningPlanEntry` per format, per upstream
+            artifact path.
+
+    """
+
+    def __init__(self, context):
+        """Initialize SigningPlan."""
+        self.context = context
+        self.paths = {}
+        self._cert_type = None
+        self._entries = {}
+
+    @property
+    def cert_type(self):
+        """str: the task's certificate type."""
+        if self._cert_type is None:
+            self._cert_type = task_cert_type(self.context)
+        return self._cert_type
+
+    def add(self, path, formats):
+        """Resolve every format `path` will be signed with.
+
+        Args:
+            path (str): the upstream artifact path.
+            formats (list): the formats to sign `path` with.
+
+        Returns:
+            dict: the `SigningPlanEntry` per format.
+
+        """
+        self.paths[path] = {fmt: self.get(fmt) for fmt in formats}
+        for entry in self.paths[path].values():
+            # Resolve the servers now, rather than on the first signing request
+            entry.servers
+        return self.paths[path]
+
+    def get(self, fmt):
+        """Get the `SigningPlanEntry` for `fmt`, resolving it if needed.
+
+        Formats that aren't in the task payload, like the plain format a
+        ``format:keyid`` signs hashes with, are resolved the first time
+        they're used.
+
+        Args:
+            fmt (str): the signing format, optionally with a ``:keyid`` suffix.
+
+        Returns:
+            SigningPlanEntry: the resolved format.
+
+        """
+        if fmt not in self._entries:
+            self._entries[fmt] = SigningPlanEntry(self, fmt)
+        return self._entries[fmt]
+
+
+# get_signing_plan {{{1
+def get_signing_plan(context):
+    """Get the task's signing plan, creating it if needed.
+
+    Args:
+        context (Context): the signing context
+
+    Returns:
+        SigningPlan: the plan shared by every signing step in this task.
+
+    """
+    if not hasattr(context, "signing_plan"):
+        context.signing_plan = SigningPlan(context)
+    return context.signing_plan
+
+
+# estimate_signing {{{1
+# Autograph signs a digest, rather than the file, for these formats
+_MAR384_DIGEST_SIZE = 48
+_WIDEVINE_DIGEST_SIZE = 64
+_AUTHENTICODE_DIGEST_SIZE = 20
+_AUTHENTICODE_EV_DIGEST_SIZE = 32
+
+SIGNING_ESTIMATE_PATH = "public/logs/signing_estimate.json"
+
+
+def _get_upload_size(size):
+    """Return the size of `size` bytes of input once it's base64 encoded."""
+    return 4 * ((size + 2) // 3)
+
+
+async def _get_archive_files(name, source):
+    """List the members of `source`, an archive of the type `name` says."""
+    if name.endswith(".dmg"):
+        with open(source, "rb") as fh:
+            return await asyncio.get_event_loop().run_in_executor(None, dmg.get_dmg_files, fh)
+    if name.endswith(".zip"):
+        return await _get_zipfile_files(source, sizes=True)
+    if name.endswith((".tar.gz", ".tar.bz2")):
+        return await _get_tarfile_files(source, os.path.splitext(name)[1], include_dirs=True, sizes=True)
+    raise SigningScriptError("Unknown archive format for {}".format(name))
+
+
+async def _estimate_format(name, source, size, fmt):
+    """Estimate the work signing one file with one format takes.
+
+    This mirrors what each signing function does, without doing it.
+
+    Args:
+        name (str): the name of the file at this point in the format chain.
+            A dmg becomes a tarball once it's been converted.
+        source (str): the upstream artifact to inspect.
+        size (int): the size of the upstream artifact.
+        fmt (str): the format to sign with.
+
+    Raises:
+        SigningScriptError: if the format will fail, or `source` can't be read.
+
+    Returns:
+        dict, str: the estimate, and the name of the file after signing. If
+            the members of a dmg can't be listed, the estimate counts no
+            files to sign in it, and says so in ``members``.
+
+    """
+    signing_func = _get_signing_function_from_format(fmt)
+    rewrites = 0
+    members = None
+    if signing_func in (sign_macapp, sign_widevine, sign_omnija) and name.endswith(".dmg"):
+        rewrites += 1
+        name = "{}.tar.gz".format(os.path.splitext(name)[0])
+    if signing_func in (sign_widevine, sign_omnija):
+        # A converted dmg has the same members as the dmg
+        try:
+            files = await _get_archive_files(source if source.endswith(".dmg") else name, source)
+        except UnsupportedDmgError as e:
+            # Signing falls back to the dmg and hfsplus binaries, which can
+            # read it; only its members can't be listed here
+            log.debug("Can't list the members of %s: %s", source, e)
+            files = {}
+            members = "unknown (binary fallback)"
+        if signing_func is sign_widevine:
+            to_sign = {f: _WIDEVINE_DIGEST_SIZE for f in _get_widevine_signing_files(list(files)) if not f.endswith("/")}
+        else:
+            to_sign = {f: files[f] for f in _get_omnija_signing_files(list(files))}
+            # Each omni.ja is rebuilt around its signature
+            rewrites += len(to_sign)
+        if to_sign:
+            rewrites += 1
+    elif signing_func is sign_authenticode_zip:
+        digest_size = _AUTHENTICODE_EV_DIGEST_SIZE if "authenticode_ev" in fmt else _AUTHENTICODE_DIGEST_SIZE
+        files = await _get_zipfile_files(source) if name.endswith(".zip") else [name]
+        to_sign = {f: digest_size for f in files if _should_sign_windows(f)}
+        if not to_sign:
+            raise SigningScriptError("Did not find any files to sign, all files: {}".format(files))
+        if name.endswith(".zip"):
+            rewrites += 1
+    elif signing_func is sign_mar384_with_autograph_hash:
+        to_sign = {name: _MAR384_DIGEST_SIZE}
+        # The signature is written into a new copy of the mar
+        rewrites += 1
+    else:
+        to_sign = {name: size}
+        if signing_func is sign_jar:
+            # zipalign may rewrite the apk
+            rewrites += 1
+    estimate = {
+        "format": fmt,
+        "autograph_calls": len(to_sign),
+        "upload_bytes": sum(_get_upload_size(s) for s in to_sign.values()),
+        "archive_rewrites": rewrites,
+        "signed_files": sorted(to_sign),
+    }
+    if members:
+        estimate["members"] = members
+    return estimate, name
+
+
+async def estimate_signing(context, filelist_dict):
+    """Estimate the work a task will do, without signing anything.
+
+    For every upstream artifact, walk its format chain, looking inside
+    archives for the files each format would sign. Count the autograph
+    calls, the bytes uploaded to autograph, and the archives rewritten.
+    These are upper bounds: the signed content cache and already-signed
+    files can mean less work.
+
+    Args:
+        context (Context): the signing context
+        filelist_dict (dict): the `build_filelist_dict` output
+
+    Returns:
+        dict: the estimate per artifact and format, the totals, and any
+            errors found.
+
+    """
+    artifacts = {}
+    totals = {"autograph_calls": 0, "upload_bytes": 0, "archive_rewrites": 0}
+    autograph_calls_per_format = {}
+    errors = []
+    for path, path_dict in filelist_dict.items():
+        source = path_dict["full_path"]
+        size = os.path.getsize(source)
+        name = path
+        steps = []
+        for fmt in path_dict["formats"]:
+            try:
+                step, name = await _estimate_format(name, source, size, fmt)
+            except (SigningScriptError, OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+                errors.append({"path": path, "format": fmt, "error": str(e)})
+                steps.append({"format": fmt, "error": str(e)})
+                break
+            steps.append(step)
+            for key in totals:
+                totals[key] += step[key]
+            autograph_calls_per_format[fmt] = autograph_calls_per_format.get(fmt, 0) + step["autograph_calls"]
+        artifacts[path] = {"size": size, "formats": steps}
+    return {"artifacts": artifacts, "totals": totals, "autograph_calls_per_format": autograph_calls_per_format, "errors": errors}
+
+
+async def write_signing_estimate(context, filelist_dict):
+    """Write the `estimate_signing` output to ``SIGNING_ESTIMATE_PATH`` in `artifact_dir`.
+
+    Args:
+        context (Context): the signing context
+        filelist_dict (dict): the `build_filelist_dict` output
+
+    Returns:
+        dict: the estimate.
+
+    """
+    estimate = await estimate_signing(context, filelist_dict)
+    path = os.path.join(context.config["artifact_dir"], SIGNING_ESTIMATE_PATH)
+    mkdir(os.path.dirname(path))
+    with open(path, "w") as fh:
+        json.dump(estimate, fh, indent=2, sort_keys=True)
+    log.info(
+        "Signing estimate: %(autograph_calls)s autograph calls, %(upload_bytes)s bytes uploaded, %(archive_rewrites)s archive rewrites",
+        estimate["totals"],
+    )
+    for error in estimate["errors"]:
+        log.warning("Signing estimate: %(path)s won't sign with %(format)s: %(error)s", error)
+    return estimate
+
+
 # _sort_formats {{{1
 def _sort_formats(formats):
     """Order the signing formats.
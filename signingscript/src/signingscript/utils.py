@@ -1,18 +1,32 @@
 """Signingscript general utility functions."""
 import asyncio
+import bz2
+import collections
 import functools
 import hashlib
+import io
 import json
 import logging
 import os
+import tempfile
+import zlib
 from asyncio.subprocess import PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from shutil import copyfile
 
-from signingscript.exceptions import FailedSubprocess, SigningServerError
+from signingscript.exceptions import FailedSubprocess, SigningScriptError, SigningServerError
 
 log = logging.getLogger(__name__)
 
+# Read files to hash 1MiB at a time
+HASH_CHUNK_SIZE = 2 ** 20
+
+# bz2 compresses in independent 900k blocks at level 9 anyway, so splitting
+# there costs nothing. gzip loses its window at each member boundary, so use
+# bigger blocks to keep the ratio within a fraction of a percent.
+PARALLEL_COMPRESSION_BLOCK_SIZES = {"gz": 4 * 2 ** 20, "bz2": 900 * 1000}
+
 
 @dataclass
 class Autograph:
@@ -39,6 +53,26 @@ def mkdir(path):
         pass
 
 
+def get_hashes(path, hash_types=("sha512",)):
+    """Get several hashes of a given path, reading it once.
+
+    Args:
+        path (str): the path to calculate the hashes for
+        hash_types (list, optional): the algorithms to use. Defaults to
+            `("sha512",)`
+
+    Returns:
+        dict: the hexdigest of each hash, keyed by algorithm
+
+    """
+    hashes = {hash_type: hashlib.new(hash_type) for hash_type in hash_types}
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, HASH_CHUNK_SIZE), b""):
+            for h in hashes.values():
+                h.update(chunk)
+    return {hash_type: h.hexdigest() for hash_type, h in hashes.items()}
+
+
 def get_hash(path, hash_type="sha512"):
     """Get the hash of a given path.
 
@@ -51,11 +85,223 @@ def get_hash(path, hash_type="sha512"):
 
     """
     # I'd love to make this async, but evidently file i/o is always ready
-    h = hashlib.new(hash_type)
-    with open(path, "rb") as f:
-        for chunk in iter(functools.partial(f.read, 4096), b""):
-            h.update(chunk)
-    return h.hexdigest()
+    return get_hashes(path, [hash_type])[hash_type]
+
+
+class DigestCache:
+    """Cache file hashes, so a file is only read again if it changes.
+
+    Entries are keyed by real path, and are only used while the file's inode,
+    size and mtime are unchanged; a file that has been signed in place, or
+    replaced, gets read again. Asking for hashes that aren't cached yet reads
+    the file once for all of them.
+
+    The signed content cache keys are its only users so far. MAR signing
+    hashes the signature data while copying the file, in
+    `write_mar_with_signature_block`, so it doesn't need a whole-file digest.
+
+    """
+
+    def __init__(self):
+        """Initialize DigestCache."""
+        self._entries = {}
+
+    def get_hashes(self, path, hash_types=("sha512",)):
+        """Get several hashes of `path`, reading it only if they aren't cached.
+
+        Args:
+            path (str): the path to calculate the hashes for
+            hash_types (list, optional): the algorithms to use. Defaults to
+                `("sha512",)`
+
+        Returns:
+            dict: the hexdigest of each hash, keyed by algorithm
+
+        """
+        path = os.path.realpath(path)
+        # Stat before reading, so a change during the read invalidates the entry
+        st = os.stat(path)
+        state = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached_state, hashes = self._entries.get(path, (None, {}))
+        if cached_state != state:
+            hashes = {}
+        missing = [hash_type for hash_type in hash_types if hash_type not in hashes]
+        if missing:
+            log.debug("Hashing %s with %s", path, missing)
+            hashes.update(get_hashes(path, missing))
+            self._entries[path] = (state, hashes)
+        return {hash_type: hashes[hash_type] for hash_type in hash_types}
+
+
+class SignedContentCache:
+    """Keep copies of signed files, to reuse for byte-identical inputs.
+
+    Entries are keyed by a list describing how a file was signed: the digest
+    of the input, the format and key id, and anything else that changes the
+    output. Entries are written atomically, so several tasks can share
+    `cache_dir`.
+
+    Args:
+        cache_dir (str): the directory to keep the signed copies in
+
+    """
+
+    def __init__(self, cache_dir):
+        """Initialize SignedContentCache."""
+        self.cache_dir = cache_dir
+        self._locks = {}
+
+    def _get_path(self, key):
+        name = hashlib.sha256(json.dumps(key).encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name)
+
+    def lock(self, key):
+        """Get the lock for `key`.
+
+        Holding it while looking up and signing means concurrent steps with
+        identical inputs sign once, and the rest reuse the result.
+
+        Args:
+            key (list): the cache key
+
+        Returns:
+            asyncio.Lock: the lock
+
+        """
+        return self._locks.setdefault(self._get_path(key), asyncio.Lock())
+
+    def get(self, key, to):
+        """Copy the signed file for `key` to `to`, if there is one.
+
+        Args:
+            key (list): the cache key
+            to (str): the path to copy the signed file to
+
+        Returns:
+            bool: True if the signed file was found and copied
+
+        """
+        try:
+            copyfile(self._get_path(key), to)
+        except FileNotFoundError:
+            return False
+        log.info("Reused the signed copy of %s", to)
+        return True
+
+    def put(self, key, from_):
+        """Keep a copy of the signed file `from_` for `key`.
+
+        Args:
+            key (list): the cache key
+            from_ (str): the signed file
+
+        """
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            copyfile(from_, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _gzip_compress(data, compresslevel):
+    """Compress `data` into a single gzip member, with a zero mtime."""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelCompressor(io.RawIOBase):
+    """A write-only file object that compresses on a thread pool.
+
+    The data written is cut into blocks, and each block is compressed into its
+    own gzip member or bz2 stream, like pigz or pbzip2 do. zlib and bz2 release
+    the GIL, so the blocks compress in parallel. The compressed blocks are
+    written to `fileobj` in order; gzip, bzip2, and python's gzip, bz2 and
+    tarfile modules all read the concatenated members or streams back as one.
+
+    Closing the compressor doesn't close `fileobj`.
+
+    Args:
+        fileobj (file): the file object to write the compressed data to
+        compression (str): `gz` or `bz2`
+        threads (int): the number of blocks to compress at once
+        block_size (int, optional): the uncompressed size of each block. If
+            None, use `PARALLEL_COMPRESSION_BLOCK_SIZES[compression]`.
+            Defaults to None.
+        compresslevel (int, optional): the compression level. Defaults to 9,
+            like `tarfile`.
+
+    Raises:
+        SigningScriptError: on an unsupported `compression`
+
+    """
+
+    def __init__(self, fileobj, compression, threads, block_size=None, compresslevel=9):
+        """Initialize ParallelCompressor."""
+        if compression == "gz":
+            self._compress = functools.partial(_gzip_compress, compresslevel=compresslevel)
+        elif compression == "bz2":
+            self._compress = functools.partial(bz2.compress, compresslevel=compresslevel)
+        else:
+            raise SigningScriptError("{} not a supported parallel compression format!".format(compression))
+        super().__init__()
+        self._fileobj = fileobj
+        self._block_size = block_size or PARALLEL_COMPRESSION_BLOCK_SIZES[compression]
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        # Keep enough blocks in flight to keep every thread busy, without
+        # buffering the whole input in memory
+        self._max_pending = threads * 2
+        self._pending = collections.deque()
+        self._blocks = 0
+
+    def writable(self):
+        """Return True; this file is writable."""
+        return True
+
+    def write(self, data):
+        """Buffer `data`, submitting every full block for compression.
+
+        Returns:
+            int: the number of bytes written
+
+        """
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[: self._block_size]))
+            del self._buffer[: self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        while len(self._pending) >= self._max_pending:
+            self._write_next()
+        self._pending.append(self._executor.submit(self._compress, block))
+        self._blocks += 1
+
+    def _write_next(self):
+        self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        """Compress the last partial block, and write out all pending blocks."""
+        if self.closed:
+            return
+        try:
+            # Always write at least one member, so empty input is still valid
+            if self._buffer or not self._blocks:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_next()
+            self._fileobj.flush()
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+            super().close()
 
 
 def load_json(path):
@@ -8,6 +8,7 @@ from io import (
     BytesIO,
     UnsupportedOperation,
 )
+import mmap
 import struct
 import subprocess
 import zlib
@@ -351,15 +352,30 @@ class JarReader(object):
     as Mozilla jar files (see further details in the JarWriter documentation).
     '''
 
-    def __init__(self, file=None, fileobj=None, data=None):
+    def __init__(self, file=None, fileobj=None, data=None, use_mmap=False):
         '''
         Opens the given file as a Jar archive. Use the given file-like object
         if one is given instead of opening the given file name.
-        '''
-        if fileobj:
+        If use_mmap is True, the file is memory-mapped instead of being read
+        into memory, and JarFileReader.compressed_data are zero-copy slices
+        of the mapping. The mapping is released by close(), or when leaving
+        the JarReader's context manager.
+        '''
+        self._mmap = None
+        if use_mmap and (file or fileobj):
+            if fileobj:
+                self._mmap = mmap.mmap(fileobj.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                with open(file, 'rb') as fh:
+                    self._mmap = mmap.mmap(fh.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+            data = self._mmap
+        elif fileobj:
             data = fileobj.read()
         elif file:
-            data = open(file, 'rb').read()
+            with open(file, 'rb') as fh:
+                data = fh.read()
         self._data = memoryview(data)
         # The End of Central Directory Record has a variable size because of
         # comments it may contain, so scan for it from the end of the file.
@@ -373,11 +389,36 @@ class JarReader(object):
             offset -= 1
         self._cdir_end = JarCdirEnd(self._data[offset:])
 
+    def __enter__(self):
+        '''
+        Context manager __enter__ method for JarReader.
+        '''
+        return self
+
+    def __exit__(self, type, value, tb):
+        '''
+        Context manager __exit__ method for JarReader.
+        '''
+        self.close()
+
     def close(self):
         '''
         Free some resources associated with the Jar.
-        '''
+        When the Jar is memory-mapped, the mapping is closed right away if
+        nothing else refers to it. Otherwise, e.g. when a JarFileReader or
+        a JarWriter still holds some compressed_data, it is unmapped once
+        the last of those is freed.
+        '''
+        if not hasattr(self, '_data'):
+            return
+        self._data.release()
         del self._data
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
 
     @property
     def compression(self):
@@ -0,0 +1,198 @@
+"""Align the uncompressed members of a zipfile, like the SDK's ``zipalign``.
+
+Android wants the data of every stored (uncompressed) member of an APK to
+start on a 4 byte boundary, so it can be mmapped. `align_zip` gets there by
+padding the extra field of the local headers, and copies everything else,
+including compressed member data, through byte for byte. The central
+directory is copied with its local header offsets updated.
+
+Zip64 archives aren't supported; APKs are nowhere near that big.
+
+"""
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+from signingscript.exceptions import SigningScriptError
+
+_COPY_CHUNK_SIZE = 2 ** 20
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+_CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+_END_RECORD = struct.Struct("<4s4H2LH")
+_END_RECORD_SIGNATURE = b"PK\x05\x06"
+_ZIP64_LIMIT = 0xFFFFFFFF
+
+
+# helpers {{{1
+def _read_exactly(fh, offset, size):
+    fh.seek(offset)
+    data = fh.read(size)
+    if len(data) != size:
+        raise SigningScriptError(f"Truncated zipfile: expected {size} bytes at offset {offset}")
+    return data
+
+
+def _copy(from_fh, to_fh, offset, size):
+    from_fh.seek(offset)
+    while size > 0:
+        data = from_fh.read(min(size, _COPY_CHUNK_SIZE))
+        if not data:
+            raise SigningScriptError(f"Truncated zipfile: {size} bytes missing before offset {offset}")
+        to_fh.write(data)
+        offset += len(data)
+        size -= len(data)
+
+
+def _read_end_record(fh):
+    """Return the offset and fields of the end of central directory record."""
+    size = fh.seek(0, os.SEEK_END)
+    tail_size = min(size, _END_RECORD.size + 0xFFFF)
+    tail = _read_exactly(fh, size - tail_size, tail_size)
+    index = tail.rfind(_END_RECORD_SIGNATURE)
+    if index < 0 or index + _END_RECORD.size > len(tail):
+        raise SigningScriptError("Not a zipfile: no end of central directory record")
+    fields = _END_RECORD.unpack_from(tail, index)
+    if _ZIP64_LIMIT in fields[5:7] or 0xFFFF in fields[3:5]:
+        raise SigningScriptError("Zip64 archives aren't supported")
+    return size - tail_size + index, fields
+
+
+def _read_central_directory(fh):
+    """Return the central directory records, and the end record's offset and fields.
+
+    Each record is a ``(fields, raw_record)`` tuple, where `raw_record`
+    includes the name, extra field and comment.
+
+    """
+    end_offset, end_fields = _read_end_record(fh)
+    cd_size, cd_offset = end_fields[5:7]
+    cd = _read_exactly(fh, cd_offset, cd_size)
+    records = []
+    pos = 0
+    for _ in range(end_fields[4]):
+        if cd[pos : pos + 4] != _CENTRAL_HEADER_SIGNATURE:
+            raise SigningScriptError(f"Corrupt central directory at offset {cd_offset + pos}")
+        fields = _CENTRAL_HEADER.unpack_from(cd, pos)
+        if _ZIP64_LIMIT in fields[8:10] + fields[-1:]:
+            raise SigningScriptError("Zip64 archives aren't supported")
+        size = _CENTRAL_HEADER.size + sum(fields[10:13])
+        records.append((fields, cd[pos : pos + size]))
+        pos += size
+    return records, end_offset, end_fields
+
+
+def _read_local_header(fh, offset):
+    fields = _LOCAL_HEADER.unpack(_read_exactly(fh, offset, _LOCAL_HEADER.size))
+    if fields[0] != _LOCAL_HEADER_SIGNATURE:
+        raise SigningScriptError(f"Corrupt zipfile: no local header at offset {offset}")
+    name_len, extra_len = fields[9:11]
+    name = _read_exactly(fh, offset + _LOCAL_HEADER.size, name_len)
+    extra = _read_exactly(fh, offset + _LOCAL_HEADER.size + name_len, extra_len)
+    return fields, name, extra
+
+
+# get_misaligned_members {{{1
+def get_misaligned_members(fh, alignment):
+    """Find the stored members whose data isn't aligned.
+
+    Args:
+        fh (file): the zipfile, open for reading in binary mode
+        alignment (int): the alignment, in bytes
+
+    Raises:
+        SigningScriptError: if `fh` isn't a zipfile we can read
+
+    Returns:
+        list: the names of the misaligned members
+
+    """
+    misaligned = []
+    records, _, _ = _read_central_directory(fh)
+    for fields, _ in records:
+        if fields[4] != zipfile.ZIP_STORED:
+            continue
+        offset = fields[-1]
+        _, name, extra = _read_local_header(fh, offset)
+        if (offset + _LOCAL_HEADER.size + len(name) + len(extra)) % alignment:
+            misaligned.append(name.decode("utf8", "replace"))
+    return misaligned
+
+
+# align_zip {{{1
+def align_zip(from_fh, to_fh, alignment):
+    """Write an aligned copy of a zipfile.
+
+    Args:
+        from_fh (file): the zipfile, open for reading in binary mode
+        to_fh (file): the file to write the aligned copy to. This must be
+            empty, and open for writing in binary mode
+        alignment (int): the alignment, in bytes
+
+    Raises:
+        SigningScriptError: if `from_fh` isn't a zipfile we can read
+
+    """
+    records, end_offset, end_fields = _read_central_directory(from_fh)
+    cd_offset = end_fields[6]
+    offsets = sorted({fields[-1] for fields, _ in records})
+    # Keep anything before the first member
+    _copy(from_fh, to_fh, 0, offsets[0] if offsets else cd_offset)
+    new_offsets = {}
+    stored = {fields[-1] for fields, _ in records if fields[4] == zipfile.ZIP_STORED}
+    for offset, next_offset in zip(offsets, offsets[1:] + [cd_offset]):
+        new_offset = to_fh.tell()
+        new_offsets[offset] = new_offset
+        fields, name, extra = _read_local_header(from_fh, offset)
+        if offset in stored:
+            extra += b"\0" * (-(new_offset + _LOCAL_HEADER.size + len(name) + len(extra)) % alignment)
+        to_fh.write(_LOCAL_HEADER.pack(*fields[:10], len(extra)) + name + extra)
+        # Member data, plus any data descriptor or other bytes up to the next member
+        data_offset = offset + _LOCAL_HEADER.size + fields[9] + fields[10]
+        _copy(from_fh, to_fh, data_offset, next_offset - data_offset)
+    new_cd_offset = to_fh.tell()
+    for fields, raw_record in records:
+        to_fh.write(_CENTRAL_HEADER.pack(*fields[:-1], new_offsets[fields[-1]]) + raw_record[_CENTRAL_HEADER.size :])
+    new_end_offset = to_fh.tell()
+    to_fh.write(_END_RECORD.pack(*end_fields[:5], new_end_offset - new_cd_offset, new_cd_offset, end_fields[7]))
+    _copy(from_fh, to_fh, end_offset + _END_RECORD.size, end_fields[7])
+
+
+# align_zip_file {{{1
+def align_zip_file(path, alignment):
+    """Align a zipfile in place, if it needs it.
+
+    The aligned copy is written next to `path`, verified, and renamed over it.
+
+    Args:
+        path (str): the path to the zipfile
+        alignment (int): the alignment, in bytes
+
+    Raises:
+        SigningScriptError: if `path` isn't a zipfile we can read, or
+            didn't align
+
+    Returns:
+        bool: False if `path` was already aligned, True otherwise
+
+    """
+    with open(path, "rb") as from_fh:
+        if not get_misaligned_members(from_fh, alignment):
+            return False
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w+b") as to_fh:
+                align_zip(from_fh, to_fh, alignment)
+                misaligned = get_misaligned_members(to_fh, alignment)
+            if misaligned:
+                raise SigningScriptError(f"{path} members are still misaligned: {misaligned}")
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return True
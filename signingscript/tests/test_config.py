@@ -15,7 +15,6 @@ COMMON_CONTEXT = {
     "SIGNTOOL_PATH": "",
     "DMG_PATH": "",
     "HFSPLUS_PATH": "",
-    "ZIPALIGN_PATH": "",
     "GPG_PUBKEY_PATH": "",
     "WIDEVINE_CERT_PATH": "",
     "AUTHENTICODE_CERT_PATH": "",
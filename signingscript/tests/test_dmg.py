@@ -0,0 +1,325 @@
+import bz2
+import io
+import lzma
+import os
+import plistlib
+import random
+import struct
+import tarfile
+import zlib
+
+import pytest
+
+import signingscript.dmg as dmg
+from signingscript.exceptions import SigningScriptError, UnsupportedDmgError
+
+# helper constants, fixtures, functions {{{1
+BLOCK_SIZE = 4096
+NODE_SIZE = 512
+MTIME = 1600000000
+HFS_MTIME = MTIME + 2082844800
+PRIVATE_DATA = "\0\0\0\0HFS+ Private Data"
+
+COMPRESSORS = {
+    dmg._RUN_RAW: lambda data: data,
+    dmg._RUN_ZLIB: zlib.compress,
+    dmg._RUN_BZIP2: bz2.compress,
+    dmg._RUN_LZMA: lzma.compress,
+}
+
+
+def _fork(size, extents):
+    extents = list(extents)[:8]
+    extents += [(0, 0)] * (8 - len(extents))
+    return struct.pack(">QII", size, 0, sum(count for _, count in extents)) + b"".join(struct.pack(">II", *e) for e in extents)
+
+
+def _key(parent_id, name):
+    name = name.encode("utf-16-be")
+    return struct.pack(">HIH", 6 + len(name), parent_id, len(name) // 2) + name
+
+
+def _bsd_info(mode, owner_flags=0, special=0):
+    return struct.pack(">IIBBHI", 0, 0, 0, owner_flags, mode, special)
+
+
+def _folder_record(folder_id, mode):
+    return struct.pack(">hHII5I", 1, 0, 0, folder_id, *[HFS_MTIME] * 5) + _bsd_info(mode) + bytes(40)
+
+
+def _file_record(file_id, mode, fork, file_type=b"\0" * 4, creator=b"\0" * 4, owner_flags=0, special=0):
+    return (
+        struct.pack(">hHII5I", 2, 0, 0, file_id, *[HFS_MTIME] * 5)
+        + _bsd_info(mode, owner_flags, special)
+        + file_type
+        + creator
+        + bytes(8)
+        + bytes(24)
+        + fork
+        + _fork(0, [])
+    )
+
+
+def _btree(records, node_size=NODE_SIZE):
+    """Build a B-tree file: a header node, then leaf nodes holding `records`."""
+    leaves = []
+    current = []
+    for record in records:
+        if current and 14 + sum(map(len, current)) + len(record) + 2 * (len(current) + 2) > node_size:
+            leaves.append(current)
+            current = []
+        current.append(record)
+    if current:
+        leaves.append(current)
+    nodes = []
+    header = struct.pack(">IIbBHH", 0, 0, 1, 0, 3, 0)
+    header += struct.pack(">HIIIIHHII", 1, 1 if leaves else 0, len(records), 1 if leaves else 0, len(leaves), node_size, 516, len(leaves) + 1, 0)
+    nodes.append(header.ljust(node_size, b"\0"))
+    for i, leaf in enumerate(leaves, 1):
+        f_link = i + 1 if i < len(leaves) else 0
+        body = struct.pack(">IIbBHH", f_link, i - 1, -1, 1, len(leaf), 0)
+        offsets = []
+        for record in leaf:
+            offsets.append(len(body))
+            body += record
+        offsets.append(len(body))
+        body = body.ljust(node_size - 2 * len(offsets), b"\0") + struct.pack(f">{len(offsets)}H", *reversed(offsets))
+        nodes.append(body)
+    return b"".join(nodes)
+
+
+class HFSBuilder:
+    """Build a small HFS+ volume in memory."""
+
+    def __init__(self):
+        self.records = []
+        self.overflow = []
+        self.data = {}
+        self.next_block = 64
+        self.next_id = 16
+        self.folder(1, "Firefox", folder_id=2)
+
+    def _alloc(self, data, fragments=1):
+        blocks = max((len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE, 1) if data else 0
+        extents = []
+        for i in range(blocks):
+            if fragments > 1 or not extents:
+                extents.append((self.next_block, 1))
+                # Leave a gap, so the extents can't be merged
+                self.next_block += 2 if fragments > 1 else 1
+            else:
+                extents[-1] = (extents[-1][0], extents[-1][1] + 1)
+                self.next_block += 1
+        offset = 0
+        for start, count in extents:
+            self.data[start] = data[offset : offset + count * BLOCK_SIZE]
+            offset += count * BLOCK_SIZE
+        return extents
+
+    def folder(self, parent_id, name, mode=0o40755, folder_id=None):
+        folder_id = folder_id or self._new_id()
+        self.records.append(_key(parent_id, name) + _folder_record(folder_id, mode))
+        return folder_id
+
+    def file(self, parent_id, name, data=b"", mode=0o100644, fragments=1, **kwargs):
+        file_id = self._new_id()
+        extents = self._alloc(data, fragments)
+        if len(extents) > 8:
+            self.overflow.append(struct.pack(">HBBII", 10, 0, 0, file_id, 8) + b"".join(struct.pack(">II", *e) for e in extents[8:16]).ljust(64, b"\0"))
+        self.records.append(_key(parent_id, name) + _file_record(file_id, mode, _fork(len(data), extents), **kwargs))
+        return file_id
+
+    def _new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def build(self, signature=b"H+"):
+        catalog = _btree(self.records)
+        extents_file = _btree(self.overflow)
+        catalog_extents = self._alloc(catalog)
+        extents_extents = self._alloc(extents_file)
+        image = bytearray(self.next_block * BLOCK_SIZE)
+        for start, data in self.data.items():
+            image[start * BLOCK_SIZE : start * BLOCK_SIZE + len(data)] = data
+        header = bytearray(512)
+        header[0:4] = signature + struct.pack(">H", 4)
+        struct.pack_into(">II", header, 40, BLOCK_SIZE, self.next_block)
+        header[192:272] = _fork(len(extents_file), extents_extents)
+        header[272:352] = _fork(len(catalog), catalog_extents)
+        image[1024:1536] = header
+        return bytes(image)
+
+
+def make_udif(disk, run_type=dmg._RUN_ZLIB, run_sectors=64, free_sectors=64):
+    """Wrap `disk` in a UDIF image, after `free_sectors` of free space."""
+    data_fork = b""
+    blkx = []
+    partitions = [("Free (Apple_Free : 1)", bytes(free_sectors * dmg.SECTOR_SIZE), 0), ("disk image (Apple_HFS : 2)", disk, free_sectors)]
+    for i, (name, partition, first_sector) in enumerate(partitions):
+        sector_count = len(partition) // dmg.SECTOR_SIZE
+        runs = []
+        for sector in range(0, sector_count, run_sectors):
+            chunk = partition[sector * dmg.SECTOR_SIZE : (sector + run_sectors) * dmg.SECTOR_SIZE]
+            count = len(chunk) // dmg.SECTOR_SIZE
+            if not chunk.strip(b"\0"):
+                runs.append(dmg._RUN.pack(dmg._RUN_ZERO, 0, sector, count, len(data_fork), 0))
+                continue
+            compressed = COMPRESSORS[run_type](chunk) if run_type in COMPRESSORS else chunk
+            runs.append(dmg._RUN.pack(run_type, 0, sector, count, len(data_fork), len(compressed)))
+            data_fork += compressed
+        runs.append(dmg._RUN.pack(dmg._RUN_END, 0, sector_count, 0, len(data_fork), 0))
+        mish = dmg._MISH.pack(b"mish", 1, first_sector, sector_count, 0, 0, i, b"", 0, 0, b"", len(runs))
+        blkx.append({"Attributes": "0x0050", "CFName": name, "Data": mish + b"".join(runs), "ID": str(i - 1), "Name": name})
+    xml = plistlib.dumps({"resource-fork": {"blkx": blkx}})
+    koly = bytearray(512)
+    koly[0:12] = b"koly" + struct.pack(">II", 4, 512)
+    struct.pack_into(">QQ", koly, 24, 0, len(data_fork))
+    struct.pack_into(">QQ", koly, 216, len(data_fork), len(xml))
+    struct.pack_into(">Q", koly, 492, free_sectors + len(disk) // dmg.SECTOR_SIZE)
+    return data_fork + xml + bytes(koly)
+
+
+def make_firefox_volume(**kwargs):
+    rng = random.Random(0)
+    firefox = bytes(rng.getrandbits(8) for _ in range(3 * BLOCK_SIZE + 100))
+    omnija = bytes(rng.getrandbits(8) for _ in range(10 * BLOCK_SIZE - 7))
+    hfs = HFSBuilder()
+    private = hfs.folder(2, PRIVATE_DATA, mode=0o40000)
+    hfs.file(private, "iNode123", b"linked", mode=0o100600)
+    hfs.file(2, ".journal", b"journal")
+    hfs.file(2, "Applications", b"/Applications", mode=0o120755)
+    app = hfs.folder(2, "Firefox.app")
+    contents = hfs.folder(app, "Contents")
+    macos = hfs.folder(contents, "MacOS")
+    resources = hfs.folder(contents, "Resources", mode=0)
+    hfs.file(macos, "firefox", firefox, mode=0o100755)
+    hfs.file(resources, "omni.ja", omnija, fragments=10)
+    hfs.file(resources, "empty", mode=0)
+    hfs.file(resources, "a/b", b"slash")
+    hfs.file(resources, "link", b"../MacOS/firefox", mode=0o120755)
+    hfs.file(resources, "hardlink", file_type=b"hlnk", creator=b"hfs+", special=123)
+    expected = {
+        "./": (tarfile.DIRTYPE, 0o755, None),
+        "./Applications": (tarfile.SYMTYPE, 0o755, "/Applications"),
+        "./Firefox.app": (tarfile.DIRTYPE, 0o755, None),
+        "./Firefox.app/Contents": (tarfile.DIRTYPE, 0o755, None),
+        "./Firefox.app/Contents/MacOS": (tarfile.DIRTYPE, 0o755, None),
+        "./Firefox.app/Contents/Resources": (tarfile.DIRTYPE, 0o755, None),
+        "./Firefox.app/Contents/MacOS/firefox": (tarfile.REGTYPE, 0o755, firefox),
+        "./Firefox.app/Contents/Resources/omni.ja": (tarfile.REGTYPE, 0o644, omnija),
+        "./Firefox.app/Contents/Resources/empty": (tarfile.REGTYPE, 0o644, b""),
+        "./Firefox.app/Contents/Resources/a:b": (tarfile.REGTYPE, 0o644, b"slash"),
+        "./Firefox.app/Contents/Resources/link": (tarfile.SYMTYPE, 0o755, "../MacOS/firefox"),
+        "./Firefox.app/Contents/Resources/hardlink": (tarfile.REGTYPE, 0o600, b"linked"),
+    }
+    return hfs, expected
+
+
+def read_tarball(path):
+    members = {}
+    with tarfile.open(path) as t:
+        for member in t.getmembers():
+            assert member.uid == 0 and member.gid == 0
+            assert member.mtime == MTIME
+            if member.isfile():
+                value = t.extractfile(member).read()
+            elif member.issym():
+                value = member.linkname
+            else:
+                value = None
+            name = member.name if member.name != "." else "./"
+            members[name] = (member.type, member.mode, value)
+    return members
+
+
+# write_dmg_to_tarfile {{{1
+@pytest.mark.parametrize("run_type", (dmg._RUN_RAW, dmg._RUN_ZLIB, dmg._RUN_BZIP2, dmg._RUN_LZMA))
+@pytest.mark.parametrize("signature", (b"H+", b"HX"))
+def test_write_dmg_to_tarfile(tmpdir, run_type, signature):
+    hfs, expected = make_firefox_volume()
+    dmg_path = os.path.join(tmpdir, "firefox.dmg")
+    with open(dmg_path, "wb") as fh:
+        fh.write(make_udif(hfs.build(signature), run_type))
+    to = os.path.join(tmpdir, "firefox.tar.gz")
+    with open(dmg_path, "rb") as fh, tarfile.open(to, "w:gz") as t:
+        dmg.write_dmg_to_tarfile(fh, t)
+    assert read_tarball(to) == expected
+    with tarfile.open(to) as t:
+        names = t.getnames()
+    # Directories come before their contents
+    assert names.index("./Firefox.app/Contents/MacOS") < names.index("./Firefox.app/Contents/MacOS/firefox")
+
+
+def test_udif_image_read():
+    disk = bytes(random.Random(1).getrandbits(8) for _ in range(200 * dmg.SECTOR_SIZE))
+    image = dmg.UDIFImage(io.BytesIO(make_udif(disk, run_sectors=7)), cache_size=2)
+    offset = 64 * dmg.SECTOR_SIZE
+    assert image.read(offset, len(disk)) == disk
+    assert image.read(offset + 3000, 10000) == disk[3000:13000]
+    assert image.read(0, 100) == bytes(100)
+    assert len(image._cache) == 2
+    with pytest.raises(SigningScriptError):
+        image.read(offset + len(disk) - 10, 20)
+
+
+@pytest.mark.parametrize(
+    "data,match",
+    (
+        (b"", "too small"),
+        (b"\0" * 1024, "no koly"),
+    ),
+)
+def test_udif_image_not_udif(data, match):
+    with pytest.raises(UnsupportedDmgError, match=match):
+        dmg.UDIFImage(io.BytesIO(data))
+
+
+@pytest.mark.parametrize("run_type", (dmg._RUN_ADC, dmg._RUN_LZFSE, 0x12345))
+def test_udif_image_unsupported_run_type(run_type):
+    hfs, _ = make_firefox_volume()
+    with pytest.raises(UnsupportedDmgError, match="Unsupported UDIF run type"):
+        dmg.UDIFImage(io.BytesIO(make_udif(hfs.build(), run_type)))
+
+
+def test_no_hfs_partition():
+    image = dmg.UDIFImage(io.BytesIO(make_udif(bytes(64 * dmg.SECTOR_SIZE))))
+    with pytest.raises(UnsupportedDmgError, match="No HFS"):
+        image.get_hfs_offset()
+    with pytest.raises(UnsupportedDmgError, match="Not an HFS"):
+        dmg.HFSVolume(lambda offset, size: image.read(offset, size))
+
+
+@pytest.mark.parametrize(
+    "kwargs,match",
+    (
+        ({"owner_flags": dmg._UF_COMPRESSED}, "is compressed"),
+        ({"file_type": b"fdrp", "creator": b"MACS"}, "directory hard link"),
+    ),
+)
+def test_unsupported_files(kwargs, match):
+    hfs, _ = make_firefox_volume()
+    hfs.file(2, "unsupported", b"data", **kwargs)
+    image = hfs.build()
+    volume = dmg.HFSVolume(lambda offset, size: image[offset : offset + size])
+    with pytest.raises(UnsupportedDmgError, match=match):
+        list(volume.iter_entries())
+
+
+def test_missing_hard_link_target():
+    hfs, _ = make_firefox_volume()
+    hfs.file(2, "broken", file_type=b"hlnk", creator=b"hfs+", special=999)
+    image = hfs.build()
+    volume = dmg.HFSVolume(lambda offset, size: image[offset : offset + size])
+    with pytest.raises(SigningScriptError, match="iNode999"):
+        list(volume.iter_entries())
+
+
+# get_dmg_files {{{1
+def test_get_dmg_files():
+    hfs, expected = make_firefox_volume()
+    files = dmg.get_dmg_files(io.BytesIO(make_udif(hfs.build())))
+    assert files == {
+        (f"{name.rstrip('/')}/" if type_ == tarfile.DIRTYPE else name): (len(value) if type_ == tarfile.REGTYPE else 0)
+        for name, (type_, _, value) in expected.items()
+        if type_ != tarfile.SYMTYPE
+    }
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from unittest.mock import MagicMock
 
@@ -7,6 +8,7 @@ import scriptworker.client
 from conftest import BASE_DIR, noop_sync
 
 import signingscript.script as script
+from signingscript.exceptions import SigningScriptError
 
 # helper constants, fixtures, functions {{{1
 EXAMPLE_CONFIG = os.path.join(BASE_DIR, "config_example.json")
@@ -95,6 +97,21 @@ async def test_async_main_autograph_authenticode(tmpdir, mocker, use_comment):
     await async_main_helper(tmpdir, mocker, formats, {}, "autograph", use_comment=use_comment)
 
 
+# get_connector {{{1
+@pytest.mark.asyncio
+async def test_get_connector():
+    context = mock.MagicMock()
+    context.config = script.get_default_config()
+    context.config["autograph_connections_per_host"] = 3
+    connector = script.get_connector(context)
+    try:
+        assert connector.limit_per_host == 3
+        assert connector._keepalive_timeout == 30
+        assert connector.use_dns_cache
+    finally:
+        await connector.close()
+
+
 def test_get_default_config():
     parent_dir = os.path.dirname(os.getcwd())
     c = script.get_default_config()
@@ -122,3 +139,80 @@ async def test_async_main_widevine(tmp_path, mocker):
     tmp_cert = tmp_path / "widevine.crt"
     formats = ["autograph_widevine"]
     await async_main_helper(tmp_path, mocker, formats, {"widevine_cert": tmp_cert})
+
+
+@pytest.mark.asyncio
+async def test_async_main_concurrent(tmpdir, mocker):
+    paths = ["path{}".format(i) for i in range(6)]
+    running = []
+    max_running = []
+
+    def fake_filelist_dict(*args, **kwargs):
+        return {path: {"full_path": "full_{}".format(path), "formats": ["autograph_mar"]} for path in paths}
+
+    async def fake_sign(_, val, *args, **kwargs):
+        running.append(val)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(val)
+        return [val]
+
+    published = []
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=["autograph_mar"])
+    mocker.patch.object(script, "build_filelist_dict", new=fake_filelist_dict)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch.object(script, "copy_to_dir", new=lambda source, parent_dir, target=None: published.append(target))
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmpdir), "artifact_dir": str(tmpdir), "autograph_configs": {}, "max_concurrent_signings": 3}
+    await script.async_main(context)
+    assert max(max_running) == 3
+    assert sorted(published) == sorted(paths * 2)
+
+
+@pytest.mark.asyncio
+async def test_async_main_concurrent_error_order(tmpdir, mocker):
+    def fake_filelist_dict(*args, **kwargs):
+        return {path: {"full_path": path, "formats": ["autograph_mar"]} for path in ("path1", "path2", "path3")}
+
+    async def fake_sign(_, val, *args, **kwargs):
+        # path3 fails first, but path2 should be reported since it's first in the filelist
+        if val.endswith("path2"):
+            await asyncio.sleep(0.01)
+            raise SigningScriptError("path2 failed")
+        if val.endswith("path3"):
+            raise SigningScriptError("path3 failed")
+        return [val]
+
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=["autograph_mar"])
+    mocker.patch.object(script, "build_filelist_dict", new=fake_filelist_dict)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmpdir), "artifact_dir": str(tmpdir), "autograph_configs": {}, "max_concurrent_signings": 3}
+    with pytest.raises(SigningScriptError, match="path2 failed"):
+        await script.async_main(context)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("dry_run", (True, False))
+async def test_async_main_signing_estimate(tmpdir, mocker, dry_run):
+    filelist_dict = {"path1": {"full_path": "path1", "formats": ["autograph_mar"]}}
+    signed = []
+
+    async def fake_sign(_, val, *args, **kwargs):
+        signed.append(val)
+        return [val]
+
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=["autograph_mar"])
+    mocker.patch.object(script, "build_filelist_dict", return_value=filelist_dict)
+    write_signing_estimate = mocker.patch.object(script, "write_signing_estimate")
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmpdir), "artifact_dir": str(tmpdir), "autograph_configs": {}, "signing_estimate": True, "signing_dry_run": dry_run}
+    await script.async_main(context)
+    write_signing_estimate.assert_called_once_with(context, filelist_dict)
+    assert signed == ([] if dry_run else [os.path.join(str(tmpdir), "path1")])
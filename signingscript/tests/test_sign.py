@@ -1,22 +1,30 @@
 import asyncio
 import base64
+import dataclasses
+import io
 import json
 import os
 import os.path
 import re
 import shutil
-import subprocess
 import sys
 import tarfile
+import threading
+import time
 import zipfile
 from contextlib import contextmanager
-from hashlib import sha256
+from hashlib import sha256, sha384
+from io import BytesIO
 from unittest import mock
 
 import aiohttp
 import pytest
-import winsign.sign
+import winsign.osslsigncode
 from conftest import BASE_DIR, DEFAULT_SCOPE_PREFIX, SERVER_CONFIG_PATH, TEST_DATA_DIR, die, does_not_raise, noop_async, noop_sync
+from mardor.reader import MarReader
+from mardor.signing import make_rsa_keypair
+from mardor.signing import sign_hash as mardor_sign_hash
+from mardor.writer import MarWriter, add_signature_block
 from scriptworker.utils import makedirs
 
 import signingscript.sign as sign
@@ -66,20 +74,33 @@ class MockedSession:
         self.signed_file = signed_file
         self.exception = exception
         self.signature = signature
+        self.bodies = []
         self.post = mock.MagicMock(wraps=self.post)
 
     async def post(self, *args, **kwargs):
+        data = kwargs.get("data")
+        if hasattr(data, "read"):
+            self.bodies.append(data.read())
+            data.seek(0)
         resp = mock.MagicMock()
         resp.status = 200
         resp.json.return_value = asyncio.Future()
         if self.signed_file:
             resp.json.return_value.set_result([{"signed_file": self.signed_file}])
+            resp.content.iter_chunked = self.iter_chunked
         if self.signature:
             resp.json.return_value.set_result([{"signature": self.signature}])
         if self.exception:
             resp.json.side_effect = self.exception
         return resp
 
+    async def iter_chunked(self, n):
+        if self.exception:
+            raise self.exception
+        body = json.dumps([{"ref": "abc", "signed_file": self.signed_file}]).encode("utf8")
+        for i in range(0, len(body), 5):
+            yield body[i : i + 5]
+
 
 async def assert_file_permissions(archive):
     with tarfile.open(archive, mode="r") as t:
@@ -121,6 +142,163 @@ def test_get_autograph_config_raises_signingscript_error(context):
         sign.get_autograph_config(context.autograph_configs, TEST_CERT_TYPE, signing_formats=["invalid"], raise_on_empty=True)
 
 
+def test_get_autograph_servers(context):
+    servers = [utils.Autograph(f"https://autograph{i}", "user", "secret", ["autograph_mar", "autograph_gpg"][i % 2 : i % 2 + 1]) for i in range(4)]
+    context.autograph_configs = {TEST_CERT_TYPE: servers}
+    assert sign.get_autograph_servers(context.autograph_configs, TEST_CERT_TYPE, ["autograph_mar"]) == [servers[0], servers[2]]
+    assert sign.get_autograph_config(context.autograph_configs, TEST_CERT_TYPE, ["autograph_gpg"]) == servers[1]
+    assert sign.get_autograph_servers(context.autograph_configs, TEST_CERT_TYPE, ["invalid"]) == []
+    with pytest.raises(SigningScriptError):
+        sign.get_autograph_servers(context.autograph_configs, TEST_CERT_TYPE, ["invalid"], raise_on_empty=True)
+
+
+# AutographPool {{{1
+POOL_SERVERS = [utils.Autograph(f"https://autograph{i}", "user", "secret", ["autograph_mar"], f"key{i}") for i in range(3)]
+
+
+def test_autograph_pool_choose():
+    pool = sign.AutographPool()
+    # New servers are tried in turn
+    chosen = []
+    for _ in range(3):
+        server = pool.choose(POOL_SERVERS)
+        pool.get_stats(server).requests += 1
+        chosen.append(server)
+    assert chosen == POOL_SERVERS
+    # Then the fastest wins, until it has enough requests in flight
+    for server, latency in zip(POOL_SERVERS, (3.0, 1.0, 2.0)):
+        pool.record_success(server, latency)
+    assert pool.choose(POOL_SERVERS) == POOL_SERVERS[1]
+    pool.get_stats(POOL_SERVERS[1]).in_flight = 2
+    assert pool.choose(POOL_SERVERS) == POOL_SERVERS[2]
+    assert pool.choose(POOL_SERVERS, exclude={sign._autograph_server_key(POOL_SERVERS[2])}) == POOL_SERVERS[0]
+    # Excluding everything falls back to all of them
+    assert pool.choose(POOL_SERVERS, exclude={sign._autograph_server_key(s) for s in POOL_SERVERS}) == POOL_SERVERS[2]
+    # Latency is smoothed
+    pool.record_success(POOL_SERVERS[0], 13.0)
+    assert pool.get_stats(POOL_SERVERS[0]).latency == pytest.approx(6.0)
+
+
+def test_autograph_pool_ejection(mocker):
+    now = 1000.0
+    mocker.patch.object(sign.time, "monotonic", new=lambda: now)
+    pool = sign.AutographPool(error_threshold=2, cooldown=30.0)
+    bad, good = POOL_SERVERS[:2]
+    pool.record_failure(bad)
+    assert pool.is_healthy(bad)
+    pool.record_failure(bad)
+    assert not pool.is_healthy(bad)
+    assert pool.choose([bad, good]) == good
+    # If everything is ejected, use whatever comes back first
+    for _ in range(2):
+        pool.record_failure(good)
+    now += 10
+    assert pool.choose([bad, good]) == bad
+    # Back on probation after the cooldown; one failure ejects it again
+    now += 25
+    assert pool.is_healthy(bad)
+    pool.record_failure(bad)
+    assert not pool.is_healthy(bad)
+    now += 31
+    pool.record_success(bad, 1.0)
+    pool.record_failure(bad)
+    assert pool.is_healthy(bad)
+    assert pool.get_stats(bad).errors == 4
+
+
+class FailoverSession:
+    """Fail requests to some servers, and sign with the others."""
+
+    def __init__(self, bad_urls, exception=None):
+        self.bad_urls = bad_urls
+        self.exception = exception or aiohttp.ClientConnectionError("down")
+        self.urls = []
+        self.keyids = []
+
+    async def post(self, url, data=None, headers=None):
+        self.urls.append(url)
+        self.keyids.append([req.get("keyid") for req in json.load(data)])
+        if any(url.startswith(bad) for bad in self.bad_urls):
+            raise self.exception
+        resp = mock.MagicMock()
+        resp.status = 200
+        resp.json = mock.AsyncMock(return_value=[{"signature": "c2ln"}])
+        return resp
+
+
+@pytest.mark.asyncio
+async def test_sign_with_autograph_failover(mocker):
+    sleep = mocker.patch.object(sign.asyncio, "sleep", new=mock.AsyncMock())
+    pool = sign.AutographPool(error_threshold=1)
+    session = FailoverSession([POOL_SERVERS[0].url])
+    assert await sign.sign_with_autograph(session, POOL_SERVERS, BytesIO(b"hash"), "autograph_mar", "hash", pool=pool) == "c2ln"
+    # The failure went straight to the next server, with its own key
+    assert session.urls == ["https://autograph0/sign/hash", "https://autograph1/sign/hash"]
+    assert session.keyids == [["key0"], ["key1"]]
+    assert all(call.args[0] == 0 for call in sleep.await_args_list)
+    assert not pool.is_healthy(POOL_SERVERS[0])
+    # The ejected server is skipped from now on
+    session.urls = []
+    for _ in range(4):
+        await sign.sign_with_autograph(session, POOL_SERVERS, BytesIO(b"hash"), "autograph_mar", "hash", pool=pool)
+    assert len(session.urls) == 4
+    assert "https://autograph0/sign/hash" not in session.urls
+    assert "https://autograph2/sign/hash" in session.urls
+
+
+@pytest.mark.asyncio
+async def test_sign_with_autograph_all_servers_fail(mocker):
+    sleep = mocker.patch.object(sign.asyncio, "sleep", new=mock.AsyncMock())
+    pool = sign.AutographPool()
+    session = FailoverSession([s.url for s in POOL_SERVERS[:2]])
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await sign.sign_with_autograph(session, POOL_SERVERS[:2], BytesIO(b"hash"), "autograph_mar", "hash", pool=pool)
+    assert len(session.urls) == 3
+    # Back off only once both servers have failed
+    assert [call.args[0] > 0 for call in sleep.await_args_list] == [False, True]
+
+
+@pytest.mark.asyncio
+async def test_sign_with_autograph_client_error_keeps_server_healthy(mocker):
+    mocker.patch.object(sign.asyncio, "sleep", new=mock.AsyncMock())
+    pool = sign.AutographPool(error_threshold=1)
+    exception = aiohttp.ClientResponseError(None, (), status=400)
+    session = FailoverSession([POOL_SERVERS[0].url], exception=exception)
+    with pytest.raises(aiohttp.ClientResponseError):
+        await sign.sign_with_autograph(session, POOL_SERVERS[:1], BytesIO(b"hash"), "autograph_mar", "hash", pool=pool)
+    assert pool.is_healthy(POOL_SERVERS[0])
+    assert pool.get_stats(POOL_SERVERS[0]).errors == 0
+
+
+def test_get_autograph_pool(context):
+    context.config["autograph_pool_error_threshold"] = 5
+    pool = sign.get_autograph_pool(context)
+    assert pool.error_threshold == 5
+    assert pool.cooldown == 30.0
+    assert pool.max_concurrent_requests == 16
+    assert sign.get_autograph_pool(context) is pool
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("limit,expected", ((None, 10), (3, 3)))
+async def test_autograph_pool_max_concurrent_requests(limit, expected):
+    pool = sign.AutographPool(max_concurrent_requests=limit)
+    running = []
+    max_running = []
+
+    async def call(server):
+        running.append(server)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(server)
+        return server.url
+
+    results = await asyncio.gather(*[pool.call(POOL_SERVERS, call) for _ in range(10)])
+    assert max(max_running) == expected
+    assert len(results) == 10
+    assert sum(pool.get_stats(s).requests for s in POOL_SERVERS) == 10
+
+
 # sign_file {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
@@ -146,9 +324,14 @@ async def test_sign_file_autograph(context, mocker, to, expected):
         ("to", "to", "autograph_apk_sha1", {"pkcs7_digest": "SHA1", "zip": "passthrough"}),
     ),
 )
-async def test_sign_file_with_autograph(context, mocker, to, expected, format, options):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+async def test_sign_file_with_autograph(context, mocker, tmp_path, to, expected, format, options):
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"0xdeadbeef")
+    if to:
+        to = str(tmp_path / to)
+        expected = to
+    else:
+        expected = str(from_)
 
     mocked_session = MockedSession(signed_file="bW96aWxsYQ==")
     mocker.patch.object(context, "session", new=mocked_session)
@@ -159,15 +342,14 @@ async def test_sign_file_with_autograph(context, mocker, to, expected, format, o
             utils.Autograph(*["https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", [format]])
         ]
     }
-    assert await sign.sign_file_with_autograph(context, "from", format, to=to) == expected
-    open_mock.assert_called()
+    assert await sign.sign_file_with_autograph(context, str(from_), format, to=to) == expected
+    with open(expected, "rb") as fh:
+        assert fh.read() == b"mozilla"
     kwargs = {"input": "MHhkZWFkYmVlZg=="}
     if options:
         kwargs["options"] = options
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/file", headers=mocker.ANY, data=mocker.ANY)
-    data = mocked_session.post.call_args[1]["data"]
-    data.seek(0)
-    assert json.load(data) == [kwargs]
+    assert json.loads(mocked_session.bodies[-1]) == [kwargs]
 
 
 @pytest.mark.asyncio
@@ -188,6 +370,31 @@ async def test_sign_file_with_autograph_no_suitable_servers_errors(context, mock
         await sign.sign_file_with_autograph(context, "from", "autograph_mar", to=to)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "sign_function,fmt",
+    (
+        (sign.sign_file_with_autograph, "autograph_mar:otherkey"),
+        (sign.sign_file_with_autograph, "autograph_apk_fennec_sha1:otherkey"),
+        (sign.sign_gpg_with_autograph, "autograph_gpg:otherkey"),
+    ),
+)
+async def test_sign_with_autograph_keyid_errors(context, mocker, tmp_path, sign_function, fmt):
+    """A keyid these formats can't pass to autograph doesn't fall back to the server's default key."""
+    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
+    context.autograph_configs = {
+        "project:releng:signing:cert:dep-signing": [
+            utils.Autograph("https://autograph-hsm.dev.mozaws.net", "alice", "secret", ["autograph_mar", "autograph_apk_fennec_sha1", "autograph_gpg"])
+        ]
+    }
+    sign_with_autograph = mocker.patch.object(sign, "sign_with_autograph")
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"from")
+    with pytest.raises(SigningScriptError, match="No autograph config found"):
+        await sign_function(context, str(from_), fmt)
+    sign_with_autograph.assert_not_called()
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
 async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, expected):
@@ -197,8 +404,8 @@ async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, e
     mocked_session = MockedSession(signed_file="bW96aWxsYQ==", exception=aiohttp.ClientError)
     mocker.patch.object(context, "session", new=mocked_session)
 
-    async def fake_retry_async(func, args=(), attempts=5, sleeptime_kwargs=None):
-        await func(*args)
+    async def fake_retry_async(func, args=(), kwargs=None, attempts=5, sleeptime_kwargs=None, **_):
+        await func(*args, **(kwargs or {}))
 
     mocker.patch.object(sign, "retry_async", new=fake_retry_async)
 
@@ -233,80 +440,139 @@ def test_get_mar_verification_key(format, cert_type, keyid, raises, expected):
         assert sign.get_mar_verification_key(cert_type, format, keyid) == expected
 
 
+# mar helpers {{{1
+@pytest.fixture(scope="module")
+def mar_keys(tmp_path_factory):
+    """A 4096 bit keypair, which makes 512 byte signatures like autograph's."""
+    private_key, public_key = make_rsa_keypair(4096)
+    public_key_path = tmp_path_factory.mktemp("mar_keys") / "public.pem"
+    public_key_path.write_bytes(public_key)
+    return private_key, str(public_key_path)
+
+
+def _make_mar(path, signing_key=None, signing_algorithm=None):
+    with open(path, "w+b") as fh:
+        with MarWriter(fh, productversion="99.0", channel="release", signing_key=signing_key, signing_algorithm=signing_algorithm) as m:
+            for name, data in (("a", b"a" * 1000), ("b/c", os.urandom(3000))):
+                m.add_fileobj(BytesIO(data), name, compress=None, flags=0o644)
+    return path
+
+
 # verify_mar_signature {{{1
 @pytest.mark.parametrize("raises", (True, False))
-def test_verify_mar_signature(mocker, raises):
-    def fake_check_call(*args, **kwargs):
-        if raises:
-            raise subprocess.CalledProcessError("x", "foo")
-
-    mocker.patch.object(subprocess, "check_call", new=fake_check_call)
+def test_verify_mar_signature(mocker, tmp_path, mar_keys, raises):
+    private_key, public_key_path = mar_keys
+    if raises:
+        private_key, _ = make_rsa_keypair(2048)
+    path = _make_mar(str(tmp_path / "test.mar"), signing_key=private_key, signing_algorithm="sha384")
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key_path)
     if raises:
         with pytest.raises(SigningScriptError):
-            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
+            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", path)
     else:
-        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
+        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", path)
 
 
-# sign_mar384_with_autograph_hash {{{1
-@pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-
-    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
-    mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
+@pytest.mark.parametrize("raises", (True, False))
+def test_verify_mar_hash_signature(mocker, mar_keys, raises):
+    private_key, public_key_path = mar_keys
+    mar_hash = sha384(b"foo").digest()
+    signature = mardor_sign_hash(private_key, mar_hash, "sha384")
+    if raises:
+        signature = signature[:-1] + bytes([signature[-1] ^ 1])
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key_path)
+    if raises:
+        with pytest.raises(SigningScriptError):
+            sign.verify_mar_hash_signature("dep-signing", "autograph_stage_mar384", mar_hash, signature, "sha384")
+    else:
+        sign.verify_mar_hash_signature("dep-signing", "autograph_stage_mar384", mar_hash, signature, "sha384")
+
+
+# write_mar_with_signature_block {{{1
+@pytest.mark.parametrize("signing_algorithm,hash_algo", ((None, "sha384"), ("sha1", "sha384"), ("sha384", "sha384"), (None, "sha1")))
+def test_write_mar_with_signature_block(tmp_path, signing_algorithm, hash_algo):
+    signing_key = make_rsa_keypair(2048)[0] if signing_algorithm else None
+    path = _make_mar(str(tmp_path / "test.mar"), signing_key=signing_key, signing_algorithm=signing_algorithm)
+    # What mardor would do
+    expected = BytesIO()
+    with open(path, "rb") as src:
+        add_signature_block(src, expected, hash_algo)
+    expected.seek(0)
+    with MarReader(expected) as m:
+        expected_hash = m.calculate_hashes()[0][1]
+
+    dest = BytesIO()
+    with open(path, "rb") as src:
+        mar_hash, signature_offset = sign.write_mar_with_signature_block(src, dest, hash_algo)
+    assert dest.getvalue() == expected.getvalue()
+    assert mar_hash == expected_hash
+    signature_size = 512 if hash_algo == "sha384" else 256
+    assert dest.getvalue()[signature_offset : signature_offset + signature_size] == b"\0" * signature_size
 
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock()
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-    mocker.patch("signingscript.sign.verify_mar_signature")
 
+# sign_mar384_with_autograph_hash {{{1
+def _mar_autograph_context(context, keyid=None):
     context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
     context.autograph_configs = {
         "project:releng:signing:cert:dep-signing": [
             utils.Autograph(
-                "https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", ["autograph_hash_only_mar384"]
+                "https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", ["autograph_hash_only_mar384"], keyid
             )
         ]
     }
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
-    mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
 
 
 @pytest.mark.asyncio
-async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
-    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
-    context.autograph_configs = {
-        "project:releng:signing:cert:dep-signing": [
-            utils.Autograph(
-                "https://autograph-hsm.dev.mozaws.net",
-                "alice",
-                "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu",
-                ["autograph_hash_only_mar384"],
-                "autograph",
-            )
-        ]
-    }
+@pytest.mark.parametrize("to", (None, "to.mar"))
+async def test_sign_mar384_with_autograph_hash(context, mocker, tmp_path, mar_keys, to):
+    private_key, public_key_path = mar_keys
+    from_ = _make_mar(str(tmp_path / "from.mar"))
+    to = str(tmp_path / to) if to else None
+    _mar_autograph_context(context)
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key_path)
+    hashes = []
 
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-    mocker.patch("signingscript.sign.add_signature_block")
-    mar_reader = mocker.patch("signingscript.sign.MarReader")
-    mar_reader.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    mocker.patch("signingscript.sign.verify_mar_signature")
+    async def fake_sign_hash(context, h, fmt, keyid):
+        hashes.append(h)
+        return mardor_sign_hash(private_key, h, "sha384")
+
+    mocker.patch.object(sign, "sign_hash_with_autograph", new=fake_sign_hash)
+    with open(from_, "rb") as fh:
+        orig = BytesIO(fh.read())
+
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384", to=to) == (to or from_)
+    with open(to or from_, "rb") as fh:
+        with MarReader(fh) as m:
+            assert m.verify(open(public_key_path, "rb").read())
+            assert m.calculate_hashes()[0][1] == hashes[0]
+        fh.seek(0)
+        signed = fh.read()
+    # Same as mardor's add_signature_block
+    expected = BytesIO()
+    add_signature_block(orig, expected, "sha384", mardor_sign_hash(private_key, hashes[0], "sha384"))
+    assert signed == expected.getvalue()
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".mar")]
+
+
+@pytest.mark.asyncio
+async def test_sign_mar384_with_autograph_hash_session(context, mocker, tmp_path):
+    from_ = _make_mar(str(tmp_path / "from.mar"))
+    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
+    mocker.patch.object(context, "session", new=mocked_session)
+    verify = mocker.patch.object(sign, "verify_mar_hash_signature")
+    _mar_autograph_context(context)
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384") == from_
+    mar_hash = verify.call_args[0][2]
+    verify.assert_called_once_with("project:releng:signing:cert:dep-signing", "autograph_hash_only_mar384", mar_hash, b"0" * 512, "sha384", None)
+    mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
+    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": base64.b64encode(mar_hash).decode()}]
+
+
+@pytest.mark.asyncio
+async def test_sign_mar384_with_autograph_hash_keyid(context, mocker, tmp_path):
+    from_ = _make_mar(str(tmp_path / "from.mar"))
+    _mar_autograph_context(context, keyid="autograph")
+    mocker.patch.object(sign, "verify_mar_hash_signature")
 
     async def fake_sign_hash(context, h, fmt, keyid):
         return b"#" * 512
@@ -314,8 +580,9 @@ async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
     fake_sign_hash = mock.MagicMock(wraps=fake_sign_hash)
     mocker.patch("signingscript.sign.sign_hash_with_autograph", fake_sign_hash)
 
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384:keyid1") == "from"
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384:keyid1") == from_
     fake_sign_hash.assert_called_with(mocker.ANY, mocker.ANY, "autograph_hash_only_mar384", "keyid1")
+    sign.verify_mar_hash_signature.assert_called_with(mocker.ANY, "autograph_hash_only_mar384", mocker.ANY, b"#" * 512, "sha384", "keyid1")
 
 
 @pytest.mark.asyncio
@@ -337,41 +604,21 @@ async def test_sign_mar384_with_autograph_hash_no_suitable_servers_errors(contex
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-
-    mocked_session = MockedSession(signature=base64.b64encode(b"0"))
+@pytest.mark.parametrize("signature", (b"0", b"0" * 512))
+async def test_sign_mar384_with_autograph_hash_bad_signature(context, mocker, tmp_path, mar_keys, signature):
+    """Bad signatures raise, leaving the original file alone."""
+    from_ = _make_mar(str(tmp_path / "from.mar"))
+    with open(from_, "rb") as fh:
+        orig = fh.read()
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=mar_keys[1])
+    mocked_session = MockedSession(signature=base64.b64encode(signature))
     mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock()
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-
-    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
-    context.autograph_configs = {
-        "project:releng:signing:cert:dep-signing": [
-            utils.Autograph(
-                "https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", ["autograph_hash_only_mar384"]
-            )
-        ]
-    }
+    _mar_autograph_context(context)
     with pytest.raises(SigningScriptError):
-        assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
-
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
-    mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+        await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384")
+    with open(from_, "rb") as fh:
+        assert fh.read() == orig
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".mar")]
 
 
 # sign_gpg {{{1
@@ -500,6 +747,8 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
     mocker.patch.object(sign, "generate_precomplete", new=noop_sync)
     mocker.patch.object(sign, "_create_tarfile", new=noop_async)
     mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_update_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_update_tarfile", new=noop_async)
     mocker.patch.object(sign, "_run_generate_precomplete", new=noop_sync)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
@@ -565,6 +814,38 @@ def test_run_generate_precomplete(context, num_precomplete, raises, mocker):
         sign._run_generate_precomplete(context, work_dir)
 
 
+@pytest.mark.parametrize("root", ("firefox", "Firefox.app/Contents/Resources"))
+def test_run_generate_precomplete_from_list(context, tmp_path, root):
+    """Generating `precomplete` from the member list matches walking the full tree."""
+    files = ["precomplete", "a", "b/c", "b/d/e", "defaults/pref/channel-prefs.js", "update-settings.ini", "distribution/f", "g/distribution/h"]
+    dirs = ["empty/"]
+    if root.endswith("Resources"):
+        files += ["../MacOS/firefox", "../MacOS/firefox.sig", "../../other/i"]
+    walk_dir = tmp_path / "walk"
+    list_dir = tmp_path / "list"
+    for top in (walk_dir, list_dir):
+        for f in files + dirs:
+            path = os.path.normpath(os.path.join(top, root, f))
+            makedirs(path if f.endswith("/") else os.path.dirname(path))
+            # Only `precomplete` needs to be extracted to generate from the list
+            if top == walk_dir and not f.endswith("/") or f == "precomplete":
+                with open(path, "w") as fh:
+                    fh.write("before")
+
+    walk_path = sign._run_generate_precomplete(context, str(walk_dir))
+    file_list = [os.path.join(list_dir, root, f) for f in files if f != "precomplete"] + [os.path.join(list_dir, root, d) for d in dirs]
+    list_path = sign._run_generate_precomplete(context, str(list_dir), file_list=file_list)
+    with open(walk_path) as fh:
+        expected = fh.read()
+    with open(list_path) as fh:
+        assert fh.read() == expected
+    prefix = "Contents/Resources/" if root.endswith("Resources") else ""
+    assert 'remove "{}precomplete"'.format(prefix) in expected
+    assert 'rmdir "{}empty/"'.format(prefix) in expected
+    assert "channel-prefs.js" not in expected
+    assert "distribution/" not in expected
+
+
 # remove_extra_files {{{1
 def test_remove_extra_files(context):
     extra = ["a", "b/c"]
@@ -591,36 +872,40 @@ def test_remove_extra_files(context):
 
 # zip_align_apk {{{1
 @pytest.mark.asyncio
-@pytest.mark.parametrize("is_verbose", (True, False))
-async def test_zip_align_apk(context, monkeypatch, is_verbose):
-    context.config["zipalign"] = "/path/to/android/sdk/zipalign"
-    context.config["verbose"] = is_verbose
-    abs_to = "/absolute/path/to/apk.apk"
-
-    async def execute_subprocess_mock(command):
-        if is_verbose:
-            assert command[0:4] == ["/path/to/android/sdk/zipalign", "-v", "4", abs_to]
-            assert len(command) == 5
-        else:
-            assert command[0:3] == ["/path/to/android/sdk/zipalign", "4", abs_to]
-            assert len(command) == 4
-
-    def shutil_mock(_, destination):
-        assert destination == abs_to
-
-    monkeypatch.setattr("signingscript.utils.execute_subprocess", execute_subprocess_mock)
-    monkeypatch.setattr("shutil.move", shutil_mock)
+async def test_zip_align_apk(context, tmpdir):
+    abs_to = os.path.join(tmpdir, "apk.apk")
+    with zipfile.ZipFile(abs_to, "w") as z:
+        for name in ("a", "bb", "ccc", "resources.arsc"):
+            z.writestr(name, name * 10)
+        z.writestr("classes.dex", b"dex" * 100, compress_type=zipfile.ZIP_DEFLATED)
+    with open(abs_to, "rb") as fh:
+        assert sign.zipalign.get_misaligned_members(fh, 4)
 
     await sign.zip_align_apk(context, abs_to)
+    with open(abs_to, "rb") as fh:
+        assert sign.zipalign.get_misaligned_members(fh, 4) == []
+    with zipfile.ZipFile(abs_to) as z:
+        assert z.testzip() is None
+        assert z.read("ccc") == b"ccc" * 10
+    mtime = os.stat(abs_to).st_mtime_ns
+    # Already aligned apks are left alone
+    await sign.zip_align_apk(context, abs_to)
+    assert os.stat(abs_to).st_mtime_ns == mtime
 
 
 # _convert_dmg_to_tar_gz {{{1
 @pytest.mark.asyncio
-async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir):
+@pytest.mark.parametrize("python_extraction", (True, False))
+async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir, python_extraction):
+    """Without python extraction, or for a dmg it can't read, use the binaries."""
+    context.config["dmg_python_extraction"] = python_extraction
     dmg_path = "path/to/foo.dmg"
     abs_dmg_path = os.path.join(context.config["work_dir"], dmg_path)
     tarball_path = "path/to/foo.tar.gz"
     abs_tarball_path = os.path.join(context.config["work_dir"], tarball_path)
+    os.makedirs(os.path.dirname(abs_dmg_path))
+    with open(abs_dmg_path, "wb") as fh:
+        fh.write(b"not a udif image" * 100)
 
     async def execute_subprocess_mock(command, **kwargs):
         assert command in (
@@ -636,13 +921,38 @@ async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir):
     monkeypatch.setattr("signingscript.utils.execute_subprocess", execute_subprocess_mock)
     monkeypatch.setattr("tempfile.TemporaryDirectory", fake_tmpdir)
 
-    await sign._convert_dmg_to_tar_gz(context, dmg_path)
+    assert await sign._convert_dmg_to_tar_gz(context, dmg_path) == tarball_path
+    assert not os.path.exists(abs_tarball_path)
+
+
+@pytest.mark.asyncio
+async def test_convert_dmg_to_tar_gz_python(context, mocker):
+    dmg_path = "path/to/foo.DMG"
+    abs_dmg_path = os.path.join(context.config["work_dir"], dmg_path)
+    os.makedirs(os.path.dirname(abs_dmg_path))
+    with open(abs_dmg_path, "wb") as fh:
+        fh.write(b"dmg")
+
+    def write_dmg_to_tarfile(fh, tar):
+        assert fh.read() == b"dmg"
+        info = tarfile.TarInfo("./foo")
+        info.size = 3
+        tar.addfile(info, io.BytesIO(b"foo"))
+
+    mocker.patch.object(sign.dmg, "write_dmg_to_tarfile", write_dmg_to_tarfile)
+    mocker.patch.object(sign.utils, "execute_subprocess", side_effect=AssertionError("shouldn't use the binaries"))
+    assert await sign._convert_dmg_to_tar_gz(context, dmg_path) == "path/to/foo.tar.gz"
+    with tarfile.open(os.path.join(context.config["work_dir"], "path/to/foo.tar.gz")) as t:
+        assert t.extractfile("./foo").read() == b"foo"
 
 
 # _extract_zipfile _create_zipfile {{{1
 @pytest.mark.asyncio
 async def test_get_zipfile_files():
     assert sorted(await sign._get_zipfile_files(os.path.join(TEST_DATA_DIR, "test.zip"))) == ["a", "b", "c/", "c/d", "c/e/", "c/e/f"]
+    sizes = await sign._get_zipfile_files(os.path.join(TEST_DATA_DIR, "test.zip"), sizes=True)
+    assert sorted(sizes) == ["a", "b", "c/", "c/d", "c/e/", "c/e/f"]
+    assert sizes["c/"] == 0 and sizes["a"] > 0
 
 
 @pytest.mark.asyncio
@@ -689,6 +999,67 @@ async def test_zipfile_append_write(context):
     assert sorted(await sign._get_zipfile_files(to)) == full_rel_files
 
 
+# _update_zipfile {{{1
+@pytest.mark.asyncio
+@pytest.mark.parametrize("data_descriptor", (True, False))
+async def test_update_zipfile(context, tmp_path, data_descriptor):
+    to = str(tmp_path / "test.zip")
+    contents = {"a": b"a" * 1000, "b/c": os.urandom(1000), "d": b"d" * 1000}
+    if data_descriptor:
+        # Writing to an unseekable stream makes zipfile use data descriptors
+        with open(to, "wb") as fh:
+            unseekable = mock.Mock(spec=["write", "flush"], write=fh.write, flush=fh.flush)
+            with zipfile.ZipFile(unseekable, "w", compression=zipfile.ZIP_DEFLATED) as z:
+                for name, data in contents.items():
+                    z.writestr(name, data)
+    else:
+        with zipfile.ZipFile(to, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            for name, data in contents.items():
+                z.writestr(name, data)
+    with zipfile.ZipFile(to) as z:
+        assert all(bool(info.flag_bits & 0x08) == data_descriptor for info in z.infolist())
+        orig_infos = {info.filename: info for info in z.infolist()}
+        orig_raw = {info.filename: _read_raw_member(z, info) for info in z.infolist()}
+
+    tmp_dir = tmp_path / "unzipped"
+    (tmp_dir / "b").mkdir(parents=True)
+    (tmp_dir / "b" / "c").write_bytes(b"new c")
+    (tmp_dir / "e.sig").write_bytes(b"new e")
+    compress = mock.MagicMock(wraps=zipfile.ZipFile._open_to_write)
+    with mock.patch.object(zipfile.ZipFile, "_open_to_write", new=lambda self, *args, **kwargs: compress(self, *args, **kwargs)):
+        assert await sign._update_zipfile(context, to, [str(tmp_dir / "b" / "c"), str(tmp_dir / "e.sig")], tmp_dir=str(tmp_dir)) == to
+    # Only the changed and new files were compressed
+    assert [call[0][1].filename for call in compress.call_args_list] == ["b/c", "e.sig"]
+
+    with zipfile.ZipFile(to) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["a", "b/c", "d", "e.sig"]
+        assert z.read("b/c") == b"new c"
+        assert z.read("e.sig") == b"new e"
+        for name in ("a", "d"):
+            assert z.read(name) == contents[name]
+            info = z.getinfo(name)
+            assert (info.CRC, info.compress_size, info.file_size) == (orig_infos[name].CRC, orig_infos[name].compress_size, orig_infos[name].file_size)
+            assert _read_raw_member(z, info) == orig_raw[name]
+    # The temporary file was renamed into place
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".zip")]
+
+
+def _read_raw_member(z, info):
+    z.fp.seek(info.header_offset)
+    return z.fp.read(zipfile.sizeFileHeader + len(info.filename) + info.compress_size)
+
+
+@pytest.mark.asyncio
+async def test_bad_update_zipfile(context, tmp_path):
+    to = tmp_path / "foo.zip"
+    to.write_bytes(b"not a zipfile")
+    with pytest.raises(SigningScriptError):
+        await sign._update_zipfile(context, str(to), [])
+    # The temporary file is cleaned up
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".zip")]
+
+
 # tarfile {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize("path,compression", ((os.path.join(TEST_DATA_DIR, "test.tar.bz2"), "bz2"), (os.path.join(TEST_DATA_DIR, "test.tar.gz"), "gz")))
@@ -706,8 +1077,112 @@ def test_get_tarfile_compression(compression, expected, raises):
 
 
 @pytest.mark.asyncio
-async def test_working_tarfile(context):
-    await helper_archive(context, "foo.tar.gz", sign._create_tarfile, sign._extract_tarfile, "gz")
+@pytest.mark.parametrize("compression", ("gz", "bz2"))
+@pytest.mark.parametrize("threads", (1, 3))
+async def test_working_tarfile(context, mocker, compression, threads):
+    context.config["tarfile_compression_threads"] = threads
+    compressor = mocker.spy(utils, "ParallelCompressor")
+    await helper_archive(context, "foo.tar.{}".format(compression), sign._create_tarfile, sign._extract_tarfile, compression)
+    assert compressor.call_count == (0 if threads == 1 else 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("bz2", "gz"))
+async def test_get_tarfile_files_include_dirs(compression):
+    path = os.path.join(TEST_DATA_DIR, "test.tar.{}".format(compression))
+    assert sorted(await sign._get_tarfile_files(path, compression, include_dirs=True)) == ["./", "./a", "./b", "./c/", "./c/d", "./c/e/", "./c/e/f"]
+    sizes = await sign._get_tarfile_files(path, compression, include_dirs=True, sizes=True)
+    assert sorted(sizes) == ["./", "./a", "./b", "./c/", "./c/d", "./c/e/", "./c/e/f"]
+    assert sizes["./c/"] == 0 and sizes["./a"] > 0
+
+
+@pytest.mark.asyncio
+async def test_get_tarfile_files_include_links_precomplete(context, tmp_path):
+    """Links in the member list give the same `precomplete` as walking the extracted tree."""
+    src_dir = tmp_path / "src"
+    makedirs(str(src_dir / "firefox" / "lib" / "sub"))
+    for f in ("precomplete", "firefox", "lib/libfoo.so", "lib/sub/g"):
+        with open(os.path.join(src_dir, "firefox", f), "w") as fh:
+            fh.write("contents")
+    os.symlink("lib/libfoo.so", str(src_dir / "firefox" / "libfoo.so"))
+    os.symlink("lib", str(src_dir / "firefox" / "libdir"))
+    os.symlink("libdir", str(src_dir / "firefox" / "libdir2"))
+    os.symlink("missing", str(src_dir / "firefox" / "broken"))
+    os.link(str(src_dir / "firefox" / "firefox"), str(src_dir / "firefox" / "firefox-bin"))
+    path = str(tmp_path / "links.tar.gz")
+    with tarfile.open(path, "w:gz") as t:
+        t.add(str(src_dir / "firefox"), arcname="firefox")
+
+    all_files = await sign._get_tarfile_files(path, "gz", include_dirs=True, include_links=True)
+    assert {"firefox/libfoo.so", "firefox/libdir/", "firefox/libdir2/", "firefox/broken", "firefox/firefox-bin"} <= set(all_files)
+    assert "firefox/libdir" not in await sign._get_tarfile_files(path, "gz", include_dirs=True)
+
+    walk_dir = str(tmp_path / "walk")
+    with tarfile.open(path) as t:
+        t.extractall(walk_dir)
+    walk_path = sign._run_generate_precomplete(context, walk_dir)
+    list_dir = str(tmp_path / "list")
+    await sign._extract_tarfile(context, path, "gz", files=["firefox/precomplete"], tmp_dir=list_dir)
+    file_list = [os.path.join(list_dir, f) for f in all_files if f != "firefox/precomplete"]
+    list_path = sign._run_generate_precomplete(context, list_dir, file_list=file_list)
+    with open(walk_path) as fh:
+        expected = fh.read()
+    with open(list_path) as fh:
+        assert fh.read() == expected
+    assert 'remove "libfoo.so"' in expected
+    assert 'rmdir "libdir/"' in expected
+
+
+@pytest.mark.asyncio
+async def test_extract_tarfile_subset(context, tmp_path):
+    path = os.path.join(TEST_DATA_DIR, "test.tar.gz")
+    tmp_dir = str(tmp_path / "untarred")
+    assert await sign._extract_tarfile(context, path, "gz", files=["./c/e/f", "./a"], tmp_dir=tmp_dir) == [
+        os.path.join(tmp_dir, "./a"),
+        os.path.join(tmp_dir, "./c/e/f"),
+    ]
+    assert sorted(os.listdir(tmp_dir)) == ["a", "c"]
+    assert os.listdir(os.path.join(tmp_dir, "c")) == ["e"]
+    with pytest.raises(SigningScriptError):
+        await sign._extract_tarfile(context, path, "gz", files=["./a", "./missing"], tmp_dir=tmp_dir)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("bz2", "gz"))
+@pytest.mark.parametrize("threads", (1, 3))
+async def test_update_tarfile(context, tmp_path, compression, threads):
+    context.config["tarfile_compression_threads"] = threads
+    to = str(tmp_path / "test.tar.{}".format(compression))
+    shutil.copyfile(os.path.join(TEST_DATA_DIR, "test.tar.{}".format(compression)), to)
+    with tarfile.open(to) as t:
+        orig = {m.name: (m.type, t.extractfile(m).read() if m.isfile() else None) for m in t.getmembers()}
+
+    tmp_dir = tmp_path / "untarred"
+    (tmp_dir / "c").mkdir(parents=True)
+    (tmp_dir / "c" / "d").write_bytes(b"new d")
+    (tmp_dir / "c" / "g.sig").write_bytes(b"new g")
+    assert await sign._update_tarfile(context, to, [str(tmp_dir / "c" / "d"), str(tmp_dir / "c" / "g.sig")], compression, tmp_dir=str(tmp_dir)) == to
+
+    await assert_file_permissions(to)
+    with tarfile.open(to) as t:
+        # Members keep their order and names; new files are appended
+        assert t.getnames() == list(orig) + ["c/g.sig"]
+        assert t.extractfile("./c/d").read() == b"new d"
+        assert t.extractfile("c/g.sig").read() == b"new g"
+        for m in t.getmembers():
+            if m.name not in ("./c/d", "c/g.sig"):
+                assert (m.type, t.extractfile(m).read() if m.isfile() else None) == orig[m.name]
+    # The temporary file was renamed into place
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".tar")]
+
+
+@pytest.mark.asyncio
+async def test_bad_update_tarfile(context, tmp_path):
+    to = tmp_path / "foo.tar.gz"
+    to.write_bytes(b"not a tarfile")
+    with pytest.raises(SigningScriptError):
+        await sign._update_tarfile(context, str(to), [], "gz")
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".tar")]
 
 
 @pytest.mark.asyncio
@@ -771,6 +1246,91 @@ def test_signreq_task_langpack():
     assert req["options"]["pkcs7_digest"] == "SHA256"
 
 
+# AutographRequestBody {{{1
+class ShortReader(BytesIO):
+    """Return at most 5 bytes per read, like a pipe might."""
+
+    def read(self, size=-1):
+        return super().read(5 if size < 0 else min(size, 5))
+
+
+@pytest.mark.parametrize("chunk_size", (3, 6, 3 * 1024))
+@pytest.mark.parametrize("input_cls", (BytesIO, ShortReader))
+@pytest.mark.parametrize("data", (b"", b"a", b"ab", b"abc", os.urandom(10000)))
+def test_autograph_request_body(chunk_size, input_cls, data):
+    sign_req = {"input": input_cls(data), "keyid": "key", "options": {"zip": "passthrough"}}
+    body = sign.AutographRequestBody(sign_req, chunk_size=chunk_size)
+    expected = json.dumps([{"input": base64.b64encode(data).decode("ascii"), "keyid": "key", "options": {"zip": "passthrough"}}]).encode("utf8")
+    raw = body.read()
+    assert json.loads(raw) == json.loads(expected)
+    assert body.tell() == body.size == len(raw)
+    # Rewinding re-encodes the input from the start
+    body.seek(0)
+    assert json.load(body) == json.loads(expected)
+
+
+def test_autograph_request_body_hash_matches():
+    data = os.urandom(100000)
+    sign_req = {"input": BytesIO(data), "keyid": "key"}
+    body = sign.AutographRequestBody(sign_req, chunk_size=3 * 100)
+    raw = json.dumps([{"input": base64.b64encode(data).decode("ascii"), "keyid": "key"}], separators=(",", ":")).encode("utf8")
+    assert sign.get_hawk_content_hash(body, "application/json") == sign.get_hawk_content_hash(BytesIO(raw), "application/json")
+
+
+@pytest.mark.parametrize("chunk_size", (0, 4, 1024))
+def test_autograph_request_body_bad_chunk_size(chunk_size):
+    with pytest.raises(SigningScriptError):
+        sign.AutographRequestBody({"input": BytesIO(b"")}, chunk_size=chunk_size)
+
+
+def test_autograph_request_body_bad_seek():
+    body = sign.AutographRequestBody({"input": BytesIO(b"abc")})
+    with pytest.raises(io.UnsupportedOperation):
+        body.seek(2)
+
+
+# SignedFileResponseParser {{{1
+@pytest.mark.parametrize("chunk_size", (1, 3, 7, 1024))
+@pytest.mark.parametrize("data", (b"", b"a", b"mozilla", os.urandom(10000)))
+@pytest.mark.parametrize("escape_slashes", (True, False))
+def test_signed_file_response_parser(chunk_size, data, escape_slashes):
+    response = [{"ref": 'a "quoted" \\ signed_file', "signed_file": base64.b64encode(data).decode("ascii"), "x5u": None, "options": {"signed_file": 1}}]
+    raw = json.dumps(response).encode("utf8")
+    if escape_slashes:
+        raw = raw.replace(b"/", b"\\/")
+    fh = BytesIO()
+    parser = sign.SignedFileResponseParser(fh)
+    for i in range(0, len(raw), chunk_size):
+        parser.feed(raw[i : i + chunk_size])
+    response[0]["signed_file"] = ""
+    assert parser.close() == response
+    assert fh.getvalue() == data
+    assert parser.bytes_written == len(data)
+
+
+@pytest.mark.parametrize(
+    "raw",
+    (b'[{"signature": "abcd"}]', b'[{"signed_file": "abcd', b'[{"signed_file": "abc"}]', b'[{"signed_file": "abcd"}'),
+)
+def test_signed_file_response_parser_errors(raw):
+    parser = sign.SignedFileResponseParser(BytesIO())
+    parser.feed(raw)
+    with pytest.raises(SigningScriptError):
+        parser.close()
+
+
+@pytest.mark.asyncio
+async def test_write_signed_file_response_error(tmp_path):
+    to = tmp_path / "signed"
+    to.write_bytes(b"original")
+    session = MockedSession(signed_file="bW96aWxsYQ==", exception=aiohttp.ClientError)
+    with pytest.raises(aiohttp.ClientError):
+        await sign.write_signed_file_response(await session.post(), str(to))
+    # The target and temporary files are left alone
+    assert os.listdir(tmp_path) == ["signed"]
+    assert to.read_bytes() == b"original"
+
+
 @pytest.mark.asyncio
 async def test_bad_autograph_method():
     with pytest.raises(SigningScriptError):
@@ -787,9 +1347,71 @@ async def test_bad_autograph_format(context):
         await sign.sign_hash_with_autograph(context, "", "gpg")
 
 
+# AutographBatcher {{{1
+class BatchingSession:
+    """Sign each input in the request with a fake signature."""
+
+    def __init__(self, fail=False, drop=False):
+        self.fail = fail
+        self.drop = drop
+        self.batches = []
+
+    async def post(self, url, data=None, headers=None):
+        reqs = json.load(data)
+        self.batches.append([base64.b64decode(req["input"]) for req in reqs])
+        if self.fail:
+            raise aiohttp.ClientError("boom")
+        resp = mock.MagicMock()
+        resp.status = 200
+        sigs = [{"signature": base64.b64encode(b"sig:" + base64.b64decode(req["input"])).decode()} for req in reqs]
+        resp.json = mock.AsyncMock(return_value=sigs[:-1] if self.drop else sigs)
+        return resp
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_size,expected_batches", ((1, 5), (2, 3), (20, 1)))
+async def test_sign_hash_with_autograph_batches(context, mocker, batch_size, expected_batches):
+    _mar_autograph_context(context)
+    context.config["autograph_hash_batch_size"] = batch_size
+    context.config["autograph_hash_batch_linger"] = 0.01
+    context.session = BatchingSession()
+    hashes = [str(i).encode() * 10 for i in range(5)]
+    signatures = await asyncio.gather(*[sign.sign_hash_with_autograph(context, h, "autograph_hash_only_mar384") for h in hashes])
+    assert signatures == [b"sig:" + h for h in hashes]
+    assert len(context.session.batches) == expected_batches
+    assert sorted(h for batch in context.session.batches for h in batch) == hashes
+    # A later call starts a new batch
+    assert await sign.sign_hash_with_autograph(context, b"later", "autograph_hash_only_mar384") == b"sig:later"
+    assert context.session.batches[-1] == [b"later"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fail,drop,exc", ((True, False, aiohttp.ClientError), (False, True, SigningScriptError)))
+async def test_sign_hash_with_autograph_batch_errors(context, mocker, fail, drop, exc):
+    async def fake_retry_async(func, args=(), kwargs=None, attempts=5, sleeptime_kwargs=None, **_):
+        return await func(*args, **(kwargs or {}))
+
+    mocker.patch.object(sign, "retry_async", new=fake_retry_async)
+    _mar_autograph_context(context)
+    context.config["autograph_hash_batch_linger"] = 0.01
+    context.session = BatchingSession(fail=fail, drop=drop)
+    results = await asyncio.gather(*[sign.sign_hash_with_autograph(context, b"x", "autograph_hash_only_mar384") for _ in range(3)], return_exceptions=True)
+    assert len(context.session.batches) == 1
+    assert all(isinstance(r, exc) for r in results)
+
+
+def test_autograph_request_body_batch():
+    sign_reqs = [{"input": BytesIO(b"abc"), "keyid": "key"}, {"input": BytesIO(b"defg"), "keyid": "key"}]
+    body = sign.AutographRequestBody(sign_reqs)
+    raw = body.read()
+    assert body.size == len(raw)
+    assert json.loads(raw) == [{"input": "YWJj", "keyid": "key"}, {"input": "ZGVmZw==", "keyid": "key"}]
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("blessed", (True, False))
 async def test_widevine_autograph(context, mocker, tmp_path, blessed):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     wv = mocker.patch("signingscript.sign.widevine")
     wv.generate_widevine_hash.return_value = b"hashhashash"
     wv.generate_widevine_signature.return_value = b"sigwidevinesig"
@@ -805,13 +1427,25 @@ async def test_widevine_autograph(context, mocker, tmp_path, blessed):
     cert = tmp_path / "widevine.crt"
     cert.write_bytes(b"TMPCERT")
     context.config["widevine_cert"] = cert
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"from")
 
     to = tmp_path / "signed.sig"
-    to = await sign.sign_widevine_with_autograph(context, "from", blessed, to=to)
+    to = await sign.sign_widevine_with_autograph(context, from_, blessed, to=to)
 
     assert b"sigwidevinesig" == to.read_bytes()
     assert called_format == "autograph_widevine"
 
+    # An identical file reuses the signature
+    other = tmp_path / "other"
+    other.write_bytes(b"from")
+    assert (await sign.sign_widevine_with_autograph(context, str(other), blessed)) == f"{other}.sig"
+    assert (tmp_path / "other.sig").read_bytes() == b"sigwidevinesig"
+    assert wv.generate_widevine_hash.call_count == 1
+    # But not with the other flags
+    await sign.sign_widevine_with_autograph(context, str(other), not blessed)
+    assert wv.generate_widevine_hash.call_count == 2
+
 
 @pytest.mark.asyncio
 async def test_no_widevine(context, mocker, tmp_path):
@@ -892,8 +1526,8 @@ async def test_sign_omnija(context, mocker, filename, raises, nofiles):
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
     mocker.patch.object(sign, "_convert_dmg_to_tar_gz", new=fake_undmg)
     mocker.patch.object(sign, "sign_omnija_with_autograph", new=noop_async)
-    mocker.patch.object(sign, "_create_tarfile", new=noop_async)
-    mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_update_tarfile", new=noop_async)
+    mocker.patch.object(sign, "_update_zipfile", new=noop_async)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
     if raises:
@@ -935,6 +1569,54 @@ async def test_omnija_same(mocker, tmpdir, orig):
     assert open(copy_from, "rb").read() == open(copy_to, "rb").read()
 
 
+@pytest.mark.asyncio
+async def test_omnija_merge_passthrough(mocker, tmpdir):
+    orig = os.path.join(tmpdir, "omni.ja")
+    signed = os.path.join(tmpdir, "signed.ja")
+    to = os.path.join(tmpdir, "new_omni.ja")
+    with sign.mozjar.JarWriter(orig, compress=True) as writer:
+        for i in range(10):
+            writer.add(f"chrome/file{i}.js", os.urandom(100) * 20)
+        writer.preload(["chrome/file5.js", "chrome/file2.js"])
+    with zipfile.ZipFile(signed, "w") as z:
+        z.writestr("META-INF/cose.sig", b"cose" * 100)
+        z.writestr("chrome/file0.js", b"ignored")
+
+    compressobj = mocker.spy(sign.mozjar.zlib, "compressobj")
+    decompress = mocker.spy(sign.mozjar.zlib, "decompress")
+    await sign.merge_omnija_files(orig, signed, to)
+    # Only the META-INF entry was compressed, and nothing was inflated
+    assert compressobj.call_count == 1
+    assert decompress.call_count == 0
+
+    orig_reader = sign.mozjar.JarReader(orig)
+    new_reader = sign.mozjar.JarReader(to)
+    assert list(new_reader.entries) == list(orig_reader.entries) + [b"META-INF/cose.sig"]
+    assert new_reader.last_preloaded == orig_reader.last_preloaded == b"chrome/file2.js"
+    for name, entry in orig_reader.entries.items():
+        for field in ("crc32", "compressed_size", "uncompressed_size", "compression"):
+            assert new_reader.entries[name][field] == entry[field]
+        assert new_reader[name].compressed_data.tobytes() == orig_reader[name].compressed_data.tobytes()
+    assert new_reader[b"META-INF/cose.sig"].read() == b"cose" * 100
+
+
+@pytest.mark.parametrize("orig", ("no_preload_unsigned_omni.ja", "preload_unsigned_omni.ja"))
+def test_jarreader_mmap(orig):
+    path = os.path.join(TEST_DATA_DIR, orig)
+    reader = sign.mozjar.JarReader(path)
+    with sign.mozjar.JarReader(path, use_mmap=True) as mmap_reader:
+        assert list(mmap_reader.entries) == list(reader.entries)
+        assert mmap_reader.last_preloaded == reader.last_preloaded
+        jarfiles = list(mmap_reader)
+        for jarfile in jarfiles:
+            assert isinstance(jarfile.compressed_data, memoryview)
+            assert jarfile.read() == reader[jarfile.filename].read()
+    # The mapping outlives the reader while jarfiles still refer to it
+    assert jarfiles[0].compressed_data.tobytes() == reader[jarfiles[0].filename].compressed_data.tobytes()
+    # Closing twice is fine
+    mmap_reader.close()
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "orig,signed,sha256_expected",
@@ -1006,10 +1688,33 @@ def test_extension_id_raises(json_, raises, mocker):
         assert id == json_["applications"]["gecko"]["id"]
 
 
+def mock_winsign(mocker, check_dummy_signature=None):
+    """Replace osslsigncode and the asn1 handling in authenticode signing."""
+
+    def get_dummy_signature(infile, digest_algo, url=None, comment=None, crosscert=None):
+        if check_dummy_signature:
+            check_dummy_signature(infile, digest_algo, comment)
+        return b"dummy"
+
+    async def resign(old_sig, certs, signer):
+        await signer("", "")
+        return b"signature"
+
+    def write_signature(infile, outfile, sig):
+        assert sig == b"signature"
+        shutil.copyfile(infile, outfile)
+
+    mocker.patch.object(winsign.osslsigncode, "get_dummy_signature", get_dummy_signature)
+    mocker.patch.object(winsign.osslsigncode, "write_signature", write_signature)
+    mocker.patch.object(sign, "get_signeddata", lambda sig: sig)
+    mocker.patch.object(sign, "resign", resign)
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("fmt", ("autograph_authenticode", "autograph_authenticode_stub"))
 @pytest.mark.parametrize("use_comment", (True, False))
 async def test_authenticode_sign_zip(tmpdir, mocker, context, fmt, use_comment):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_cross_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_url"] = "https://example.com"
@@ -1024,20 +1729,17 @@ async def test_authenticode_sign_zip(tmpdir, mocker, context, fmt, use_comment):
     async def mocked_autograph(context, from_, fmt, keyid):
         return b""
 
-    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, comment=None, **kwargs):
+    def check_dummy_signature(infile, digest_algo, comment):
         if infile.endswith(".msi") and use_comment:
             assert comment == "Some authenticode comment"
         else:
             assert comment is None
-        await signer("", "")
-        shutil.copyfile(infile, outfile)
-        return True
 
     def mocked_issigned(filename):
         if filename.endswith("signed.exe"):
             return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker, check_dummy_signature)
     mocker.patch.object(winsign.osslsigncode, "is_signed", mocked_issigned)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
@@ -1050,6 +1752,7 @@ async def test_authenticode_sign_zip(tmpdir, mocker, context, fmt, use_comment):
 @pytest.mark.parametrize("fmt", ("autograph_authenticode", "autograph_authenticode_stub"))
 @pytest.mark.parametrize("use_comment", (True, False))
 async def test_authenticode_sign_msi(tmpdir, mocker, context, fmt, use_comment):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_cross_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_url"] = "https://example.com"
@@ -1064,21 +1767,18 @@ async def test_authenticode_sign_msi(tmpdir, mocker, context, fmt, use_comment):
     async def mocked_autograph(context, from_, fmt, keyid):
         return b""
 
-    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, comment=None, **kwargs):
+    def check_dummy_signature(infile, digest_algo, comment):
         assert digest_algo == "sha1"
         if not use_comment:
             assert comment is None
         else:
             assert comment == "Some authenticode comment"
-        await signer("", "")
-        shutil.copyfile(infile, outfile)
-        return True
 
     def mocked_issigned(filename):
         if filename.endswith("signed.exe"):
             return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker, check_dummy_signature)
     mocker.patch.object(winsign.osslsigncode, "is_signed", mocked_issigned)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
@@ -1089,6 +1789,7 @@ async def test_authenticode_sign_msi(tmpdir, mocker, context, fmt, use_comment):
 
 @pytest.mark.asyncio
 async def test_authenticode_ev_sha(tmpdir, mocker, context):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_cross_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_url"] = "https://example.com"
@@ -1102,17 +1803,14 @@ async def test_authenticode_ev_sha(tmpdir, mocker, context):
     async def mocked_autograph(context, from_, fmt, keyid):
         return b""
 
-    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, comment=None, **kwargs):
+    def check_dummy_signature(infile, digest_algo, comment):
         assert digest_algo == "sha256"
-        await signer("", "")
-        shutil.copyfile(infile, outfile)
-        return True
 
     def mocked_issigned(filename):
         if filename.endswith("signed.exe"):
             return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker, check_dummy_signature)
     mocker.patch.object(winsign.osslsigncode, "is_signed", mocked_issigned)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
@@ -1121,6 +1819,169 @@ async def test_authenticode_ev_sha(tmpdir, mocker, context):
     assert os.path.exists(result)
 
 
+@pytest.mark.asyncio
+async def test_authenticode_sign_zip_pipelined(tmp_path, mocker, context):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    context.config["authenticode_signing_threads"] = 2
+    names = [f"lib{i}.dll" for i in range(6)]
+    test_file = str(tmp_path / "windows.zip")
+    with zipfile.ZipFile(test_file, "w") as z:
+        for name in names + ["README.txt"]:
+            z.writestr(name, name)
+
+    events = []
+    running = []
+    max_running = []
+    loop_thread = threading.current_thread()
+
+    def check_dummy_signature(infile, digest_algo, comment):
+        assert threading.current_thread() is not loop_thread
+        running.append(infile)
+        max_running.append(len(running))
+        events.append(("digest", os.path.basename(infile)))
+        time.sleep(0.05)
+        running.remove(infile)
+
+    async def mocked_autograph(context, from_, fmt, keyid):
+        events.append(("autograph", None))
+        await asyncio.sleep(0.01)
+        return b""
+
+    mock_winsign(mocker, check_dummy_signature)
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: False)
+    mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
+    load_pem_certs = mocker.spy(sign, "load_pem_certs")
+
+    assert await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode") == test_file
+    assert load_pem_certs.call_count == 1
+    assert max(max_running) == 2
+    assert sorted(name for event, name in events if event == "digest") == names
+    # Autograph started signing before the last file was digested
+    kinds = [kind for kind, _ in events]
+    assert kinds.index("autograph") < max(i for i, kind in enumerate(kinds) if kind == "digest")
+    with zipfile.ZipFile(test_file) as z:
+        assert sorted(z.namelist()) == sorted(names + ["README.txt"])
+
+
+@pytest.mark.asyncio
+async def test_authenticode_sign_zip_error_doesnt_block(tmp_path, mocker, context):
+    """A failure is raised without waiting for osslsigncode stages still running in threads."""
+    context.task = {"scopes": [TEST_CERT_TYPE]}
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    context.config["authenticode_signing_threads"] = 2
+    test_file = str(tmp_path / "windows.zip")
+    with zipfile.ZipFile(test_file, "w") as z:
+        for name in ("fail.dll", "slow.dll"):
+            z.writestr(name, name)
+    release = threading.Event()
+
+    def dummy_signature(infile, digest_algo, comment):
+        if infile.endswith("fail.dll"):
+            raise OSError("osslsigncode failed")
+        release.wait(10)
+
+    mock_winsign(mocker, dummy_signature)
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: False)
+    start = time.monotonic()
+    try:
+        with pytest.raises(IOError):
+            await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
+        assert time.monotonic() - start < 5
+    finally:
+        release.set()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("persistent", (True, False))
+async def test_authenticode_sign_zip_reuses_signed_content(tmp_path, mocker, context, persistent):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    if persistent:
+        context.config["signed_content_cache_dir"] = str(tmp_path / "cache")
+    test_file = str(tmp_path / "windows.zip")
+    with zipfile.ZipFile(test_file, "w") as z:
+        for locale in ("en-US", "de", "fr"):
+            z.writestr(f"{locale}/helper.exe", b"helper")
+        z.writestr("other.exe", b"other")
+
+    digested = []
+
+    def write_signature(infile, outfile, sig):
+        with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+            fout.write(b"signed " + fin.read())
+
+    mock_winsign(mocker, lambda infile, digest_algo, comment: digested.append(infile))
+    mocker.patch.object(winsign.osslsigncode, "write_signature", write_signature)
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: False)
+    mocker.patch.object(sign, "sign_hash_with_autograph", mock.AsyncMock(return_value=b""))
+
+    await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
+    assert len(digested) == 2
+    with zipfile.ZipFile(test_file) as z:
+        assert {name: z.read(name) for name in z.namelist()} == {
+            "en-US/helper.exe": b"signed helper",
+            "de/helper.exe": b"signed helper",
+            "fr/helper.exe": b"signed helper",
+            "other.exe": b"signed other",
+        }
+
+    # A retry of the same task signs nothing again
+    with zipfile.ZipFile(test_file, "w") as z:
+        z.writestr("helper.exe", b"helper")
+    await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
+    assert len(digested) == 2
+    # A new task on the same worker only reuses the persistent cache
+    del context.signed_content_cache
+    shutil.rmtree(os.path.join(context.config["work_dir"], "signed_content_cache"), ignore_errors=True)
+    with zipfile.ZipFile(test_file, "w") as z:
+        z.writestr("helper.exe", b"helper")
+    await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
+    assert len(digested) == (2 if persistent else 3)
+    # Signing differently doesn't reuse anything
+    with zipfile.ZipFile(test_file, "w") as z:
+        z.writestr("helper.exe", b"helper")
+    await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode_ev")
+    assert len(digested) == (3 if persistent else 4)
+
+
+@pytest.mark.asyncio
+async def test_authenticode_sign_reuses_signed_content_per_key(tmp_path, mocker, context):
+    """A different cert type, or autograph server or key id, doesn't reuse a persistent cache entry."""
+    context.task = {"scopes": [TEST_CERT_TYPE]}
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    context.config["signed_content_cache_dir"] = str(tmp_path / "cache")
+    test_file = str(tmp_path / "helper.exe")
+    digested = []
+    mock_winsign(mocker, lambda infile, digest_algo, comment: digested.append(infile))
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: False)
+    mocker.patch.object(sign, "sign_hash_with_autograph", mock.AsyncMock(return_value=b""))
+
+    async def sign_in_new_task(cert_type):
+        for attr in ("signing_plan", "signed_content_cache"):
+            if hasattr(context, attr):
+                delattr(context, attr)
+        context.task = {"scopes": [cert_type]}
+        with open(test_file, "wb") as fh:
+            fh.write(b"helper")
+        await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
+        return len(digested)
+
+    assert await sign_in_new_task(TEST_CERT_TYPE) == 1
+    assert await sign_in_new_task(TEST_CERT_TYPE) == 1
+    assert await sign_in_new_task("{}cert:release-signing".format(DEFAULT_SCOPE_PREFIX)) == 2
+    context.autograph_configs[TEST_CERT_TYPE] = [dataclasses.replace(a, key_id="other") for a in context.autograph_configs[TEST_CERT_TYPE]]
+    assert await sign_in_new_task(TEST_CERT_TYPE) == 3
+
+
 @pytest.mark.asyncio
 async def test_authenticode_sign_zip_nofiles(tmpdir, mocker, context):
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
@@ -1130,17 +1991,14 @@ async def test_authenticode_sign_zip_nofiles(tmpdir, mocker, context):
     test_file = os.path.join(tmpdir, "partial1.mar")
     shutil.copyfile(os.path.join(TEST_DATA_DIR, "partial1.mar"), test_file)
 
-    async def mocked_winsign(infile, outfile, *args, **kwargs):
-        shutil.copyfile(infile, outfile)
-        return True
-
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker)
     with pytest.raises(SigningScriptError):
         await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
 
 
 @pytest.mark.asyncio
 async def test_authenticode_sign_zip_error(tmpdir, mocker, context):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_url"] = "https://example.com"
     context.config["authenticode_timestamp_style"] = None
@@ -1148,16 +2006,18 @@ async def test_authenticode_sign_zip_error(tmpdir, mocker, context):
     test_file = os.path.join(tmpdir, "windows.zip")
     shutil.copyfile(os.path.join(TEST_DATA_DIR, "windows.zip"), test_file)
 
-    async def mocked_winsign(infile, outfile, *args, **kwargs):
-        return False
+    def mocked_dummy_signature(*args, **kwargs):
+        raise OSError("osslsigncode failed")
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: False)
+    mocker.patch.object(winsign.osslsigncode, "get_dummy_signature", mocked_dummy_signature)
     with pytest.raises(IOError):
         await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
 
 
 @pytest.mark.asyncio
 async def test_authenticode_sign_authenticode_permanent_error(tmpdir, mocker, context, caplog):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_url"] = "https://example.com"
     context.config["authenticode_timestamp_style"] = None
@@ -1168,13 +2028,8 @@ async def test_authenticode_sign_authenticode_permanent_error(tmpdir, mocker, co
     async def mocked_authenticode_sign(infile, outfile, *args, **kwargs):
         raise Exception("BAD!")
 
-    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, **kwargs):
-        await signer("", "")
-        shutil.copyfile(infile, outfile)
-        return True
-
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_authenticode_sign)
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker)
 
     with pytest.raises(Exception):
         await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
@@ -1223,6 +2078,7 @@ async def test_authenticode_sign_gpg_temporary_error(tmpdir, mocker, context, ca
 
 @pytest.mark.asyncio
 async def test_authenticode_sign_single_file(tmpdir, mocker, context):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_cross_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_url"] = "https://example.com"
@@ -1234,12 +2090,7 @@ async def test_authenticode_sign_single_file(tmpdir, mocker, context):
     async def mocked_autograph(context, from_, fmt, keyid):
         return b""
 
-    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, **kwargs):
-        await signer("", "")
-        shutil.copyfile(infile, outfile)
-        return True
-
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
     result = await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
@@ -1249,6 +2100,7 @@ async def test_authenticode_sign_single_file(tmpdir, mocker, context):
 
 @pytest.mark.asyncio
 async def test_authenticode_sign_keyids(tmpdir, mocker, context):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_cert_202005"] = os.path.join(TEST_DATA_DIR, "windows.crt")
     context.config["authenticode_cross_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
@@ -1262,14 +2114,29 @@ async def test_authenticode_sign_keyids(tmpdir, mocker, context):
         assert keyid == "202005"
         return keyid
 
-    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, **kwargs):
-        await signer("", "")
-        shutil.copyfile(infile, outfile)
-        return True
-
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mock_winsign(mocker)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
     result = await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode:202005")
     assert result == test_file
     assert os.path.exists(result)
+
+
+def test_authenticode_cert_store(tmp_path, mocker, context):
+    shutil.copyfile(os.path.join(TEST_DATA_DIR, "windows.crt"), tmp_path / "cross.crt")
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_cert_202005"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_cross_cert"] = str(tmp_path / "cross.crt")
+    load_pem_certs = mocker.spy(sign, "load_pem_certs")
+    store = sign.get_authenticode_cert_store(context)
+    assert sign.get_authenticode_cert_store(context) is store
+
+    certs = store.get_certs()
+    assert len(certs) == 1
+    # Callers get their own list, so they can append the cross certs
+    certs.extend(store.get_cross_certs())
+    assert len(store.get_certs()) == 1
+    assert store.get_certs("202005") == store.get_certs()
+    assert load_pem_certs.call_count == 2
+    with pytest.raises(KeyError):
+        store.get_certs("unknown")
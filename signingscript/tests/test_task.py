@@ -1,4 +1,10 @@
+import asyncio
+import io
+import json
 import os
+import tarfile
+import zipfile
+from unittest import mock
 
 import pytest
 from conftest import BASE_DIR
@@ -6,7 +12,8 @@ from scriptworker.client import validate_task_schema
 from scriptworker.exceptions import ScriptWorkerTaskException, TaskVerificationError
 
 import signingscript.task as stask
-from signingscript.utils import mkdir
+from signingscript.exceptions import SigningScriptError, UnsupportedDmgError
+from signingscript.utils import DigestCache, SignedContentCache, mkdir
 
 # helper constants, fixtures, functions {{{1
 SERVER_CONFIG_PATH = os.path.join(BASE_DIR, "example_server_config.json")
@@ -221,3 +228,168 @@ def test_build_filelist_dict_comment(context, task_defn_authenticode_comment):
 
     # Now ok
     assert stask.build_filelist_dict(context) == expected
+
+
+# _get_format_semaphore {{{1
+@pytest.mark.asyncio
+async def test_get_format_semaphore(context):
+    context.config["max_concurrent_signings"] = 5
+    context.config["max_concurrent_signings_per_format"] = {"autograph_authenticode": 2}
+    semaphore = stask._get_format_semaphore(context, "autograph_authenticode:202005")
+    assert semaphore is stask._get_format_semaphore(context, "autograph_authenticode")
+    assert semaphore._value == 2
+    assert stask._get_format_semaphore(context, "autograph_mar")._value == 5
+
+
+@pytest.mark.asyncio
+async def test_sign_format_concurrency(context, mocker):
+    context.config["max_concurrent_signings_per_format"] = {"autograph_mar": 1}
+    running = []
+
+    async def fake_sign(_, path, *args, **kwargs):
+        running.append(path)
+        assert len(running) == 1
+        await asyncio.sleep(0.01)
+        running.remove(path)
+        return path
+
+    mocker.patch.object(stask, "FORMAT_TO_SIGNING_FUNCTION", new={"default": fake_sign})
+    await asyncio.gather(*[stask.sign(context, "file{}".format(i), ["autograph_mar"]) for i in range(3)])
+
+
+# get_digest_cache {{{1
+def test_get_digest_cache(context):
+    cache = stask.get_digest_cache(context)
+    assert isinstance(cache, DigestCache)
+    assert stask.get_digest_cache(context) is cache
+
+
+# get_signed_content_cache {{{1
+@pytest.mark.parametrize("cache_dir", (None, "persistent"))
+def test_get_signed_content_cache(context, tmpdir, cache_dir):
+    if cache_dir:
+        cache_dir = context.config["signed_content_cache_dir"] = os.path.join(tmpdir, cache_dir)
+    cache = stask.get_signed_content_cache(context)
+    assert isinstance(cache, SignedContentCache)
+    assert cache.cache_dir == (cache_dir or os.path.join(context.config["work_dir"], "signed_content_cache"))
+    assert stask.get_signed_content_cache(context) is cache
+
+
+# SigningPlan {{{1
+def test_signing_plan(context, mocker):
+    context.task = {"scopes": [TEST_CERT_TYPE]}
+    cert_type = mocker.patch.object(stask, "task_cert_type", wraps=stask.task_cert_type)
+    get_servers = mocker.patch.object(stask, "get_autograph_servers", wraps=stask.get_autograph_servers)
+    plan = stask.get_signing_plan(context)
+    assert stask.get_signing_plan(context) is plan
+
+    entries = plan.add("a.exe", ["autograph_authenticode:202005", "autograph_gpg"])
+    assert plan.add("b.exe", ["autograph_authenticode:202005"])["autograph_authenticode:202005"] is entries["autograph_authenticode:202005"]
+    entry = entries["autograph_authenticode:202005"]
+    assert (entry.fmt, entry.keyid, entry.cert_type) == ("autograph_authenticode", "202005", TEST_CERT_TYPE)
+    assert entry.get_servers() == context.autograph_configs[TEST_CERT_TYPE][1:]
+    assert plan.get("autograph_authenticode:202005") is entry
+    # The plain format is resolved separately, on first use
+    assert plan.get("autograph_authenticode").keyid is None
+    assert plan.get("autograph_authenticode").get_servers() == entry.get_servers()
+    with pytest.raises(SigningScriptError, match="No autograph config found"):
+        entries["autograph_gpg"].get_servers()
+    # Scopes and configs are only scanned once per format
+    assert cert_type.call_count == 1
+    assert get_servers.call_count == 3
+
+
+@pytest.mark.parametrize("fmt", ("autograph_marsha384:keyid", "autograph_gpg:otherkey", "autograph_apk_fennec_sha1:otherkey"))
+def test_signing_plan_keyid_not_split(context, fmt):
+    """Formats that don't pass a keyid to autograph only match servers on the full format."""
+    context.task = {"scopes": [TEST_CERT_TYPE]}
+    entry = stask.get_signing_plan(context).get(fmt)
+    assert (entry.fmt, entry.keyid) == (fmt, None)
+    with pytest.raises(SigningScriptError, match="No autograph config found"):
+        entry.get_servers()
+
+
+def test_signing_plan_no_scopes(context):
+    context.task = {"scopes": []}
+    plan = stask.get_signing_plan(context)
+    # The format alone doesn't need the task scopes
+    assert plan.get("autograph_authenticode:202005").keyid == "202005"
+    with pytest.raises(TaskVerificationError):
+        plan.add("a.exe", ["autograph_authenticode:202005"])
+
+
+# estimate_signing {{{1
+def _write_zip(path, members):
+    with zipfile.ZipFile(path, "w") as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+
+
+@pytest.mark.asyncio
+async def test_estimate_signing(context, tmpdir, mocker):
+    _write_zip(os.path.join(tmpdir, "win.zip"), {"firefox.exe": b"exe", "xul.dll": b"dll", "msvcp140.dll": b"ms", "README": b"readme"})
+    _write_zip(os.path.join(tmpdir, "empty.zip"), {"README": b"readme"})
+    with tarfile.open(os.path.join(tmpdir, "linux.tar.gz"), "w:gz") as t:
+        for name, data in (("firefox/omni.ja", b"o" * 100), ("firefox/browser/omni.ja", b"b" * 10), ("firefox/libxul.so", b"xul")):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    for name in ("target.complete.mar", "mac.dmg", "apk.apk"):
+        with open(os.path.join(tmpdir, name), "wb") as fh:
+            fh.write(b"x" * 30)
+    mocker.patch.object(stask.dmg, "get_dmg_files", return_value={"./": 0, "./Firefox.app/Contents/MacOS/firefox": 10, "./Firefox.app/Contents/MacOS/XUL": 10})
+    filelist_dict = {
+        path: {"full_path": os.path.join(tmpdir, path), "formats": formats}
+        for path, formats in (
+            ("win.zip", ["autograph_authenticode_ev", "autograph_widevine", "autograph_gpg"]),
+            ("linux.tar.gz", ["autograph_widevine", "autograph_omnija"]),
+            ("target.complete.mar", ["autograph_hash_only_mar384:keyid"]),
+            ("mac.dmg", ["macapp", "autograph_widevine"]),
+            ("apk.apk", ["autograph_apk_fennec_sha1"]),
+            ("empty.zip", ["autograph_authenticode", "autograph_gpg"]),
+        )
+    }
+    estimate = await stask.estimate_signing(context, filelist_dict)
+    artifacts = estimate["artifacts"]
+    assert [(f["autograph_calls"], f["upload_bytes"], f["archive_rewrites"]) for f in artifacts["win.zip"]["formats"]] == [
+        (2, 88, 1),
+        (2, 176, 1),
+        (1, 4 * ((artifacts["win.zip"]["size"] + 2) // 3), 0),
+    ]
+    assert artifacts["win.zip"]["formats"][0]["signed_files"] == ["firefox.exe", "xul.dll"]
+    assert [(f["autograph_calls"], f["upload_bytes"], f["archive_rewrites"]) for f in artifacts["linux.tar.gz"]["formats"]] == [(1, 88, 1), (2, 136 + 16, 3)]
+    assert artifacts["target.complete.mar"]["formats"][0]["upload_bytes"] == 64
+    # The dmg is converted once, and its members are listed for widevine
+    assert [(f["autograph_calls"], f["archive_rewrites"]) for f in artifacts["mac.dmg"]["formats"]] == [(1, 1), (2, 1)]
+    assert artifacts["mac.dmg"]["formats"][0]["signed_files"] == ["mac.tar.gz"]
+    assert artifacts["apk.apk"]["formats"][0]["archive_rewrites"] == 1
+    # Formats after a failing format are skipped
+    assert len(artifacts["empty.zip"]["formats"]) == 1
+    assert estimate["errors"] == [{"path": "empty.zip", "format": "autograph_authenticode", "error": mock.ANY}]
+    assert "Did not find any files to sign" in estimate["errors"][0]["error"]
+    assert estimate["autograph_calls_per_format"]["autograph_widevine"] == 5
+    assert estimate["totals"]["autograph_calls"] == sum(estimate["autograph_calls_per_format"].values()) == 13
+
+
+@pytest.mark.asyncio
+async def test_estimate_signing_unsupported_dmg(context, tmpdir, mocker):
+    path = os.path.join(tmpdir, "mac.dmg")
+    with open(path, "wb") as fh:
+        fh.write(b"x" * 30)
+    mocker.patch.object(stask.dmg, "get_dmg_files", side_effect=UnsupportedDmgError("compressed"))
+    filelist_dict = {"mac.dmg": {"full_path": path, "formats": ["macapp", "autograph_widevine", "autograph_omnija"]}}
+    estimate = await stask.estimate_signing(context, filelist_dict)
+    # The binaries can still convert it, so it's not an error
+    assert estimate["errors"] == []
+    formats = estimate["artifacts"]["mac.dmg"]["formats"]
+    assert [f.get("members") for f in formats] == [None, "unknown (binary fallback)", "unknown (binary fallback)"]
+    assert [f["autograph_calls"] for f in formats] == [1, 0, 0]
+
+
+@pytest.mark.asyncio
+async def test_write_signing_estimate(context, mocker):
+    estimate = {"totals": {"autograph_calls": 1, "upload_bytes": 2, "archive_rewrites": 3}, "errors": [{"path": "a", "format": "b", "error": "c"}]}
+    mocker.patch.object(stask, "estimate_signing", return_value=estimate)
+    assert await stask.write_signing_estimate(context, {}) == estimate
+    with open(os.path.join(context.config["artifact_dir"], stask.SIGNING_ESTIMATE_PATH)) as fh:
+        assert json.load(fh) == estimate
@@ -1,5 +1,11 @@
+import bz2
+import gzip
+import hashlib
+import io
 import json
 import os
+import shutil
+import subprocess
 
 import mock
 import pytest
@@ -7,7 +13,7 @@ from conftest import PUB_KEY_PATH, read_file
 from scriptworker.context import Context
 
 import signingscript.utils as utils
-from signingscript.exceptions import FailedSubprocess, SigningServerError
+from signingscript.exceptions import FailedSubprocess, SigningScriptError, SigningServerError
 
 ID_RSA_PUB_HASH = "226658906e46b26ef195c468f94e2be983b6c53f370dff0d8e725832f" + "4645933de4755690a3438760afe8790a91938100b75b5d63e76ebd00920adc8d2a8857e"
 
@@ -43,6 +49,63 @@ def test_get_hash():
     assert utils.get_hash(PUB_KEY_PATH, hash_type="sha512") == ID_RSA_PUB_HASH
 
 
+def test_get_hashes(tmpdir):
+    path = os.path.join(tmpdir, "file")
+    data = os.urandom(utils.HASH_CHUNK_SIZE * 2 + 1)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    assert utils.get_hashes(path, ["sha256", "sha512"]) == {"sha256": hashlib.sha256(data).hexdigest(), "sha512": hashlib.sha512(data).hexdigest()}
+
+
+# DigestCache {{{1
+def test_digest_cache(tmpdir, mocker):
+    path = os.path.join(tmpdir, "file")
+    with open(path, "w") as fh:
+        fh.write("foo")
+    cache = utils.DigestCache()
+    get_hashes = mocker.spy(utils, "get_hashes")
+    assert cache.get_hashes(path, ["sha256"]) == {"sha256": hashlib.sha256(b"foo").hexdigest()}
+    assert get_hashes.call_count == 1
+    # Cached; also found through a different path to the same file
+    assert cache.get_hashes(os.path.join(tmpdir, ".", "file"), ["sha256"]) == {"sha256": hashlib.sha256(b"foo").hexdigest()}
+    assert get_hashes.call_count == 1
+    # Only the missing hash is calculated
+    assert cache.get_hashes(path, ["sha256", "sha512"])["sha512"] == hashlib.sha512(b"foo").hexdigest()
+    assert get_hashes.call_args[0][1] == ["sha512"]
+    calls = get_hashes.call_count
+
+    # Changing the file invalidates the entry
+    with open(path, "w") as fh:
+        fh.write("barbaz")
+    os.utime(path, ns=(0, 0))
+    assert cache.get_hashes(path, ["sha256", "sha512"]) == {"sha256": hashlib.sha256(b"barbaz").hexdigest(), "sha512": hashlib.sha512(b"barbaz").hexdigest()}
+    assert get_hashes.call_count == calls + 1
+    assert get_hashes.call_args[0][1] == ["sha256", "sha512"]
+
+
+# SignedContentCache {{{1
+def test_signed_content_cache(tmpdir):
+    cache = utils.SignedContentCache(os.path.join(tmpdir, "cache"))
+    signed = os.path.join(tmpdir, "signed")
+    with open(signed, "wb") as fh:
+        fh.write(b"signed")
+    key = ["digest", "autograph_authenticode", None, ["certdigest"], "sha1"]
+    to = os.path.join(tmpdir, "to")
+    assert not cache.get(key, to)
+    assert not os.path.exists(to)
+    cache.put(key, signed)
+    assert cache.get(key, to)
+    with open(to, "rb") as fh:
+        assert fh.read() == b"signed"
+    assert not cache.get(key[:-1] + ["sha256"], to)
+    # Only the entry is left behind, no temporary files
+    assert len(list(os.walk(os.path.join(tmpdir, "cache")))[1][2]) == 1
+    # Another cache in the same dir sees the entry
+    assert utils.SignedContentCache(os.path.join(tmpdir, "cache")).get(key, to)
+    assert cache.lock(key) is cache.lock(list(key))
+    assert cache.lock(key) is not cache.lock(key[:-1])
+
+
 # load_json {{{1
 def test_load_json_from_file(tmpdir):
     json_object = {"a_key": "a_value"}
@@ -66,6 +129,39 @@ def test_load_autograph_configs():
     assert cfg["project:releng:signing:cert:dep-signing"][1].key_id == "keyid"
 
 
+# ParallelCompressor {{{1
+@pytest.mark.parametrize("compression,decompress,tool", (("gz", gzip.decompress, "gzip"), ("bz2", bz2.decompress, "bzip2")))
+@pytest.mark.parametrize("size", (0, 1, 999, 1000, 12345))
+def test_parallel_compressor(tmpdir, compression, decompress, tool, size):
+    data = os.urandom(size // 2) + b"x" * (size - size // 2)
+    path = os.path.join(tmpdir, "out")
+    with open(path, "wb") as fh:
+        with utils.ParallelCompressor(fh, compression, 3, block_size=1000) as compressor:
+            # Writes that don't line up with the blocks
+            for i in range(0, size, 333):
+                assert compressor.write(data[i : i + 333]) == len(data[i : i + 333])
+        assert not fh.closed
+    with open(path, "rb") as fh:
+        compressed = fh.read()
+    assert decompress(compressed) == data
+    if shutil.which(tool):
+        assert subprocess.run([tool, "-dc", path], check=True, stdout=subprocess.PIPE).stdout == data
+
+
+def test_parallel_compressor_blocks():
+    fh = io.BytesIO()
+    with utils.ParallelCompressor(fh, "gz", 2, block_size=10) as compressor:
+        compressor.write(b"a" * 25)
+    # One gzip member per block
+    assert fh.getvalue().count(b"\x1f\x8b\x08") == 3
+    assert gzip.decompress(fh.getvalue()) == b"a" * 25
+
+
+def test_parallel_compressor_bad_compression():
+    with pytest.raises(SigningScriptError):
+        utils.ParallelCompressor(io.BytesIO(), "xz", 2)
+
+
 # log_output {{{1
 @pytest.mark.asyncio
 async def test_log_output(tmpdir, mocker):
@@ -0,0 +1,144 @@
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+import signingscript.zipalign as zipalign
+from signingscript.exceptions import SigningScriptError
+
+# helper constants, fixtures, functions {{{1
+MEMBERS = {
+    "a": b"a" * 10,
+    "bb/": b"",
+    "bb/ccc": os.urandom(1000),
+    "resources.arsc": b"arsc" * 100,
+    "classes.dex": b"dex" * 1000,
+    "lib/x86/libxul.so": os.urandom(5000),
+}
+
+
+class Unseekable(io.RawIOBase):
+    """Make zipfile write data descriptors."""
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.fh.write(b)
+
+
+def make_zip(comment=b"", prefix=b"", unseekable=False):
+    fh = io.BytesIO()
+    fh.write(prefix)
+    with zipfile.ZipFile(Unseekable(fh) if unseekable else fh, "w") as z:
+        z.comment = comment
+        for name, data in MEMBERS.items():
+            info = zipfile.ZipInfo(name, date_time=(2020, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED if name == "classes.dex" else zipfile.ZIP_STORED
+            info.extra = b"\xfe\xca\x00\x00" if name == "a" else b""
+            z.writestr(info, data)
+    return fh
+
+
+def align(from_fh, alignment=4):
+    to_fh = io.BytesIO()
+    zipalign.align_zip(from_fh, to_fh, alignment)
+    return to_fh
+
+
+def assert_same_members(fh):
+    with zipfile.ZipFile(fh) as z:
+        assert z.testzip() is None
+        assert {info.filename: z.read(info) for info in z.infolist()} == MEMBERS
+
+
+# get_misaligned_members align_zip {{{1
+@pytest.mark.parametrize("alignment", (4, 4096))
+@pytest.mark.parametrize(
+    "kwargs",
+    (
+        {},
+        {"comment": b"a comment"},
+        {"prefix": b"#!/bin/sh\n"},
+        {"unseekable": True},
+    ),
+)
+def test_align_zip(kwargs, alignment):
+    from_fh = make_zip(**kwargs)
+    assert zipalign.get_misaligned_members(from_fh, alignment)
+    to_fh = align(from_fh, alignment)
+    assert zipalign.get_misaligned_members(to_fh, alignment) == []
+    assert_same_members(to_fh)
+    with zipfile.ZipFile(to_fh) as z:
+        assert z.comment == kwargs.get("comment", b"")
+    assert to_fh.getvalue().startswith(kwargs.get("prefix", b""))
+    # Aligning is idempotent
+    assert align(to_fh, alignment).getvalue() == to_fh.getvalue()
+
+
+def test_align_zip_only_pads_stored_members():
+    from_fh = make_zip()
+    to_fh = align(from_fh)
+    with zipfile.ZipFile(from_fh) as from_z, zipfile.ZipFile(to_fh) as to_z:
+        for from_info, to_info in zip(from_z.infolist(), to_z.infolist()):
+            assert from_info.compress_size == to_info.compress_size
+            assert from_info.CRC == to_info.CRC
+    # Compressed members don't need aligning
+    assert "classes.dex" not in zipalign.get_misaligned_members(from_fh, 4096)
+
+
+def test_align_empty_zip():
+    from_fh = io.BytesIO()
+    zipfile.ZipFile(from_fh, "w").close()
+    assert zipalign.get_misaligned_members(from_fh, 4) == []
+    assert align(from_fh).getvalue() == from_fh.getvalue()
+
+
+@pytest.mark.parametrize(
+    "data,match",
+    (
+        (b"not a zip", "no end of central directory"),
+        (b"PK\x05\x06" + b"\0" * 6 + b"\xff\xff" + b"\0" * 10, "Zip64"),
+        (b"PK\x05\x06" + b"\0" * 4 + b"\x01\x00\x01\x00" + b"\x2e\0\0\0" + b"\0" * 6, "Truncated"),
+    ),
+)
+def test_bad_zip(data, match):
+    with pytest.raises(SigningScriptError, match=match):
+        zipalign.get_misaligned_members(io.BytesIO(data), 4)
+
+
+def test_corrupt_local_header():
+    data = bytearray(make_zip().getvalue())
+    data[0:4] = b"XXXX"
+    with pytest.raises(SigningScriptError, match="no local header"):
+        zipalign.get_misaligned_members(io.BytesIO(bytes(data)), 4)
+
+
+# align_zip_file {{{1
+def test_align_zip_file(tmpdir):
+    path = os.path.join(tmpdir, "apk.apk")
+    with open(path, "wb") as fh:
+        fh.write(make_zip().getvalue())
+    os.chmod(path, 0o644)
+    assert zipalign.align_zip_file(path, 4) is True
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    with open(path, "rb") as fh:
+        assert zipalign.get_misaligned_members(fh, 4) == []
+        assert_same_members(fh)
+    assert zipalign.align_zip_file(path, 4) is False
+    assert os.listdir(tmpdir) == ["apk.apk"]
+
+
+def test_align_zip_file_failure(tmpdir, mocker):
+    path = os.path.join(tmpdir, "apk.apk")
+    with open(path, "wb") as fh:
+        fh.write(make_zip().getvalue())
+    mocker.patch.object(zipalign, "align_zip", side_effect=lambda from_fh, to_fh, alignment: to_fh.write(b"truncated"))
+    with pytest.raises(SigningScriptError):
+        zipalign.align_zip_file(path, 4)
+    assert os.listdir(tmpdir) == ["apk.apk"]